@@ -0,0 +1,146 @@
+import math
+import time
+import asyncio
+import weakref
+from collections import deque
+from fastapi import HTTPException
+from fastapi.responses import StreamingResponse
+from starlette.background import BackgroundTask
+from starlette.concurrency import iterate_in_threadpool
+from schemas.variables import *
+from stores.admission_store import admission_state, admission_waiters, admission_sessions
+from helpers.metrics.helpers import record_timing, increment_counter, set_gauge
+
+def publish_admission_gauges():
+    set_gauge("llm_admission.active", admission_state["active"])
+    set_gauge("llm_admission.queue_depth", admission_state["queued"])
+
+def get_retry_after() -> str:
+    """
+    Estimates the seconds until a stream frees up for a new request, from the queue length and the average stream duration.
+    """
+    waves = (admission_state["queued"] + 1) / LLM_MAX_CONCURRENT_STREAMS
+    return str(max(1, math.ceil(waves * admission_state["avg_stream_seconds"])))
+
+def reject_request(status_code: int, detail: str, counter: str):
+    increment_counter(f"llm_admission.{counter}")
+    raise HTTPException(status_code=status_code, detail=detail, headers={"Retry-After": get_retry_after()})
+
+def leave_session(session_id: str):
+    admission_sessions[session_id] -= 1
+    if not admission_sessions[session_id]:
+        del admission_sessions[session_id]
+
+async def acquire_stream_slot(session_id: str) -> dict:
+    """
+    Admits a request to open an upstream completion stream, waiting in the queue while all streams are in use.
+    Raises 429 when the session already holds or waits for its share of streams, and 503 when the queue
+    is full or the wait times out, both with a Retry-After header. Returns the slot to release afterwards.
+    """
+    if admission_sessions.get(session_id, 0) >= LLM_MAX_STREAMS_PER_SESSION:
+        reject_request(429, "Too many concurrent requests for this session. Please wait for the current answer.", "rejected_session")
+
+    requested_at = time.perf_counter()
+    if admission_state["active"] < LLM_MAX_CONCURRENT_STREAMS and not admission_waiters:
+        admission_state["active"] += 1
+        admission_sessions[session_id] = admission_sessions.get(session_id, 0) + 1
+    else:
+        if admission_state["queued"] >= LLM_MAX_QUEUED_STREAMS:
+            reject_request(503, "The assistant is busy. Please try again shortly.", "rejected_queue_full")
+        future = asyncio.get_running_loop().create_future()
+        admission_waiters.setdefault(session_id, deque()).append(future)
+        admission_state["queued"] += 1
+        admission_sessions[session_id] = admission_sessions.get(session_id, 0) + 1
+        publish_admission_gauges()
+        try:
+            # A released slot is handed over by resolving the future, so `active` already counts this request.
+            await asyncio.wait_for(future, LLM_QUEUE_TIMEOUT_SECONDS)
+        except (asyncio.TimeoutError, asyncio.CancelledError) as e:
+            leave_session(session_id)
+            if future.done() and not future.cancelled():
+                # The slot was handed over just as the wait ended; pass it on.
+                hand_over_slot()
+            else:
+                waiters = admission_waiters.get(session_id)
+                if waiters is not None and future in waiters:
+                    waiters.remove(future)
+                    if not waiters:
+                        del admission_waiters[session_id]
+                admission_state["queued"] -= 1
+                publish_admission_gauges()
+            if isinstance(e, asyncio.TimeoutError):
+                reject_request(503, "The assistant is busy. Please try again shortly.", "timeouts")
+            raise
+
+    admitted_at = time.perf_counter()
+    record_timing("llm_admission.wait", (admitted_at - requested_at) * 1000)
+    publish_admission_gauges()
+    return {"session_id": session_id, "admitted_at": admitted_at}
+
+def release_stream_slot(slot: dict):
+    """
+    Releases the slot of a finished stream, recording how long the stream held it.
+    Releasing a slot again does nothing, so every path that may end a stream can release it.
+    """
+    if slot.get("released"):
+        return
+    slot["released"] = True
+    elapsed = time.perf_counter() - slot["admitted_at"]
+    record_timing("llm_admission.stream", elapsed * 1000)
+    admission_state["avg_stream_seconds"] = 0.9 * admission_state["avg_stream_seconds"] + 0.1 * elapsed
+    leave_session(slot["session_id"])
+    hand_over_slot()
+
+def hand_over_slot():
+    """
+    Passes a freed slot to the next waiting request, taking sessions in turn, or frees it when nobody waits.
+    """
+    while admission_waiters:
+        session_id, waiters = next(iter(admission_waiters.items()))
+        future = waiters.popleft()
+        if waiters:
+            admission_waiters.move_to_end(session_id)
+        else:
+            del admission_waiters[session_id]
+        # Timed out waiters remove themselves, unless their future was already cancelled here.
+        if future.cancelled():
+            continue
+        admission_state["queued"] -= 1
+        future.set_result(None)
+        break
+    else:
+        admission_state["active"] -= 1
+    publish_admission_gauges()
+
+async def stream_with_slot(stream, slot: dict):
+    """
+    Yields the chunks of a sync or async stream, releasing its slot once the stream ends or the client disconnects
+    while it is read. Use stream_response_with_slot, which also covers streams that are never read.
+    """
+    try:
+        if hasattr(stream, "__aiter__"):
+            async for chunk in stream:
+                yield chunk
+        else:
+            async for chunk in iterate_in_threadpool(stream):
+                yield chunk
+    finally:
+        release_stream_slot(slot)
+
+async def release_slot_task(slot: dict):
+    release_stream_slot(slot)
+
+def stream_response_with_slot(stream, slot: dict, media_type: str = "text/plain") -> StreamingResponse:
+    """
+    Returns a StreamingResponse of `stream` that releases its slot whichever way the response ends:
+    when the stream finishes or is closed, in a background task after the response (which also runs
+    when the body was never iterated), and, should the response never be sent, once it is garbage collected.
+    """
+    response = StreamingResponse(
+        stream_with_slot(stream, slot), media_type=media_type, background=BackgroundTask(release_slot_task, slot)
+    )
+    loop = asyncio.get_running_loop()
+    # The finalizer may run on any thread, so the release is scheduled on the event loop.
+    finalizer = weakref.finalize(response, loop.call_soon_threadsafe, release_stream_slot, slot)
+    finalizer.atexit = False
+    return response
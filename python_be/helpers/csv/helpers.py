@@ -1,32 +1,211 @@
 import os
 import json
+import shutil
+import hashlib
 import re
 import pandas as pd
-import openai
 import faiss
 from schemas.variables import *
 import numpy as np
 import matplotlib.pyplot as plt
 from typing import Optional, Dict
 import chardet
+import pyarrow as pa
+import pyarrow.compute as pc
+import pyarrow.parquet as pq
 from stores.chart_store import chart_data_store
+from stores.dataset_store import dataset_store, dataset_store_lock
+from stores.profile_store import profile_store
+from helpers.uploads.helpers import get_recorded_hash
+from helpers.embeddings.helpers import embed_texts
+from helpers.metrics.helpers import increment_counter
 
 # Set display options to show all columns
 pd.set_option('display.max_columns', None)
 pd.set_option('display.width', 1000)  # Adjust width if needed
 
-def get_csv_path() -> str:
+def get_dataset_id(csv_path: str) -> str:
     """
-    Returns the path to a CSV file found in the /datasets folder.
-    If multiple CSV files are found, returns the first one.
-    Raises FileNotFoundError if no CSV file is found.
+    Returns the dataset ID of a CSV file, which is its file name without the .csv extension.
     """
-    dataset_dir = "datasets"
-    for file in os.listdir(dataset_dir):
-        if file.endswith(".csv"):
-            return os.path.join(dataset_dir, file)
+    return os.path.splitext(os.path.basename(csv_path))[0]
+
+def list_dataset_ids() -> list:
+    """
+    Returns the IDs of all CSV datasets in the /datasets folder.
+    """
+    if not os.path.exists(CSV_DIRECTORY):
+        return []
+    return sorted(get_dataset_id(f) for f in os.listdir(CSV_DIRECTORY) if f.endswith(".csv"))
+
+def get_csv_path(dataset_id: Optional[str] = None) -> str:
+    """
+    Returns the path to the CSV file of the given dataset in the /datasets folder.
+    If no dataset is given, returns the first CSV file found.
+    Raises FileNotFoundError if no matching CSV file is found.
+    """
+    if dataset_id is not None:
+        csv_path = os.path.join(CSV_DIRECTORY, os.path.basename(dataset_id) + ".csv")
+        if not os.path.exists(csv_path):
+            raise FileNotFoundError(f"No CSV file found for dataset '{dataset_id}'")
+        return csv_path
+
+    for dataset_id in list_dataset_ids():
+        return os.path.join(CSV_DIRECTORY, dataset_id + ".csv")
     raise FileNotFoundError("No CSV file found in the datasets directory")
 
+def get_dataset_index_dir(dataset_id: str) -> str:
+    """
+    Returns the directory holding the FAISS index, text records, profile and centroid of a dataset.
+    """
+    return os.path.join(CSV_INDEX_DIRECTORY, os.path.basename(dataset_id))
+
+def get_index_path(dataset_id: str) -> str:
+    return os.path.join(get_dataset_index_dir(dataset_id), INDEX_FILE)
+
+def get_text_records_path(dataset_id: str) -> str:
+    return os.path.join(get_dataset_index_dir(dataset_id), TEXT_RECORDS_FILE)
+
+def get_profile_path(dataset_id: str) -> str:
+    return os.path.join(get_dataset_index_dir(dataset_id), PROFILE_FILE)
+
+def get_centroid_path(dataset_id: str) -> str:
+    return os.path.join(get_dataset_index_dir(dataset_id), CENTROID_FILE)
+
+def is_dataset_indexed(dataset_id: str) -> bool:
+    """
+    Returns True if the FAISS index and text records of a dataset exist.
+    """
+    return os.path.exists(get_index_path(dataset_id)) and os.path.exists(get_text_records_path(dataset_id))
+
+def get_row_hashes_path(dataset_id: str) -> str:
+    return os.path.join(get_dataset_index_dir(dataset_id), ROW_HASHES_FILE)
+
+def get_row_positions_path(dataset_id: str) -> str:
+    return os.path.join(get_dataset_index_dir(dataset_id), ROW_POSITIONS_FILE)
+
+def get_manifest_path(dataset_id: str) -> str:
+    return os.path.join(get_dataset_index_dir(dataset_id), INDEX_MANIFEST_FILE)
+
+def get_vectors_path(dataset_id: str) -> str:
+    return os.path.join(get_dataset_index_dir(dataset_id), VECTORS_FILE)
+
+def get_compression_report_path(dataset_id: str) -> str:
+    return os.path.join(get_dataset_index_dir(dataset_id), COMPRESSION_REPORT_FILE)
+
+def get_checkpoint_dir(dataset_id: str) -> str:
+    return os.path.join(get_dataset_index_dir(dataset_id), EMBEDDING_CHECKPOINT_DIRECTORY)
+
+def load_embedding_checkpoint(dataset_id: str) -> Dict:
+    """
+    Loads the embeddings checkpointed by an unfinished ingestion of a dataset, keyed by row text hash.
+    The embeddings stay memory-mapped, only the hashes are read. Without a checkpoint an empty one is
+    returned. Load it once per ingestion: "num_parts" is advanced as new parts are written.
+    """
+    checkpoint_dir = get_checkpoint_dir(dataset_id)
+    parts = []
+    if os.path.isdir(checkpoint_dir):
+        parts = sorted(f[:-len("_hashes.npy")] for f in os.listdir(checkpoint_dir) if f.endswith("_hashes.npy"))
+    if not parts:
+        return {
+            "positions": pd.Series(np.empty(0, dtype=np.int64), index=np.empty(0, dtype=np.uint64)),
+            "offsets": np.zeros(1, dtype=np.int64),
+            "embeddings": [],
+            "num_parts": 0,
+        }
+
+    hashes = [np.load(os.path.join(checkpoint_dir, f"{part}_hashes.npy")) for part in parts]
+    embeddings = [np.load(os.path.join(checkpoint_dir, f"{part}_embeddings.npy"), mmap_mode="r") for part in parts]
+    # The offsets of the parts are taken before their hashes are concatenated.
+    offsets = np.cumsum([0] + [len(h) for h in hashes])
+    hashes = np.concatenate(hashes)
+    print(f"🔹 Resuming from checkpoint with {len(hashes)} embedded rows.", flush=True)
+    positions = pd.Series(np.arange(len(hashes)), index=hashes)
+    return {
+        "positions": positions[~positions.index.duplicated()],
+        "offsets": offsets,
+        "embeddings": embeddings,
+        "num_parts": len(parts),
+    }
+
+def get_checkpointed_embeddings(checkpoint: Optional[Dict], row_hashes: np.ndarray) -> list:
+    """
+    Returns the checkpointed embedding of every row hash, or None for rows that were not embedded yet.
+    """
+    if checkpoint is None:
+        return [None] * len(row_hashes)
+    positions = checkpoint["positions"].reindex(row_hashes).fillna(-1).to_numpy(dtype=np.int64)
+    result = []
+    for position in positions:
+        if position < 0:
+            result.append(None)
+            continue
+        part = int(np.searchsorted(checkpoint["offsets"], position, side="right")) - 1
+        result.append(np.asarray(checkpoint["embeddings"][part][position - checkpoint["offsets"][part]]).tolist())
+    return result
+
+def save_embedding_checkpoint(dataset_id: str, part: int, row_hashes: list, embeddings: list):
+    """
+    Writes a part of the embedding checkpoint of a dataset. The embeddings are written first, so a
+    part whose hashes file exists is always complete.
+    """
+    checkpoint_dir = get_checkpoint_dir(dataset_id)
+    os.makedirs(checkpoint_dir, exist_ok=True)
+    prefix = os.path.join(checkpoint_dir, f"part_{part:06d}")
+    np.save(prefix + "_embeddings.npy", np.array(embeddings, dtype='float32'))
+    # np.save appends .npy to names without it, so the temporary file keeps the extension.
+    np.save(prefix + "_hashes.tmp.npy", np.array(row_hashes, dtype=np.uint64))
+    os.replace(prefix + "_hashes.tmp.npy", prefix + "_hashes.npy")
+
+def clear_embedding_checkpoint(dataset_id: str):
+    checkpoint_dir = get_checkpoint_dir(dataset_id)
+    if os.path.isdir(checkpoint_dir):
+        shutil.rmtree(checkpoint_dir)
+
+def get_file_hash(file_path: str) -> str:
+    """Generate a SHA-256 hash of a file's content, reusing the hash recorded at upload time."""
+    recorded_hash = get_recorded_hash(file_path)
+    if recorded_hash is not None:
+        return recorded_hash
+    hasher = hashlib.sha256()
+    with open(file_path, "rb") as f:
+        while chunk := f.read(1024 * 1024):
+            hasher.update(chunk)
+    return hasher.hexdigest()
+
+def hash_texts(texts: list) -> np.ndarray:
+    """
+    Returns a 64-bit hash per row text. The index stores these per-row hashes so that
+    rows which are already embedded can be recognised when the CSV changes.
+    """
+    return pd.util.hash_array(np.asarray(texts, dtype=object))
+
+def load_index_manifest(dataset_id: str) -> Optional[Dict]:
+    """
+    Returns the manifest (content hash and row count) the dataset's index was built from,
+    or None if the index has no manifest or row hashes.
+    """
+    manifest_path = get_manifest_path(dataset_id)
+    if not (os.path.exists(manifest_path) and os.path.exists(get_row_hashes_path(dataset_id))):
+        return None
+    with open(manifest_path, "r") as f:
+        return json.load(f)
+
+def save_index_manifest(dataset_id: str, content_hash: Optional[str], row_hashes: np.ndarray, row_positions: np.ndarray):
+    """
+    Tags the dataset's index with the CSV content hash and the hashes and CSV row positions
+    of the rows it contains, in index order. A None content hash marks an index that is missing
+    rows of the CSV, so the next run does not skip the file and embeds the missing rows.
+    """
+    np.save(get_row_hashes_path(dataset_id), row_hashes)
+    np.save(get_row_positions_path(dataset_id), row_positions)
+    with open(get_manifest_path(dataset_id), "w") as f:
+        json.dump({
+            "content_hash": content_hash,
+            "num_rows": int(len(row_hashes)),
+            "compression": get_compression_spec(),
+        }, f)
+
 def detect_encoding(file_path, num_bytes=10000):
     """
     Detects the encoding of the file by reading a sample of bytes.
@@ -36,113 +215,396 @@ def detect_encoding(file_path, num_bytes=10000):
     detected = chardet.detect(raw_data)
     return detected.get('encoding', 'utf-8')  # Fallback to UTF-8 if not detected
 
-def chunk_dataframe(df: pd.DataFrame, chunk_size: int = 200, overlap: int = 3) -> list:
+def serialize_rows(df: pd.DataFrame) -> list:
+    """
+    Builds the "column: value" text of every row in a single vectorized pass over the column arrays.
+    Columns are sorted by name so that every row is rendered in a consistent order.
+    """
+    if df.empty:
+        return []
+
+    text = None
+    for column in sorted(df.columns, key=str):
+        part = f"{column}: " + df[column].astype(str)
+        text = part if text is None else text + ", " + part
+    return text.tolist()
+
+def chunk_dataframe(df: pd.DataFrame, chunk_size: int = 200) -> list:
     """
-    Splits a cleaned DataFrame into smaller overlapping JSON chunks.
+    Serializes a cleaned DataFrame into row texts and splits them into batches for embedding.
     
-    Each chunk contains up to `chunk_size` rows, and consecutive chunks overlap by `overlap` rows.
+    Each chunk contains up to `chunk_size` row texts. Embeddings are generated per row,
+    so chunks do not overlap and every row appears exactly once in the index.
     
     Best Practices for Choosing chunk_size:
     - For small datasets (≤ 10K rows): chunk_size = 100 - 500 is usually fine.
     - For medium datasets (10K - 1M rows): chunk_size = 500 - 2000 may improve efficiency.
     - For very large datasets (1M+ rows): chunk_size = 5000+ is better to minimize overhead.
-    
-    The `overlap` value should be less than `chunk_size`.
     """
-    if overlap >= chunk_size:
-        raise ValueError("Overlap must be less than chunk_size.")
-    
-    chunks = []
-    step = chunk_size - overlap  # number of rows to advance for each new chunk
-    for i in range(0, len(df), step):
-        chunk = df.iloc[i:i+chunk_size]
-        chunks.append(chunk.to_json(orient="records"))
-        print(f"Processing chunk {len(chunks)} of approx. {((len(df)-1) // step) + 1}", flush=True)
-    
+    if chunk_size <= 0:
+        raise ValueError("chunk_size must be positive.")
+
+    row_texts = serialize_rows(df)
+    chunks = [row_texts[i:i + chunk_size] for i in range(0, len(row_texts), chunk_size)]
+    print(f"Serialized {len(row_texts)} rows into {len(chunks)} chunks", flush=True)
     return chunks
 
-def create_embeddings_from_chunks(json_chunks: list) -> (list, list): # type: ignore
+def chunk_row_positions(df: pd.DataFrame, chunk_size: int = 200) -> list:
     """
-    Generates embeddings from JSON chunks using OpenAI's embedding model.
-    Also returns a list of text records corresponding to each embedding.
+    Returns the CSV row position of every row of a cleaned DataFrame, chunked like chunk_dataframe.
+    """
+    positions = df.index.to_numpy(dtype=np.int64)
+    return [positions[i:i + chunk_size] for i in range(0, len(positions), chunk_size)]
+
+def create_embeddings_from_chunks(
+    text_chunks: list,
+    position_chunks: Optional[list] = None,
+    dataset_id: Optional[str] = None,
+    checkpoint: Optional[Dict] = None,
+) -> (list, list, np.ndarray, int): # type: ignore
+    """
+    Generates embeddings from chunks of row texts using OpenAI's embedding model.
+    Also returns a list of text records corresponding to each embedding, the CSV row
+    positions of the embedded rows when `position_chunks` (chunked like `text_chunks`) is given,
+    and the number of rows left out because their embeddings failed.
+
+    With a `dataset_id`, new embeddings are checkpointed to disk every EMBEDDING_CHECKPOINT_ROWS rows
+    and rows found in the dataset's checkpoint are not embedded again, so an interrupted ingestion
+    resumes where it stopped. Callers embedding a dataset over several calls pass the `checkpoint`
+    they loaded once with load_embedding_checkpoint; otherwise it is loaded here.
     """
     embeddings_list = []  # To store all generated embeddings
     text_records = []     # To map embeddings back to their text
-    for i, json_data in enumerate(json_chunks):
-        print(f"🔹 Generating embeddings for chunk {i+1} of {len(json_chunks)}", flush=True)
-        # Convert JSON string to a list of dictionaries
-        chunk_data = json.loads(json_data)
-        
-        # Build text input for each record:
-        text_inputs = []
-        for d in chunk_data:
-            # Concatenate all key-value pairs into a single string.
-            # Sorting the items ensures a consistent order.
-            text = ", ".join([f"{k}: {v}" for k, v in sorted(d.items())])
-            text_inputs.append(text)
+    row_positions = []    # To map embeddings back to their CSV rows
+    if dataset_id and checkpoint is None:
+        checkpoint = load_embedding_checkpoint(dataset_id)
+    next_part = checkpoint["num_parts"] if checkpoint else 0
+    pending_hashes, pending_embeddings = [], []
+    dropped_rows = 0
+    for i, text_inputs in enumerate(text_chunks):
+        print(f"🔹 Generating embeddings for chunk {i+1} of {len(text_chunks)}", flush=True)
         
         if not text_inputs:
             print(f"⚠️ Skipping chunk {i+1} - No valid text fields found.")
             continue
 
-        # Generate embeddings for each text input using OpenAI's API
+        # Generate embeddings for the text inputs that are not checkpointed, through the shared scheduler
+        row_hashes = hash_texts(text_inputs)
+        chunk_embeddings = get_checkpointed_embeddings(checkpoint, row_hashes)
+        missing = [j for j, embedding in enumerate(chunk_embeddings) if embedding is None]
         try:
-            chunk_embeddings = [
-                openai.embeddings.create(input=text, model="text-embedding-ada-002").data[0].embedding
-                for text in text_inputs
-            ]
+            if missing:
+                for j, embedding in zip(missing, embed_texts([text_inputs[j] for j in missing])):
+                    chunk_embeddings[j] = embedding
         except Exception as e:
+            # Retries are exhausted; the whole chunk stays out of the index, and the caller marks the index incomplete.
+            dropped_rows += len(text_inputs)
+            increment_counter("embeddings.dropped_texts", len(text_inputs))
             print(f"Error generating embeddings for chunk {i+1}: {e}")
             continue
 
         embeddings_list.extend(chunk_embeddings)
         text_records.extend(text_inputs)
+        if position_chunks is not None:
+            row_positions.append(np.asarray(position_chunks[i], dtype=np.int64))
 
+        if dataset_id and missing:
+            pending_hashes.extend(row_hashes[j] for j in missing)
+            pending_embeddings.extend(chunk_embeddings[j] for j in missing)
+            if len(pending_hashes) >= EMBEDDING_CHECKPOINT_ROWS:
+                save_embedding_checkpoint(dataset_id, next_part, pending_hashes, pending_embeddings)
+                next_part += 1
+                pending_hashes, pending_embeddings = [], []
+
+    if pending_hashes:
+        save_embedding_checkpoint(dataset_id, next_part, pending_hashes, pending_embeddings)
+        next_part += 1
+    if checkpoint:
+        checkpoint["num_parts"] = next_part
     print(f"✅ Successfully generated {len(embeddings_list)} embeddings.", flush=True)
-    return embeddings_list, text_records
+    if dropped_rows:
+        print(f"⚠️ {dropped_rows} rows were left out because their embeddings failed.", flush=True)
+    positions = np.concatenate(row_positions) if row_positions else np.empty(0, dtype=np.int64)
+    return embeddings_list, text_records, positions, dropped_rows
+
+def get_compression_spec() -> Optional[str]:
+    """
+    Returns the FAISS index factory string of the configured CSV_VECTOR_COMPRESSION,
+    e.g. "PCA256,SQ8", or None when vectors are stored uncompressed.
+    """
+    if not CSV_VECTOR_COMPRESSION:
+        return None
+    codecs = {"sq8": "SQ8", "fp16": "SQfp16", "pq": f"PQ{CSV_PQ_SUBQUANTIZERS}"}
+    if CSV_VECTOR_COMPRESSION not in codecs:
+        raise ValueError(f"Unsupported vector compression '{CSV_VECTOR_COMPRESSION}'. Use one of {sorted(codecs)}.")
+    projection = f"PCA{CSV_VECTOR_PCA_DIM}," if CSV_VECTOR_PCA_DIM else ""
+    return projection + codecs[CSV_VECTOR_COMPRESSION]
+
+def is_compressed_index(index) -> bool:
+    return not isinstance(index, faiss.IndexFlat)
+
+def create_faiss_index(training_embeddings: np.ndarray):
+    """
+    Creates an empty FAISS index for embeddings like `training_embeddings`: a flat (L2) index, or the
+    configured compressed index trained on a sample of them. Too few rows to train on fall back to flat.
+    """
+    dim = training_embeddings.shape[1]
+    spec = get_compression_spec()
+    if spec is None or len(training_embeddings) < CSV_COMPRESSION_MIN_ROWS:
+        return faiss.IndexFlatL2(dim)
+
+    index = faiss.index_factory(dim, spec)
+    base_index = get_base_index(index)
+    if isinstance(base_index, faiss.IndexPQ):
+        # Polysemous training only serves polysemous search, which is not used, and dominates the training time.
+        base_index.do_polysemous_training = False
+    if len(training_embeddings) > CSV_COMPRESSION_TRAIN_ROWS:
+        sample = np.random.default_rng(0).choice(len(training_embeddings), CSV_COMPRESSION_TRAIN_ROWS, replace=False)
+        training_embeddings = training_embeddings[np.sort(sample)]
+    index.train(training_embeddings)
+    print(f"✅ Trained {spec} index on {len(training_embeddings)} embeddings.", flush=True)
+    return index
 
 def build_faiss_index(embeddings_list: list):
     """
-    Builds a FAISS flat (L2) index from a list of embeddings.
+    Builds a FAISS index from a list of embeddings: flat (L2), or compressed if CSV_VECTOR_COMPRESSION is set.
     Returns the FAISS index.
     """
     embeddings_np = np.array(embeddings_list).astype('float32')
     if embeddings_np.ndim < 2:
         raise ValueError("No embeddings were generated. Please check your data and text extraction.")
-    
-    dim = embeddings_np.shape[1]
-    index = faiss.IndexFlatL2(dim)
+
+    index = create_faiss_index(embeddings_np)
     index.add(embeddings_np)
     print(f"✅ FAISS index built with {index.ntotal} embeddings.")
     return index
 
-def reset_faiss_index():
+def save_rescore_vectors(dataset_id: str, faiss_index, embeddings_np: np.ndarray, append: bool = False):
     """
-    Deletes the stored FAISS index and text records file, allowing for a fresh start.
+    Stores the full embeddings of a compressed index on disk as float16, in index order, for re-scoring
+    its candidates. Flat indices are exact, so any stale vectors file is removed instead.
     """
-    if os.path.exists(INDEX_FILE):
-        os.remove(INDEX_FILE)
-        print(f"Deleted FAISS index file: {INDEX_FILE}")
-    else:
-        print(f"FAISS index file not found: {INDEX_FILE}")
-    
-    if os.path.exists(TEXT_RECORDS_FILE):
-        os.remove(TEXT_RECORDS_FILE)
-        print(f"Deleted text records file: {TEXT_RECORDS_FILE}")
+    vectors_path = get_vectors_path(dataset_id)
+    if not is_compressed_index(faiss_index):
+        if not append and os.path.exists(vectors_path):
+            os.remove(vectors_path)
+        return
+    with open(vectors_path, "ab" if append else "wb") as f:
+        f.write(embeddings_np.astype(np.float16).tobytes())
+
+def load_rescore_vectors(dataset_id: str, dim: int) -> Optional[np.ndarray]:
+    """
+    Memory-maps the full embeddings of a compressed index, or returns None for flat indices.
+    Only the rows that are re-scored are ever read from disk.
+    """
+    vectors_path = get_vectors_path(dataset_id)
+    if not os.path.exists(vectors_path):
+        return None
+    return np.memmap(vectors_path, dtype=np.float16, mode="r").reshape(-1, dim)
+
+def get_base_index(faiss_index):
+    """Returns the index holding the vectors, unwrapping the PCA projection of compressed indices."""
+    while isinstance(faiss_index, faiss.IndexPreTransform):
+        faiss_index = faiss.downcast_index(faiss_index.index)
+    return faiss_index
+
+def accepts_search_selector(faiss_index) -> bool:
+    """
+    Returns False for indices whose search rejects an id selector (PQ), which are post-filtered instead.
+    """
+    return not isinstance(get_base_index(faiss_index), faiss.IndexPQ)
+
+def search_post_filtered(faiss_index, query_embedding: np.ndarray, k: int, id_mask: np.ndarray):
+    """
+    Searches a single query on an index that rejects id selectors, keeping only the ids where `id_mask` is True.
+    Neighbours are fetched in batches sized by the share of rows the mask keeps, doubled until k of them pass
+    the mask or the whole index was searched. Returns the top k (distances, indices), shaped like faiss search results.
+    """
+    matching = int(id_mask.sum())
+    wanted = min(k, matching)
+    fetch_k = min(faiss_index.ntotal, k * max(1, len(id_mask) // max(1, matching)))
+    while True:
+        distances, indices = faiss_index.search(query_embedding, fetch_k)
+        found = indices[0] >= 0
+        keep = np.zeros(len(found), dtype=bool)
+        keep[found] = id_mask[indices[0][found]]
+        if keep.sum() >= wanted or fetch_k >= faiss_index.ntotal:
+            break
+        fetch_k = min(faiss_index.ntotal, fetch_k * 2)
+    return distances[0][keep][:k].reshape(1, -1), indices[0][keep][:k].reshape(1, -1)
+
+def rescore_candidates(query_embedding: np.ndarray, indices: np.ndarray, vectors: np.ndarray, k: int):
+    """
+    Re-ranks the candidate ids of a compressed search of a single query by their exact L2 distance
+    to the full vectors. Returns the top k (distances, indices), shaped like faiss search results.
+    """
+    candidates = indices[0][indices[0] >= 0]
+    exact = ((vectors[candidates].astype('float32') - query_embedding.reshape(1, -1)) ** 2).sum(axis=1)
+    order = np.argsort(exact, kind="stable")[:k]
+    return exact[order].reshape(1, -1), candidates[order].reshape(1, -1)
+
+def get_index_vectors(faiss_index, ids: np.ndarray, rescore_vectors: Optional[np.ndarray] = None) -> np.ndarray:
+    """
+    Returns the stored vectors of the given ids: the full vectors of a compressed index when available,
+    otherwise reconstructed from the index.
+    """
+    if rescore_vectors is not None:
+        return np.asarray(rescore_vectors[ids], dtype='float32')
+    return np.vstack([faiss_index.reconstruct(int(i)) for i in ids])
+
+def exact_knn(vectors: np.ndarray, queries: np.ndarray, k: int, block_rows: int = 100000) -> np.ndarray:
+    """
+    Brute-force k nearest neighbours of `queries` among `vectors`, scanning the (memory-mapped)
+    vectors in blocks. Returns the neighbour ids.
+    """
+    best_distances = np.full((len(queries), 0), np.inf, dtype='float32')
+    best_ids = np.empty((len(queries), 0), dtype=np.int64)
+    for start in range(0, len(vectors), block_rows):
+        block = np.ascontiguousarray(vectors[start:start + block_rows], dtype='float32')
+        flat = faiss.IndexFlatL2(block.shape[1])
+        flat.add(block)
+        distances, ids = flat.search(queries, min(k, len(block)))
+        best_distances = np.hstack([best_distances, distances])
+        best_ids = np.hstack([best_ids, ids + start])
+        order = np.argsort(best_distances, axis=1, kind="stable")[:, :k]
+        best_distances = np.take_along_axis(best_distances, order, axis=1)
+        best_ids = np.take_along_axis(best_ids, order, axis=1)
+    return best_ids
+
+def write_compression_report(dataset_id: str, faiss_index, k: int = COMPRESSION_REPORT_K) -> Optional[Dict]:
+    """
+    Measures what the compressed index of a dataset saves and costs, and saves the report next to it:
+      - memory: size of the index file versus the same vectors in a flat float32 index.
+      - recall@k: overlap with the exact neighbours of COMPRESSION_REPORT_QUERIES stored vectors,
+        for the compressed search alone and after re-scoring.
+    Returns None (and removes any old report) for flat indices.
+    """
+    report_path = get_compression_report_path(dataset_id)
+    vectors = load_rescore_vectors(dataset_id, faiss_index.d)
+    if vectors is None:
+        if os.path.exists(report_path):
+            os.remove(report_path)
+        return None
+
+    num_vectors = len(vectors)
+    sample = np.random.default_rng(0).choice(num_vectors, min(COMPRESSION_REPORT_QUERIES, num_vectors), replace=False)
+    query_ids = np.sort(sample)
+    queries = np.ascontiguousarray(vectors[query_ids], dtype='float32')
+
+    # Each query is a stored vector, so one extra neighbour is fetched and the query itself dropped.
+    exact_ids = exact_knn(vectors, queries, k + 1)
+    _, candidate_ids = faiss_index.search(queries, (k + 1) * CSV_RESCORE_FACTOR)
+
+    def neighbours(ids, query_id):
+        return [i for i in ids if i != query_id and i >= 0][:k]
+
+    recall, recall_rescored = [], []
+    for row, query_id in enumerate(query_ids):
+        truth = set(neighbours(exact_ids[row], query_id))
+        compressed = neighbours(candidate_ids[row], query_id)
+        _, rescored = rescore_candidates(queries[row], candidate_ids[row:row + 1], vectors, k + 1)
+        recall.append(len(truth.intersection(compressed)) / k)
+        recall_rescored.append(len(truth.intersection(neighbours(rescored[0], query_id))) / k)
+
+    flat_bytes = num_vectors * faiss_index.d * 4
+    index_bytes = os.path.getsize(get_index_path(dataset_id))
+    report = {
+        "compression": get_compression_spec(),
+        "num_vectors": int(num_vectors),
+        "dimension": int(faiss_index.d),
+        "flat_bytes": int(flat_bytes),
+        "index_bytes": int(index_bytes),
+        "memory_saved": round(1 - index_bytes / flat_bytes, 4),
+        "k": k,
+        "queries": int(len(query_ids)),
+        "recall": round(float(np.mean(recall)), 4),
+        "recall_rescored": round(float(np.mean(recall_rescored)), 4),
+    }
+    with open(report_path, "w") as f:
+        json.dump(report, f)
+    print(
+        f"✅ Compression report: {report['memory_saved']:.1%} memory saved, recall@{k} "
+        f"{report['recall']:.3f} ({report['recall_rescored']:.3f} re-scored)", flush=True
+    )
+    return report
+
+def load_compression_report(dataset_id: str) -> Optional[Dict]:
+    report_path = get_compression_report_path(dataset_id)
+    if not os.path.exists(report_path):
+        return None
+    with open(report_path, "r") as f:
+        return json.load(f)
+
+def reset_faiss_index(dataset_id: str):
+    """
+    Deletes the stored FAISS index, text records, profile and centroid of a dataset, allowing for a fresh start.
+    """
+    index_dir = get_dataset_index_dir(dataset_id)
+    if os.path.exists(index_dir):
+        shutil.rmtree(index_dir)
+        print(f"Deleted FAISS index directory: {index_dir}")
     else:
-        print(f"Text records file not found: {TEXT_RECORDS_FILE}")
-        
+        print(f"FAISS index directory not found: {index_dir}")
+
 def prepare_clean_data(csv_path: str, encoding: str = "utf-8") -> pd.DataFrame:
     """
     Reads a CSV file, cleans the data by removing duplicates and missing values,
-    and returns a cleaned DataFrame.
+    and returns a cleaned DataFrame. The index keeps each row's position in the CSV file.
     """
     df = pd.read_csv(csv_path, encoding=encoding)
     df.drop_duplicates(inplace=True)
     df.dropna(inplace=True)
-    df.reset_index(drop=True, inplace=True)
     return df
 
+def iter_clean_data(csv_path: str, encoding: str = "utf-8", batch_rows: int = CSV_STREAMING_BATCH_ROWS):
+    """
+    Streaming counterpart of prepare_clean_data for CSV files larger than memory.
+    Reads the CSV in batches of `batch_rows` rows and yields cleaned DataFrames whose
+    index keeps each row's position in the CSV file.
+
+    Column types are fixed for the whole file up front (see infer_csv_dtypes), so a row is read, hashed
+    and serialized the same way in every batch (e.g. never 1 in one batch and 1.0 in another).
+    Duplicates are dropped across the whole file by keeping the 64-bit hashes of the rows seen so far,
+    the only state carried between batches: 8 bytes per unique row, held in a few sorted NumPy arrays
+    that are merged as they grow, so each lookup is a binary search.
+    """
+    seen_runs = []  # sorted hash arrays, each at most half the size of the one before
+    dtypes = infer_csv_dtypes(csv_path, encoding, batch_rows)
+    for batch in pd.read_csv(csv_path, encoding=encoding, chunksize=batch_rows, dtype=dtypes):
+        batch = batch.dropna()
+        if batch.empty:
+            continue
+
+        row_hashes = pd.util.hash_pandas_object(batch, index=False).to_numpy()
+        keep = np.ones(len(row_hashes), dtype=bool)
+        for run in seen_runs:
+            found = np.searchsorted(run, row_hashes)
+            keep &= run[np.minimum(found, len(run) - 1)] != row_hashes
+        # Duplicates inside the same batch are not in the seen hashes yet.
+        keep &= ~pd.Series(row_hashes).duplicated().to_numpy()
+
+        if keep.any():
+            seen_runs.append(np.sort(row_hashes[keep]))
+        while len(seen_runs) > 1 and len(seen_runs[-1]) * 2 > len(seen_runs[-2]):
+            merged = np.concatenate([seen_runs.pop(), seen_runs.pop()])
+            seen_runs.append(np.sort(merged, kind="stable"))
+
+        batch = batch[keep]
+        if not batch.empty:
+            yield batch
+
+def iter_row_texts(csv_path: str, encoding: str = "utf-8"):
+    """
+    Yields (row texts, CSV row positions) of the clean rows of a CSV file in batches. Files above
+    CSV_STREAMING_THRESHOLD_BYTES are read in streaming mode, smaller files in one batch.
+    """
+    if os.path.getsize(csv_path) > CSV_STREAMING_THRESHOLD_BYTES:
+        batches = iter_clean_data(csv_path, encoding=encoding)
+    else:
+        batches = [prepare_clean_data(csv_path, encoding=encoding)]
+    for batch in batches:
+        yield serialize_rows(batch), batch.index.to_numpy(dtype=np.int64)
+
 def clean_df_text(df):
      # Convert column labels to strings before cleaning
      df.columns = df.columns.astype(str).str.lower()
@@ -156,11 +618,368 @@ def clean_df_text(df):
 
      return df
 
+def get_file_identity(csv_path: str) -> tuple:
+    """
+    Returns a key that changes whenever the file at `csv_path` is replaced or modified.
+    """
+    stat = os.stat(csv_path)
+    return (os.path.abspath(csv_path), stat.st_size, stat.st_mtime_ns)
+
+def get_snapshot_path(csv_path: str) -> str:
+    """
+    Returns the path of the columnar (Parquet) snapshot written for a CSV file.
+    """
+    return os.path.join(CSV_SNAPSHOT_DIRECTORY, os.path.basename(csv_path) + ".parquet")
+
+def read_snapshot_metadata(csv_path: str) -> Optional[Dict]:
+    """
+    Returns the metadata stored in the snapshot of a CSV file, or None if there is no
+    snapshot or it was written for a different version of the file.
+    """
+    snapshot_path = get_snapshot_path(csv_path)
+    if not os.path.exists(snapshot_path):
+        return None
+
+    try:
+        schema_metadata = pq.read_schema(snapshot_path).metadata or {}
+        metadata = json.loads(schema_metadata[SNAPSHOT_METADATA_KEY.encode()])
+    except Exception as e:
+        print(f"Error reading snapshot metadata for {csv_path}: {e}")
+        return None
+
+    _, size, mtime_ns = get_file_identity(csv_path)
+    if metadata.get("size") != size or metadata.get("mtime_ns") != mtime_ns:
+        return None
+    return metadata
+
+def infer_csv_dtypes(csv_path: str, encoding: str, batch_rows: int = CSV_STREAMING_BATCH_ROWS) -> dict:
+    """
+    Returns read_csv dtypes that fit every batch of a CSV file, so that batches read separately get the
+    same column types: integer columns that gain missing values in a later batch are read as float, and
+    columns whose type differs between batches (e.g. numbers and text) are read as strings.
+    """
+    kinds = {}
+    for batch in pd.read_csv(csv_path, encoding=encoding, chunksize=batch_rows):
+        for column, dtype in batch.dtypes.items():
+            kinds.setdefault(column, set()).add(dtype.kind)
+
+    dtypes = {}
+    for column, seen in kinds.items():
+        if seen <= {"i"}:
+            dtypes[column] = "int64"
+        elif seen <= {"i", "f"}:
+            dtypes[column] = "float64"
+        elif seen == {"b"}:
+            dtypes[column] = "bool"
+        else:
+            dtypes[column] = str
+    return dtypes
+
+def get_arrow_type(dtype) -> pa.DataType:
+    return {"int64": pa.int64(), "float64": pa.float64(), "bool": pa.bool_()}.get(dtype, pa.string())
+
+def dictionary_encode_strings(table: pa.Table) -> pa.Table:
+    """
+    Dictionary-encodes every string column of an Arrow table, so category columns are stored
+    once per distinct value and load back as pandas categoricals.
+    """
+    for i, field in enumerate(table.schema):
+        if pa.types.is_string(field.type) or pa.types.is_large_string(field.type):
+            table = table.set_column(i, field.name, pc.dictionary_encode(table.column(i)))
+    return table
+
+def write_dataset_snapshot(csv_path: str, encoding: Optional[str] = None, batch_rows: int = CSV_STREAMING_BATCH_ROWS) -> bool:
+    """
+    Writes a Parquet snapshot of the CSV file after applying clean_df_text, reading the CSV in
+    batches of `batch_rows` rows so that memory stays bounded for large files.
+    Column types are fixed for the whole file up front (see infer_csv_dtypes), so every batch
+    matches the snapshot schema.
+    The snapshot records the source file's size, mtime and encoding, and is only used
+    while those still match. Returns True if the snapshot was written.
+    """
+    encoding = encoding or detect_encoding(csv_path)
+    _, size, mtime_ns = get_file_identity(csv_path)
+    snapshot_path = get_snapshot_path(csv_path)
+    tmp_path = snapshot_path + ".tmp"
+    os.makedirs(CSV_SNAPSHOT_DIRECTORY, exist_ok=True)
+
+    writer = None
+    try:
+        dtypes = infer_csv_dtypes(csv_path, encoding, batch_rows)
+        for batch in pd.read_csv(csv_path, encoding=encoding, chunksize=batch_rows, dtype=dtypes):
+            batch = clean_df_text(batch)
+            # An explicit schema keeps columns that are empty in a batch from being inferred as nulls.
+            schema = pa.schema([
+                (column, get_arrow_type(dtype)) for column, dtype in zip(batch.columns, dtypes.values())
+            ])
+            table = dictionary_encode_strings(pa.Table.from_pandas(batch, schema=schema, preserve_index=False))
+            if writer is None:
+                metadata = {"size": size, "mtime_ns": mtime_ns, "encoding": encoding}
+                writer = pq.ParquetWriter(tmp_path, table.schema.with_metadata({SNAPSHOT_METADATA_KEY: json.dumps(metadata)}))
+            writer.write_table(table.replace_schema_metadata(writer.schema.metadata))
+        if writer is None:
+            print(f"⚠️ Skipping snapshot for {csv_path}: no rows found.")
+            return False
+        writer.close()
+        os.replace(tmp_path, snapshot_path)
+    except Exception as e:
+        if writer is not None:
+            writer.close()
+        if os.path.exists(tmp_path):
+            os.remove(tmp_path)
+        print(f"⚠️ Snapshot for {csv_path} dropped, tools will parse the CSV instead: {e}", flush=True)
+        return False
+
+    print(f"✅ Snapshot saved to {snapshot_path}", flush=True)
+    return True
+
+def remove_dataset_snapshot(csv_path: str):
+    """
+    Deletes the snapshot of a CSV file if one exists.
+    """
+    snapshot_path = get_snapshot_path(csv_path)
+    if os.path.exists(snapshot_path):
+        os.remove(snapshot_path)
+        print(f"Deleted snapshot file: {snapshot_path}")
+
+def load_clean_dataset(csv_path: str, encoding: Optional[str] = None, columns: Optional[list] = None) -> (pd.DataFrame, str): # type: ignore
+    """
+    Returns the cleaned DataFrame and the encoding of a CSV file, parsing it only on a cache miss.
+
+    On a miss the data is read from the file's columnar snapshot when one is current, loading
+    only `columns` if given. Without a snapshot the whole CSV is parsed and cleaned, and the
+    encoding is detected unless provided.
+
+    Entries are keyed by path, size, mtime and column projection, so a modified file is never
+    served stale. The cache is evicted least recently used first once the cached DataFrames
+    exceed DATASET_CACHE_MAX_BYTES.
+    The returned DataFrame is shared between callers and must not be modified in place.
+    """
+    identity = get_file_identity(csv_path)
+    projection = tuple(columns) if columns is not None else None
+    with dataset_store_lock:
+        # A cached full DataFrame can serve any projection.
+        for key in (identity + (None,), identity + (projection,)):
+            entry = dataset_store.get(key)
+            if entry is not None:
+                dataset_store.move_to_end(key)
+                df = entry["df"]
+                if projection is not None and key[-1] is None:
+                    df = df[list(projection)]
+                return df, entry["encoding"]
+
+    metadata = read_snapshot_metadata(csv_path)
+    if metadata is not None:
+        encoding = metadata["encoding"]
+        df = pq.read_table(get_snapshot_path(csv_path), columns=columns).to_pandas()
+    else:
+        projection = None
+        encoding = encoding or detect_encoding(csv_path)
+        df = clean_df_text(pd.read_csv(csv_path, encoding=encoding))
+    size = int(df.memory_usage(deep=True).sum())
+
+    with dataset_store_lock:
+        # Drop entries for older versions of the same file.
+        for stale_key in [k for k in dataset_store if k[0] == identity[0] and k[:3] != identity]:
+            dataset_store.pop(stale_key)
+
+        if size <= DATASET_CACHE_MAX_BYTES:
+            dataset_store[identity + (projection,)] = {"df": df, "encoding": encoding, "size": size}
+            total = sum(entry["size"] for entry in dataset_store.values())
+            while total > DATASET_CACHE_MAX_BYTES:
+                _, evicted = dataset_store.popitem(last=False)
+                total -= evicted["size"]
+
+    if columns is not None and projection is None:
+        df = df[list(columns)]
+    return df, encoding
+
+def get_dataset_columns(csv_path: str, numeric_only: bool = False) -> list:
+    """
+    Returns the cleaned column names of a CSV file, read from the snapshot schema when possible
+    so that no data has to be loaded.
+    """
+    if read_snapshot_metadata(csv_path) is not None:
+        schema = pq.read_schema(get_snapshot_path(csv_path))
+        return [
+            field.name for field in schema
+            if not numeric_only or pa.types.is_integer(field.type) or pa.types.is_floating(field.type)
+        ]
+
+    df, _ = load_clean_dataset(csv_path)
+    columns = df.select_dtypes(include=['number']).columns if numeric_only else df.columns
+    return list(columns)
+
+def get_dataset_encoding(csv_path: str) -> str:
+    """
+    Returns the encoding of a CSV file, taken from its snapshot or the dataset cache when possible.
+    """
+    metadata = read_snapshot_metadata(csv_path)
+    if metadata is not None:
+        return metadata["encoding"]
+    _, encoding = load_clean_dataset(csv_path)
+    return encoding
+
+def invalidate_dataset_cache():
+    """
+    Drops all cached DataFrames. Called whenever a CSV is uploaded or deleted.
+    """
+    with dataset_store_lock:
+        dataset_store.clear()
+    profile_store.clear()
+
+def to_json_value(value):
+    """
+    Converts pandas/numpy scalars to plain Python values that can be stored as JSON.
+    """
+    if value is None or (not isinstance(value, str) and pd.isna(value)):
+        return None
+    if hasattr(value, "item"):
+        return value.item()
+    if isinstance(value, pd.Timestamp):
+        return value.isoformat()
+    return value
+
+def iter_dataset_columns(csv_path: str, columns: list):
+    """
+    Yields (column name, Series) pairs of the cleaned dataset. When a snapshot is current the
+    columns are read from it one at a time, so only a single column is in memory at once.
+    """
+    if read_snapshot_metadata(csv_path) is not None:
+        snapshot_path = get_snapshot_path(csv_path)
+        for column in columns:
+            yield column, pq.read_table(snapshot_path, columns=[column]).to_pandas()[column]
+    else:
+        df, _ = load_clean_dataset(csv_path)
+        for column in columns:
+            yield column, df[column]
+
+def profile_numeric_columns(numeric: pd.DataFrame) -> Dict:
+    """
+    Computes the numeric profile of every column of `numeric` with whole-block reductions:
+    one describe pass provides mean, std, min, quantiles and max for all columns at once.
+    """
+    if numeric.shape[1] == 0:
+        return {}
+
+    stats = numeric.describe().T
+    table = pd.DataFrame({
+        'Count': numeric.count(),
+        'Missing': numeric.isna().sum(),
+        'Sum': numeric.sum(),
+        'Mean': stats['mean'],
+        'Median': stats['50%'],
+        'Std': stats['std'],
+        'Variance': stats['std'] ** 2,
+        'Min': stats['min'],
+        '25%': stats['25%'],
+        '50%': stats['50%'],
+        '75%': stats['75%'],
+        'Max': stats['max'],
+        'Range': stats['max'] - stats['min'],
+    }, index=numeric.columns)
+
+    return {
+        col: {metric: to_json_value(value) for metric, value in metrics.items()}
+        for col, metrics in table.to_dict(orient="index").items()
+    }
+
+def profile_categorical_column(s: pd.Series, top_k: int = PROFILE_TOP_K) -> Dict:
+    """
+    Computes the categorical profile of a column from a single value_counts pass:
+    count, missing, cardinality and mode are all derived from the frequency table.
+    """
+    counts = s.value_counts()
+    count = int(counts.sum())
+
+    mode = None
+    if not counts.empty:
+        # Series.mode over just the tied most frequent values (one each) orders them exactly like s.mode(),
+        # without another pass over the column.
+        modes = counts.index[counts.to_numpy() == counts.iloc[0]]
+        mode = pd.Series(modes, dtype=s.dtype).mode().iloc[0]
+
+    return {
+        'Count': count,
+        'Missing': len(s) - count,
+        'Unique': len(counts),
+        'Mode': to_json_value(mode),
+        'Top': [[to_json_value(v), to_json_value(f)] for v, f in counts.head(top_k).items()],
+        'Low': [[to_json_value(v), to_json_value(f)] for v, f in counts.sort_values(ascending=True).head(top_k).items()],
+        # Full vocabulary of low-cardinality columns, used to recognise filter values in queries.
+        'Values': [to_json_value(v) for v in counts.index] if len(counts) <= FILTER_MAX_CATEGORIES else [],
+    }
+
+def build_dataset_profile(csv_path: str, top_k: int = PROFILE_TOP_K) -> Dict:
+    """
+    Computes the dataset profile served by the aggregate tools:
+      - per numeric column: Count, Missing, Sum, Mean, Median, Std, Variance, Min,
+        25%, 50%, 75% quantiles, Max and Range.
+      - per categorical column: Count, Missing, Unique (cardinality), Mode, the
+        `top_k` most and least frequent values with their frequencies and, for columns
+        with at most FILTER_MAX_CATEGORIES distinct values, all values.
+    """
+    _, size, mtime_ns = get_file_identity(csv_path)
+    numeric_columns = get_dataset_columns(csv_path, numeric_only=True)
+    numeric_set = set(numeric_columns)
+    categorical_columns = [col for col in get_dataset_columns(csv_path) if col not in numeric_set]
+
+    numeric, _ = load_clean_dataset(csv_path, columns=numeric_columns)
+    return {
+        "source": {"file": os.path.abspath(csv_path), "size": size, "mtime_ns": mtime_ns},
+        "numeric": profile_numeric_columns(numeric),
+        "categorical": {
+            col: profile_categorical_column(s, top_k)
+            for col, s in iter_dataset_columns(csv_path, categorical_columns)
+        },
+    }
+
+def write_dataset_profile(csv_path: str) -> Dict:
+    """
+    Builds the dataset profile of a CSV file and saves it next to the dataset's FAISS index.
+    """
+    profile = build_dataset_profile(csv_path)
+    profile_path = get_profile_path(get_dataset_id(csv_path))
+    os.makedirs(os.path.dirname(profile_path), exist_ok=True)
+    tmp_path = profile_path + ".tmp"
+    with open(tmp_path, "w") as f:
+        json.dump(profile, f)
+    os.replace(tmp_path, profile_path)
+    profile_store[get_file_identity(csv_path)] = profile
+    print(f"✅ Dataset profile saved to {profile_path}", flush=True)
+    return profile
+
+def get_dataset_profile(csv_path: str) -> Dict:
+    """
+    Returns the dataset profile of a CSV file from memory or its profile file,
+    building it only if no profile exists for the current version of the file.
+    """
+    identity = get_file_identity(csv_path)
+    profile = profile_store.get(identity)
+    if profile is not None:
+        return profile
+
+    profile_path = get_profile_path(get_dataset_id(csv_path))
+    if os.path.exists(profile_path):
+        try:
+            with open(profile_path, "r") as f:
+                profile = json.load(f)
+            source = profile.get("source", {})
+            if (source.get("file"), source.get("size"), source.get("mtime_ns")) == identity:
+                profile_store[identity] = profile
+                return profile
+        except Exception as e:
+            print(f"Error loading dataset profile: {e}")
+
+    return write_dataset_profile(csv_path)
+
 
 def get_min_max_mean(csv_path, encoding: str = "utf-8"):
-     df = pd.read_csv(csv_path, encoding=encoding)
-     results = clean_df_text(df)
-     numeric_summary = results.describe().loc[['min', 'max', 'mean']]
+     numeric_profile = get_dataset_profile(csv_path)["numeric"]
+     numeric_summary = pd.DataFrame(
+         {col: {'min': m['Min'], 'max': m['Max'], 'mean': m['Mean']} for col, m in numeric_profile.items()},
+         index=['min', 'max', 'mean']
+     )
 
      return numeric_summary
 
@@ -173,9 +992,7 @@ def get_min_max_mean(csv_path, encoding: str = "utf-8"):
 # print(summary_stats)
 
 def get_totals(csv_path, encoding: str = "utf-8"):
-     df = pd.read_csv(csv_path, encoding=encoding)
-     # Clean the DataFrame first
-     df = clean_df_text(df)
+     df, _ = load_clean_dataset(csv_path, encoding, columns=get_dataset_columns(csv_path, numeric_only=True))
 
      # Calculate totals for each numeric column
      totals = df.select_dtypes(include=['number']).sum()
@@ -200,63 +1017,31 @@ def create_category_aggregates(csv_path: str, encoding: str = "utf-8",  column_o
        - Count, Missing Count, Unique Count, Mode,
          Top 3 most frequent values and their frequencies,
          Lowest 3 least frequent values and their frequencies.
+
+     Aggregates are served from the dataset profile computed at training time.
      """
-     df = pd.read_csv(csv_path, encoding=encoding)
-     df = clean_df_text(df)
-
-     numeric_cols = df.select_dtypes(include=['number']).columns
-     categorical_cols = df.select_dtypes(exclude=['number']).columns
-
-     numeric_metrics = {}
-     for col in numeric_cols:
-         s = df[col]
-         numeric_metrics[col] = {
-             'Count': s.count(),
-             'Missing': s.isna().sum(),
-             'Sum': s.sum(),
-             'Mean': s.mean(),
-             'Median': s.median(),
-             'Std': s.std(),
-             'Variance': s.var(),
-             'Min': s.min(),
-             '25%': s.quantile(0.25),
-             '50%': s.quantile(0.50),
-             '75%': s.quantile(0.75),
-             'Max': s.max(),
-             'Range': s.max() - s.min() if s.count() > 0 else None
-         }
+     profile = get_dataset_profile(csv_path)
 
-     categorical_metrics = {}
-     for col in categorical_cols:
-         s = df[col]
-         counts = s.value_counts()
-         top_counts = counts.head(3)
-         low_counts = counts.sort_values(ascending=True).head(3)
+     numeric_metrics = profile["numeric"]
 
+     categorical_metrics = {}
+     for col, metrics in profile["categorical"].items():
+         count = metrics['Count']
          cat_data = {
-             'Count': s.count(),
-             'Missing': s.isna().sum(),
-             'Unique': s.nunique(),
-             'Mode': s.mode().iloc[0] if not s.mode().empty else None,
+             'Count': count,
+             'Missing': metrics['Missing'],
+             'Unique': metrics['Unique'],
+             'Mode': metrics['Mode'],
          }
 
-         # Top 3 values: frequencies and relative percentages.
-         for i in range(1, 4):
-            value = top_counts.index[i-1] if i <= len(top_counts) else None
-            frequency = top_counts.iloc[i-1] if i <= len(top_counts) else None
-            percentage = (frequency / s.count() * 100) if frequency is not None else None
-            cat_data[f'Top{i}'] = value
-            cat_data[f'Top_Frequency{i}'] = frequency
-            cat_data[f'Top_Percentage{i}'] = round(percentage, 2) if percentage is not None else None
-
-         # Lowest 3 values: frequencies and relative percentages.
-         for i in range(1, 4):
-            value = low_counts.index[i-1] if i <= len(low_counts) else None
-            frequency = low_counts.iloc[i-1] if i <= len(low_counts) else None
-            percentage = (frequency / s.count() * 100) if frequency is not None else None
-            cat_data[f'Low{i}'] = value
-            cat_data[f'Low_Frequency{i}'] = frequency
-            cat_data[f'Low_Percentage{i}'] = round(percentage, 2) if percentage is not None else None
+         # Top 3 and lowest 3 values: frequencies and relative percentages.
+         for prefix, ranked in (('Top', metrics['Top']), ('Low', metrics['Low'])):
+             for i in range(1, 4):
+                value, frequency = ranked[i-1] if i <= len(ranked) else (None, None)
+                percentage = (frequency / count * 100) if frequency is not None else None
+                cat_data[f'{prefix}{i}'] = value
+                cat_data[f'{prefix}_Frequency{i}'] = frequency
+                cat_data[f'{prefix}_Percentage{i}'] = round(percentage, 2) if percentage is not None else None
 
          categorical_metrics[col] = cat_data
 
@@ -287,28 +1072,284 @@ def find_column(df_columns, query_col):
             return col
     return None
 
+def is_numeric_column(s: pd.Series) -> bool:
+    """
+    Returns True for numeric columns, treating booleans as categorical.
+    """
+    return pd.api.types.is_numeric_dtype(s) and not pd.api.types.is_bool_dtype(s)
+
+def bucket_column(s: pd.Series, max_categories: int = COMPARE_MAX_CATEGORIES) -> pd.Series:
+    """
+    Reduces a column to at most `max_categories` (+1) labels for cross-tabulation.
+    Numeric columns with more distinct values are binned into quantiles, labelled like "(2.0, 5.0]" and kept
+    as an ordered categorical so the bins sort numerically; categorical columns keep their `max_categories`
+    most frequent values and group the rest under "Other".
+    """
+    if is_numeric_column(s) and s.nunique() > max_categories:
+        return pd.qcut(s, q=max_categories, duplicates="drop").cat.rename_categories(str)
+
+    counts = s.value_counts()
+    values = s.astype(object)
+    if len(counts) <= max_categories:
+        return values
+    return values.where(s.isin(counts.index[:max_categories]) | s.isna(), OTHER_CATEGORY_LABEL)
+
+def sparse_crosstab(a: pd.Series, b: pd.Series) -> pd.DataFrame:
+    """
+    Counts the co-occurring values of two columns by grouping on their integer codes.
+    Only observed pairs are materialised, so the result never grows to the full
+    (distinct a) x (distinct b) matrix. Returns a long-form frame sorted by count,
+    whose labels keep the dtype of the columns (so binned columns stay ordered).
+    """
+    codes_a, labels_a = pd.factorize(a)
+    codes_b, labels_b = pd.factorize(b)
+    # Missing values are coded as -1 and are left out, like in pd.crosstab.
+    valid = (codes_a >= 0) & (codes_b >= 0)
+    keys = codes_a[valid].astype(np.int64) * len(labels_b) + codes_b[valid]
+    pair_keys, counts = np.unique(keys, return_counts=True)
+
+    pairs = pd.DataFrame({
+        "row": labels_a.take(pair_keys // len(labels_b)),
+        "column": labels_b.take(pair_keys % len(labels_b)),
+        "count": counts,
+    })
+    return pairs.sort_values("count", ascending=False, kind="stable").reset_index(drop=True)
+
 def compare_columns(csv_path: str, column1: str, column2: str, encoding='utf-8') -> str:
     """
-    Compares two columns in the dataset by performing a cross-tabulation.
-    Returns the result as a formatted string.
+    Compares two columns in the dataset by performing a bounded cross-tabulation.
+
+    Each column is reduced to its top categories (numeric columns are binned) before counting,
+    and numeric columns are additionally summarised per category of the other column.
+    Returns the result as a formatted string of at most COMPARE_MAX_CHARS characters.
     """
-    df = pd.read_csv(csv_path, encoding=encoding)
-    # Normalize column names.
-    df.columns = df.columns.str.strip().str.lower()
+    # Column names are already stripped and lower-cased by clean_df_text.
+    df_columns = get_dataset_columns(csv_path)
     normalized_col1 = column1.strip().lower()
     normalized_col2 = column2.strip().lower()
 
-    col1_actual = find_column(df.columns, normalized_col1)
-    col2_actual = find_column(df.columns, normalized_col2)
+    col1_actual = find_column(df_columns, normalized_col1)
+    col2_actual = find_column(df_columns, normalized_col2)
 
     if not col1_actual or not col2_actual:
         return (
             f"Error: Could not find one or both columns ('{column1}', '{column2}'). "
-            f"Available columns: {df.columns.tolist()}"
+            f"Available columns: {df_columns}"
         )
 
-    comparison = pd.crosstab(df[col1_actual], df[col2_actual])
-    return comparison.to_string()
+    df, _ = load_clean_dataset(csv_path, encoding, columns=list(dict.fromkeys([col1_actual, col2_actual])))
+    s1, s2 = df[col1_actual], df[col2_actual]
+    bucketed1, bucketed2 = bucket_column(s1), bucket_column(s2)
+
+    pairs = sparse_crosstab(bucketed1, bucketed2)
+    comparison = pairs.pivot(index="row", columns="column", values="count").fillna(0).astype(int)
+    comparison.index.name, comparison.columns.name = col1_actual, col2_actual
+
+    sections = [f"Cross-tabulation (top {COMPARE_MAX_CATEGORIES} categories per column, numeric columns binned):\n{comparison.to_string()}"]
+
+    if is_numeric_column(s1) and is_numeric_column(s2):
+        sections.append(f"Pearson correlation between '{col1_actual}' and '{col2_actual}': {s1.corr(s2):.4f}")
+    for numeric, numeric_name, groups, group_name in ((s1, col1_actual, bucketed2, col2_actual), (s2, col2_actual, bucketed1, col1_actual)):
+        if is_numeric_column(numeric) and numeric_name != group_name:
+            summary = numeric.groupby(groups, observed=True).agg(['count', 'mean', 'median', 'min', 'max'])
+            summary = summary.sort_values('count', ascending=False)
+            sections.append(f"Summary of '{numeric_name}' per '{group_name}':\n{summary.to_string()}")
+
+    result = "\n\n".join(sections)
+    if len(result) > COMPARE_MAX_CHARS:
+        result = result[:COMPARE_MAX_CHARS] + "\n... (truncated)"
+    return result
+
+def build_filter_mask(s: pd.Series, operator: str, value) -> pd.Series:
+    """
+    Returns a boolean mask of the rows of `s` matching a single query_dataset filter.
+    Text comparisons are case-insensitive; numeric columns compare numerically.
+    """
+    values = value if isinstance(value, list) else [value]
+    if is_numeric_column(s) and operator != "contains":
+        try:
+            values = [float(v) for v in values]
+        except (TypeError, ValueError):
+            raise ValueError(f"Filter on numeric column '{s.name}' needs numeric values, got {value!r}.")
+        column = s
+    else:
+        values = [str(v).strip().lower() for v in values]
+        column = s.astype(str).str.strip().str.lower()
+
+    if operator == "in":
+        return column.isin(values)
+    if operator == "contains":
+        return column.str.contains(values[0], regex=False)
+    comparisons = {
+        "==": column.__eq__, "!=": column.__ne__,
+        ">": column.__gt__, ">=": column.__ge__,
+        "<": column.__lt__, "<=": column.__le__,
+    }
+    if operator not in comparisons:
+        raise ValueError(f"Unsupported filter operator '{operator}'.")
+    return comparisons[operator](values[0])
+
+def query_dataset(
+    csv_path: str,
+    encoding: str = "utf-8",
+    filters: Optional[list] = None,
+    group_by: Optional[list] = None,
+    aggregations: Optional[list] = None,
+    sort_by: Optional[str] = None,
+    ascending: bool = False,
+    limit: int = QUERY_DEFAULT_LIMIT,
+) -> str:
+    """
+    Runs a small declarative query plan over the whole dataset and returns the result table as text.
+
+    filters      -> list of {"column", "operator", "value"}; operators: ==, !=, >, >=, <, <=, in, contains.
+    group_by     -> list of columns to group by.
+    aggregations -> list of {"function", "column"}; functions: count, sum, mean, median, min, max, nunique, std.
+                    "count" without a column counts rows.
+    sort_by      -> result column to sort by; limit caps the number of returned rows.
+
+    Only the referenced columns are loaded and all steps are vectorized.
+    """
+    filters = filters or []
+    group_by = group_by or []
+    aggregations = aggregations or [{"function": "count"}]
+    df_columns = get_dataset_columns(csv_path)
+
+    def resolve(name: str) -> str:
+        column = find_column(df_columns, str(name).strip().lower())
+        if not column:
+            raise ValueError(f"Could not find column '{name}'. Available columns: {df_columns}")
+        return column
+
+    try:
+        filters = [{**f, "column": resolve(f["column"])} for f in filters]
+        group_by = [resolve(col) for col in group_by]
+
+        named_aggregations = {}
+        for agg in aggregations:
+            function = str(agg.get("function", "")).lower()
+            if function not in QUERY_AGGREGATIONS:
+                raise ValueError(f"Unsupported aggregation '{function}'. Use one of {sorted(QUERY_AGGREGATIONS)}.")
+            if agg.get("column"):
+                column = resolve(agg["column"])
+                named_aggregations[f"{function}_{column}"] = (column, function)
+            else:
+                named_aggregations["row_count"] = (None, "size")
+
+        needed = list(dict.fromkeys(
+            [f["column"] for f in filters] + group_by +
+            [column for column, _ in named_aggregations.values() if column is not None]
+        ))
+        df, _ = load_clean_dataset(csv_path, encoding, columns=needed or df_columns[:1])
+
+        mask = np.ones(len(df), dtype=bool)
+        for f in filters:
+            mask &= build_filter_mask(df[f["column"]], f.get("operator", "=="), f.get("value")).to_numpy(dtype=bool)
+        view = df[mask]
+
+        if group_by:
+            grouped = view.groupby(group_by, observed=True)
+            result = grouped.agg(**{
+                name: (column if column is not None else group_by[0], function)
+                for name, (column, function) in named_aggregations.items()
+            }).reset_index()
+        else:
+            result = pd.DataFrame({
+                name: [len(view) if column is None else view[column].agg(function)]
+                for name, (column, function) in named_aggregations.items()
+            })
+
+        if sort_by:
+            sort_column = find_column(list(result.columns), str(sort_by).strip().lower())
+            if sort_column is None:
+                raise ValueError(f"Cannot sort by '{sort_by}'. Result columns: {list(result.columns)}")
+            result = result.sort_values(sort_column, ascending=ascending)
+
+        limit = max(1, min(int(limit), QUERY_MAX_LIMIT))
+    except (KeyError, TypeError, ValueError) as e:
+        return f"Error: {e}"
+
+    header = f"Rows matching filters: {len(view)} of {len(df)}. Result rows: {len(result)}"
+    if len(result) > limit:
+        header += f" (showing first {limit})"
+    return header + "\n" + result.head(limit).to_string(index=False)
+
+def extract_query_filters(csv_path: str, query: str) -> list:
+    """
+    Extracts query_dataset style filters from a natural language query:
+      - values of low-cardinality categorical columns mentioned in the query -> "in" filters.
+      - numeric columns followed by a comparison ("price over 100", "age between 20 and 30")
+        -> range filters.
+    Returns an empty list if the query mentions no column values or ranges.
+    """
+    profile = get_dataset_profile(csv_path)
+    text = query.lower()
+    filters = []
+
+    for column, stats in profile["categorical"].items():
+        matches = [
+            value for value in stats.get("Values", [])
+            if isinstance(value, str) and len(value) > 2
+            and re.search(rf"\b{re.escape(value.lower())}\b", text)
+        ]
+        if matches:
+            filters.append({"column": column, "operator": "in", "value": matches})
+
+    number = r"(-?\d+(?:\.\d+)?)"
+    for column in profile["numeric"]:
+        name = re.escape(column.lower())
+        between = re.search(rf"\b{name}\b[^.?!\d]*?\bbetween\s+{number}\s+and\s+{number}", text)
+        if between:
+            low, high = sorted(float(v) for v in between.groups())
+            filters += [
+                {"column": column, "operator": ">=", "value": low},
+                {"column": column, "operator": "<=", "value": high},
+            ]
+            continue
+        for pattern, operator in QUERY_RANGE_PATTERNS:
+            match = re.search(rf"\b{name}\b[^.?!\d]*?(?:{pattern})\s*{number}", text)
+            if match:
+                filters.append({"column": column, "operator": operator, "value": float(match.group(1))})
+                break
+    return filters
+
+def select_index_rows(csv_path: str, filters: list) -> Optional[np.ndarray]:
+    """
+    Returns a boolean mask over the FAISS ids of a dataset's index, True for the rows matching
+    all `filters`. The filters are evaluated on the cached columnar data, loading only the
+    filtered columns, and mapped to FAISS ids through the row positions stored with the index.
+
+    Returns None if the index has no row positions (it predates them) or there are no filters.
+    Raises ValueError for unknown columns or invalid filter values.
+    """
+    row_positions_path = get_row_positions_path(get_dataset_id(csv_path))
+    if not filters or not os.path.exists(row_positions_path):
+        return None
+
+    df_columns = get_dataset_columns(csv_path)
+    resolved = []
+    for f in filters:
+        column = find_column(df_columns, str(f.get("column", "")).strip().lower())
+        if not column:
+            raise ValueError(f"Could not find column '{f.get('column')}'. Available columns: {df_columns}")
+        resolved.append({**f, "column": column})
+
+    df, _ = load_clean_dataset(csv_path, columns=list(dict.fromkeys(f["column"] for f in resolved)))
+    mask = np.ones(len(df), dtype=bool)
+    for f in resolved:
+        try:
+            mask &= build_filter_mask(df[f["column"]], f.get("operator", "=="), f.get("value")).to_numpy(dtype=bool)
+        except TypeError:
+            # e.g. a text value compared with a numeric column
+            raise ValueError(
+                f"Filter value {f.get('value')!r} cannot be compared with column '{f['column']}' of type {df[f['column']].dtype}."
+            )
+
+    row_positions = np.load(row_positions_path)
+    if len(row_positions) and row_positions.max() >= len(mask):
+        # The CSV changed since it was indexed.
+        return None
+    return mask[row_positions]
 
 async def stream_openai_response(response_iterator):
     """
@@ -338,27 +1379,27 @@ def generate_pie_chart_data(csv_path: str, encoding: str = "utf-8", column_of_in
     if session_id is not None and session_id in chart_data_store:
         chart_data_store.pop(session_id)
     
-    # Read and clean the CSV file.
-    df = pd.read_csv(csv_path, encoding=encoding)
-    df = clean_df_text(df)  # Use your cleaning function if needed.
+    # Only the column names are needed until a column is matched.
+    df_columns = get_dataset_columns(csv_path)
 
     if column_of_interest:
         # Normalize the column name for case-insensitive comparison.
         column_norm = column_of_interest.strip().lower()
-        df_columns_norm = [col.strip().lower() for col in df.columns]
+        df_columns_norm = [col.strip().lower() for col in df_columns]
         
         # Try for an exact match first.
         if column_norm in df_columns_norm:
-            matched_col = df.columns[df_columns_norm.index(column_norm)]
+            matched_col = df_columns[df_columns_norm.index(column_norm)]
         else:
             # If no exact match, try substring matching.
             matched_col = None
-            for original, norm in zip(df.columns, df_columns_norm):
+            for original, norm in zip(df_columns, df_columns_norm):
                 if column_norm in norm:
                     matched_col = original
                     break
                     
         if matched_col:
+            df, _ = load_clean_dataset(csv_path, encoding, columns=[matched_col])
             # Check if the column is categorical (i.e. not numeric).
             if not pd.api.types.is_numeric_dtype(df[matched_col]):
                 distribution = df[matched_col].value_counts()
@@ -0,0 +1,222 @@
+import re
+import time
+import random
+import openai
+import numpy as np
+from concurrent.futures import ThreadPoolExecutor, Future
+from typing import Optional
+from schemas.variables import *
+from helpers.metrics.helpers import increment_counter, set_gauge
+from stores.embedding_store import (
+    embedding_scheduler_state, embedding_scheduler_condition,
+    query_embedding_cache, query_embedding_in_flight, query_embedding_lock
+)
+
+# Client used for embedding requests. The scheduler does its own retries, so the SDK's are disabled.
+_embedding_client = None
+_embedding_client_key = None
+
+def get_embedding_client() -> openai.OpenAI:
+    """
+    Returns the OpenAI client for embedding requests, recreated whenever the API key changes.
+    """
+    global _embedding_client, _embedding_client_key
+    if _embedding_client is None or _embedding_client_key != openai.api_key:
+        _embedding_client = openai.OpenAI(api_key=openai.api_key, max_retries=0)
+        _embedding_client_key = openai.api_key
+    return _embedding_client
+
+def parse_reset_seconds(value: Optional[str]) -> Optional[float]:
+    """
+    Parses rate-limit reset durations such as "1s", "6m0s" or "20ms" into seconds.
+    """
+    if not value:
+        return None
+    units = {"ms": 0.001, "s": 1, "m": 60, "h": 3600}
+    parts = re.findall(r"(\d+(?:\.\d+)?)(ms|s|m|h)", value)
+    if not parts:
+        try:
+            return float(value)
+        except ValueError:
+            return None
+    return sum(float(amount) * units[unit] for amount, unit in parts)
+
+def acquire_embedding_slot():
+    """
+    Blocks until a request may be sent: fewer requests in flight than the current limit,
+    and no rate-limit pause in effect.
+    """
+    with embedding_scheduler_condition:
+        while True:
+            wait = embedding_scheduler_state["paused_until"] - time.monotonic()
+            if wait <= 0 and embedding_scheduler_state["in_flight"] < int(embedding_scheduler_state["limit"]):
+                break
+            embedding_scheduler_condition.wait(timeout=wait if wait > 0 else None)
+        embedding_scheduler_state["in_flight"] += 1
+
+def release_embedding_slot(headers=None, rate_limited: bool = False, retry_delay: float = 0.0):
+    """
+    Frees a request slot and adapts the concurrency limit (AIMD):
+      - on a rate limit, the limit is multiplied by EMBEDDING_DECREASE_FACTOR and all requests
+        pause for `retry_delay` seconds.
+      - on success, the limit grows by about one per window of requests while the rate-limit headers
+        show remaining requests and tokens above EMBEDDING_HEADROOM; below it the limit holds and,
+        when nothing remains, requests pause until the limit resets.
+    """
+    with embedding_scheduler_condition:
+        state = embedding_scheduler_state
+        state["in_flight"] -= 1
+        now = time.monotonic()
+        if rate_limited:
+            state["limit"] = max(EMBEDDING_MIN_CONCURRENCY, state["limit"] * EMBEDDING_DECREASE_FACTOR)
+            state["paused_until"] = max(state["paused_until"], now + retry_delay)
+        elif headers is not None:
+            has_headroom = True
+            for kind in ("requests", "tokens"):
+                remaining = headers.get(f"x-ratelimit-remaining-{kind}")
+                limit = headers.get(f"x-ratelimit-limit-{kind}")
+                if remaining is None or limit is None:
+                    continue
+                remaining, limit = float(remaining), float(limit)
+                if remaining < limit * EMBEDDING_HEADROOM:
+                    has_headroom = False
+                if remaining <= 0:
+                    reset = parse_reset_seconds(headers.get(f"x-ratelimit-reset-{kind}")) or 1.0
+                    state["paused_until"] = max(state["paused_until"], now + reset)
+            if has_headroom:
+                state["limit"] = min(EMBEDDING_MAX_CONCURRENCY, state["limit"] + 1 / state["limit"])
+        set_gauge("embeddings.concurrency_limit", round(state["limit"], 2))
+        embedding_scheduler_condition.notify_all()
+
+def get_retry_delay(attempt: int, error: Exception) -> float:
+    """
+    Seconds to wait before retrying a failed request: the server's Retry-After when given, otherwise
+    exponential backoff with full jitter, capped at EMBEDDING_MAX_BACKOFF_SECONDS.
+    """
+    response = getattr(error, "response", None)
+    if response is not None:
+        retry_after = parse_reset_seconds(response.headers.get("retry-after"))
+        if retry_after is not None:
+            return min(retry_after, EMBEDDING_MAX_BACKOFF_SECONDS)
+    return random.uniform(0, min(EMBEDDING_MAX_BACKOFF_SECONDS, EMBEDDING_BASE_BACKOFF_SECONDS * 2 ** attempt))
+
+def embed_batch(texts: list, model: str = EMBEDDING_MODEL) -> list:
+    """
+    Embeds up to EMBEDDING_BATCH_SIZE texts in one request through the scheduler.
+    Rate limits, timeouts, connection and server errors are retried up to EMBEDDING_MAX_RETRIES times;
+    other errors, and the last failure, are raised.
+    """
+    for attempt in range(EMBEDDING_MAX_RETRIES + 1):
+        acquire_embedding_slot()
+        try:
+            raw = get_embedding_client().embeddings.with_raw_response.create(input=texts, model=model)
+        except (openai.RateLimitError, openai.APITimeoutError, openai.APIConnectionError, openai.InternalServerError) as e:
+            rate_limited = isinstance(e, openai.RateLimitError)
+            delay = get_retry_delay(attempt, e)
+            release_embedding_slot(rate_limited=rate_limited, retry_delay=delay)
+            increment_counter("embeddings.rate_limited" if rate_limited else "embeddings.errors")
+            if attempt == EMBEDDING_MAX_RETRIES:
+                raise
+            increment_counter("embeddings.retried")
+            print(f"⚠️ Embedding request failed ({type(e).__name__}), retrying in {delay:.1f}s...", flush=True)
+            if not rate_limited:
+                time.sleep(delay)
+            continue
+        except Exception:
+            release_embedding_slot()
+            raise
+
+        release_embedding_slot(headers=raw.headers)
+        increment_counter("embeddings.requests")
+        increment_counter("embeddings.texts", len(texts))
+        response = raw.parse()
+        return [item.embedding for item in sorted(response.data, key=lambda item: item.index)]
+
+def mmr_select(
+    query_embedding,
+    candidate_embeddings,
+    k: int,
+    mmr_lambda: float,
+) -> list:
+    """
+    Maximal Marginal Relevance: greedily picks min(k, len(candidates)) candidates, each maximizing
+    mmr_lambda * sim(query, c) - (1 - mmr_lambda) * max sim(c, selected), with cosine similarities
+    computed once as matrices. Returns candidate positions in selection order.
+    """
+    candidates = np.asarray(candidate_embeddings, dtype='float32')
+    if len(candidates) == 0:
+        return []
+    candidates = candidates / np.clip(np.linalg.norm(candidates, axis=1, keepdims=True), 1e-12, None)
+    query = np.asarray(query_embedding, dtype='float32').reshape(-1)
+    query = query / max(float(np.linalg.norm(query)), 1e-12)
+
+    relevance = candidates @ query
+    pairwise = candidates @ candidates.T
+    redundancy = np.zeros(len(candidates), dtype='float32')
+    available = np.ones(len(candidates), dtype=bool)
+    selected = []
+    while len(selected) < k and available.any():
+        scores = np.where(available, mmr_lambda * relevance - (1 - mmr_lambda) * redundancy, -np.inf)
+        best = int(np.argmax(scores))
+        selected.append(best)
+        redundancy = pairwise[best] if len(selected) == 1 else np.maximum(redundancy, pairwise[best])
+        available[best] = False
+    return selected
+
+# Worker pool sending the batches of embed_texts; the scheduler decides how many run at once.
+embedding_executor = ThreadPoolExecutor(max_workers=EMBEDDING_MAX_CONCURRENCY)
+
+def embed_texts(texts: list, model: str = EMBEDDING_MODEL) -> list:
+    """
+    Embeds a list of texts, sent as batches of EMBEDDING_BATCH_SIZE inputs in parallel under the shared
+    rate-limit-aware concurrency limit. Returns the embeddings in input order, or raises if a batch
+    still fails after its retries.
+    """
+    batches = [texts[i:i + EMBEDDING_BATCH_SIZE] for i in range(0, len(texts), EMBEDDING_BATCH_SIZE)]
+    if len(batches) == 1:
+        return embed_batch(batches[0], model)
+    embeddings = []
+    for batch_embeddings in embedding_executor.map(lambda batch: embed_batch(batch, model), batches):
+        embeddings.extend(batch_embeddings)
+    return embeddings
+
+def embed_query_cached(text: str, model: str = EMBEDDING_MODEL) -> list:
+    """
+    Returns the embedding of a search query from an LRU cache of QUERY_EMBEDDING_CACHE_SIZE entries.
+    On a miss only one request per distinct query is sent: concurrent callers with the same query wait
+    for the request already in flight (single-flight) and share its result or error.
+    """
+    key = (model, text)
+    with query_embedding_lock:
+        embedding = query_embedding_cache.get(key)
+        if embedding is not None:
+            query_embedding_cache.move_to_end(key)
+        else:
+            future = query_embedding_in_flight.get(key)
+            is_leader = future is None
+            if is_leader:
+                future = Future()
+                query_embedding_in_flight[key] = future
+    if embedding is not None:
+        increment_counter("query_embeddings.hits")
+        return embedding
+    if not is_leader:
+        increment_counter("query_embeddings.coalesced")
+        return future.result()
+
+    increment_counter("query_embeddings.misses")
+    try:
+        embedding = embed_texts([text], model)[0]
+    except Exception as e:
+        with query_embedding_lock:
+            query_embedding_in_flight.pop(key, None)
+        future.set_exception(e)
+        raise
+
+    with query_embedding_lock:
+        query_embedding_cache[key] = embedding
+        while len(query_embedding_cache) > QUERY_EMBEDDING_CACHE_SIZE:
+            query_embedding_cache.popitem(last=False)
+        query_embedding_in_flight.pop(key, None)
+    future.set_result(embedding)
+    return embedding
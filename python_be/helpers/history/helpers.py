@@ -0,0 +1,92 @@
+import time
+import openai
+from concurrent.futures import ThreadPoolExecutor
+from schemas.variables import *
+from stores.history_store import history_summaries, history_summarizing, history_lock
+from helpers.metrics.helpers import record_timing, increment_counter
+
+# A single worker is enough: summaries are small, off the request path, and at most one runs per conversation.
+summary_executor = ThreadPoolExecutor(max_workers=1)
+
+SUMMARY_INSTRUCTIONS = (
+    "You maintain a running summary of a conversation between a user and an assistant. "
+    "Merge the new messages into the existing summary. Keep the facts, figures, names and decisions "
+    "later questions may refer to, and drop greetings and repetition. "
+    "Answer with the updated summary only, in at most a few short paragraphs."
+)
+
+def get_history_messages(chat: str, chat_histories: dict, session_id: str) -> list:
+    """
+    Returns the history to send with the next request of a session:
+    the running summary of the older turns, if any, followed by the most recent messages.
+    """
+    with history_lock:
+        summary = history_summaries.get((chat, session_id))
+        recent = list(chat_histories.get(session_id, [])[-HISTORY_RECENT_MESSAGES:])
+    if summary:
+        return [{"role": "system", "content": f"Summary of the earlier conversation:\n{summary}"}] + recent
+    return recent
+
+def add_history_message(chat: str, chat_histories: dict, session_id: str, role: str, content: str):
+    """
+    Appends a message to a session's history. After an assistant answer, once enough messages have
+    aged out of the recent window, they are folded into the summary in the background.
+    """
+    with history_lock:
+        history = chat_histories.setdefault(session_id, [])
+        history.append({"role": role, "content": content})
+        # Bound the raw history even if summarization keeps failing.
+        del history[:-HISTORY_MAX_MESSAGES]
+        due = (
+            role == "assistant"
+            and len(history) - HISTORY_RECENT_MESSAGES >= HISTORY_SUMMARY_BATCH
+            and (chat, session_id) not in history_summarizing
+        )
+        if due:
+            history_summarizing.add((chat, session_id))
+    if due:
+        summary_executor.submit(summarize_history, chat, chat_histories, session_id)
+
+def summarize_history(chat: str, chat_histories: dict, session_id: str):
+    """
+    Folds the messages older than the recent window into the session's running summary with a cheap model,
+    then drops them from the raw history. Messages appended meanwhile are left untouched.
+    """
+    key = (chat, session_id)
+    try:
+        with history_lock:
+            history = chat_histories.get(session_id)
+            if history is None:
+                return
+            older = history[:-HISTORY_RECENT_MESSAGES]
+            summary = history_summaries.get(key)
+        if not older:
+            return
+
+        transcript = "\n\n".join(f"{message['role'].capitalize()}: {message['content']}" for message in older)
+        start = time.perf_counter()
+        response = openai.chat.completions.create(
+            model=HISTORY_SUMMARY_MODEL,
+            messages=[
+                {"role": "system", "content": SUMMARY_INSTRUCTIONS},
+                {"role": "user", "content": f"Existing summary:\n{summary or '(none)'}\n\nNew messages:\n{transcript}"},
+            ],
+            temperature=0,
+            max_tokens=HISTORY_SUMMARY_MAX_TOKENS,
+        )
+        record_timing("history.summarize", (time.perf_counter() - start) * 1000)
+        new_summary = response.choices[0].message.content.strip()
+
+        with history_lock:
+            # The session may have been cleared, or its oldest messages trimmed, while the model ran.
+            if chat_histories.get(session_id) is not history or history[:len(older)] != older:
+                return
+            history_summaries[key] = new_summary
+            del history[:len(older)]
+        print(f"📝 Summarized {len(older)} messages of {chat} session {session_id}.", flush=True)
+    except Exception as e:
+        increment_counter("history.summary_errors")
+        print(f"[ERROR] Failed to summarize the {chat} history of session {session_id}: {e}", flush=True)
+    finally:
+        with history_lock:
+            history_summarizing.discard(key)
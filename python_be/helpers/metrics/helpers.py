@@ -0,0 +1,38 @@
+from stores.metrics_store import metrics_store, metrics_store_lock
+
+def record_timing(name: str, elapsed_ms: float):
+    """
+    Records one timing sample under `name`, keeping the call count, total, last and max duration.
+    """
+    with metrics_store_lock:
+        entry = metrics_store.setdefault(name, {"count": 0, "total_ms": 0.0, "last_ms": 0.0, "max_ms": 0.0})
+        entry["count"] += 1
+        entry["total_ms"] += elapsed_ms
+        entry["last_ms"] = elapsed_ms
+        entry["max_ms"] = max(entry["max_ms"], elapsed_ms)
+
+def increment_counter(name: str, amount: int = 1):
+    """
+    Adds `amount` to the counter `name`.
+    """
+    with metrics_store_lock:
+        entry = metrics_store.setdefault(name, {"count": 0})
+        entry["count"] += amount
+
+def set_gauge(name: str, value: float):
+    """
+    Records the current value of `name`.
+    """
+    with metrics_store_lock:
+        metrics_store[name] = {"value": value}
+
+def get_metrics() -> dict:
+    """
+    Returns a snapshot of all recorded metrics, adding the average duration of timings.
+    """
+    with metrics_store_lock:
+        snapshot = {name: dict(entry) for name, entry in metrics_store.items()}
+    for entry in snapshot.values():
+        if "total_ms" in entry and entry.get("count"):
+            entry["avg_ms"] = entry["total_ms"] / entry["count"]
+    return snapshot
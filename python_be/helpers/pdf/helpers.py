@@ -5,8 +5,18 @@ import chromadb
 import openai
 import hashlib
 import datetime
+import json
+import re
+import time
+import numpy as np
 from dotenv import load_dotenv
 from sentence_transformers import SentenceTransformer
+from helpers.uploads.helpers import get_recorded_hash
+from helpers.embeddings.helpers import embed_texts, embed_query_cached, mmr_select
+from helpers.metrics.helpers import increment_counter, set_gauge
+from helpers.history.helpers import add_history_message
+from stores.answer_cache_store import answer_cache, answer_cache_state, answer_cache_lock
+from schemas.variables import *
 
 load_dotenv()
 openai.api_key = os.getenv("OPENAI_API_KEY")
@@ -59,7 +69,10 @@ metadata_collection = chroma_client.get_or_create_collection(name="metadata")
 
 
 def get_pdf_hash(pdf_path: str) -> str:
-    """Generate a SHA-256 hash for a PDF file."""
+    """Generate a SHA-256 hash for a PDF file, reusing the hash recorded at upload time."""
+    recorded_hash = get_recorded_hash(pdf_path)
+    if recorded_hash is not None:
+        return recorded_hash
     hasher = hashlib.sha256()
     with open(pdf_path, "rb") as f:
         while chunk := f.read(8192):
@@ -67,6 +80,202 @@ def get_pdf_hash(pdf_path: str) -> str:
     return hasher.hexdigest()
 
 
+def get_pdf_checkpoint_path(pdf_hash):
+    return os.path.join(PDF_CHECKPOINT_DIRECTORY, f"{pdf_hash}.json")
+
+def load_pdf_checkpoint(pdf_hash):
+    """Return the checkpoint (chunk size and number of chunks) of an unfinished PDF ingestion, or None."""
+    checkpoint_path = get_pdf_checkpoint_path(pdf_hash)
+    if not os.path.exists(checkpoint_path):
+        return None
+    try:
+        with open(checkpoint_path, "r") as f:
+            return json.load(f)
+    except Exception as e:
+        print(f"[ERROR] Error loading PDF checkpoint {checkpoint_path}: {e}")
+        return None
+
+def save_pdf_checkpoint(pdf_hash, chunk_size, num_chunks):
+    """Record that a PDF is being ingested, so an interrupted run can be resumed or cleaned up."""
+    os.makedirs(PDF_CHECKPOINT_DIRECTORY, exist_ok=True)
+    with open(get_pdf_checkpoint_path(pdf_hash), "w") as f:
+        json.dump({"chunk_size": chunk_size, "num_chunks": num_chunks}, f)
+
+def clear_pdf_checkpoint(pdf_hash):
+    checkpoint_path = get_pdf_checkpoint_path(pdf_hash)
+    if os.path.exists(checkpoint_path):
+        os.remove(checkpoint_path)
+
+# MinHash permutations (a * x + b) mod p, fixed so signatures stay comparable across runs
+_minhash_rng = np.random.default_rng(PDF_MINHASH_SEED)
+_MINHASH_A = _minhash_rng.integers(1, 2 ** 32, size=PDF_MINHASH_PERMUTATIONS, dtype=np.uint64)
+_MINHASH_B = _minhash_rng.integers(0, 2 ** 32, size=PDF_MINHASH_PERMUTATIONS, dtype=np.uint64)
+_MINHASH_PRIME = np.uint64((1 << 61) - 1)
+# Serializes updates of the dedup index and of the representatives' sources
+dedup_lock = threading.Lock()
+
+def minhash_signature(text):
+    """Compute the MinHash signature of the word shingles of a text chunk."""
+    words = re.findall(r"\w+", text.lower())
+    size = PDF_SHINGLE_SIZE
+    shingles = {" ".join(words[i:i + size]) for i in range(max(1, len(words) - size + 1))}
+    hashes = np.array(
+        [int.from_bytes(hashlib.blake2b(s.encode(), digest_size=4).digest(), "little") for s in shingles],
+        dtype=np.uint64,
+    )
+    # a and x are below 2^32, so the product fits in 64 bits.
+    values = (hashes[:, None] * _MINHASH_A + _MINHASH_B) % _MINHASH_PRIME
+    return values.min(axis=0).astype(np.uint32)
+
+def load_dedup_index():
+    """Load the MinHash signatures of all stored chunks and, per chunk, the chunk ID holding its embedding."""
+    if not os.path.exists(PDF_DEDUP_INDEX_FILE):
+        return {"ids": [], "signatures": np.empty((0, PDF_MINHASH_PERMUTATIONS), dtype=np.uint32), "representatives": []}
+    with np.load(PDF_DEDUP_INDEX_FILE) as data:
+        return {
+            "ids": data["ids"].tolist(),
+            "signatures": data["signatures"],
+            "representatives": data["representatives"].tolist(),
+        }
+
+def save_dedup_index(index):
+    tmp_path = PDF_DEDUP_INDEX_FILE + ".tmp.npz"
+    np.savez(tmp_path, ids=np.array(index["ids"], dtype=str), signatures=index["signatures"],
+             representatives=np.array(index["representatives"], dtype=str))
+    os.replace(tmp_path, PDF_DEDUP_INDEX_FILE)
+
+def lsh_band_keys(signature):
+    """Split a signature into PDF_LSH_BANDS bands; near-duplicates very likely share at least one band."""
+    rows = PDF_MINHASH_PERMUTATIONS // PDF_LSH_BANDS
+    return [(band, signature[band * rows:(band + 1) * rows].tobytes()) for band in range(PDF_LSH_BANDS)]
+
+def find_near_duplicate(signature, signatures, buckets):
+    """
+    Return the position of the most similar signature among the LSH candidates whose estimated
+    Jaccard similarity reaches PDF_DEDUP_THRESHOLD, or None if the chunk has no near-duplicate.
+    """
+    candidates = {position for key in lsh_band_keys(signature) for position in buckets.get(key, [])}
+    if not candidates:
+        return None
+    candidates = sorted(candidates)
+    similarities = (np.stack([signatures[c] for c in candidates]) == signature).mean(axis=1)
+    best = int(np.argmax(similarities))
+    if similarities[best] < PDF_DEDUP_THRESHOLD:
+        return None
+    return candidates[best]
+
+def register_pdf_chunks(chunk_ids, chunks, sources):
+    """
+    Assign every chunk of a PDF to a representative: the stored chunk it near-duplicates (across the
+    corpus or earlier in the same PDF), or itself. Chunks registered by an earlier, interrupted run keep
+    their assignment. Duplicates are recorded in the sources of their representative, so only
+    representatives have to be embedded.
+
+    Returns (representatives per chunk, sources per new representative).
+    """
+    with dedup_lock:
+        index = load_dedup_index()
+        known = {chunk_id: position for position, chunk_id in enumerate(index["ids"])}
+        signatures = list(index["signatures"])
+        buckets = {}
+        for position, signature in enumerate(signatures):
+            for key in lsh_band_keys(signature):
+                buckets.setdefault(key, []).append(position)
+
+        representatives = []
+        new_sources = {}
+        duplicates = {}
+        for chunk_id, chunk, source in zip(chunk_ids, chunks, sources):
+            if chunk_id in known:
+                representatives.append(index["representatives"][known[chunk_id]])
+                continue
+            signature = minhash_signature(chunk)
+            match = find_near_duplicate(signature, signatures, buckets)
+            representative = index["representatives"][match] if match is not None else chunk_id
+            representatives.append(representative)
+
+            for key in lsh_band_keys(signature):
+                buckets.setdefault(key, []).append(len(signatures))
+            signatures.append(signature)
+            index["ids"].append(chunk_id)
+            index["representatives"].append(representative)
+
+            if representative == chunk_id:
+                new_sources[chunk_id] = [source]
+            elif representative in new_sources:
+                new_sources[representative].append(source)
+            else:
+                duplicates.setdefault(representative, []).append(source)
+
+        # Point representatives stored by other PDFs (or earlier runs) at their new duplicates.
+        if duplicates:
+            stored = collection.get(ids=list(duplicates), include=["metadatas"])
+            for rep_id, metadata in zip(stored["ids"], stored["metadatas"]):
+                rep_sources = json.loads(metadata.get("sources", "[]")) + duplicates[rep_id]
+                collection.update(ids=[rep_id], metadatas=[{**metadata, "sources": json.dumps(rep_sources)}])
+        index["signatures"] = np.array(signatures, dtype=np.uint32).reshape(-1, PDF_MINHASH_PERMUTATIONS)
+        save_dedup_index(index)
+
+    skipped = sum(1 for chunk_id, rep in zip(chunk_ids, representatives) if rep != chunk_id)
+    if skipped:
+        print(f"♻️ {skipped}/{len(chunk_ids)} chunks reuse the embedding of a near-duplicate chunk.", flush=True)
+    return representatives, new_sources
+
+def release_pdf_chunks(pdf_hash):
+    """
+    Remove the chunks of a PDF from the dedup index before its embeddings are deleted:
+      - representatives of the PDF that other PDFs still point to are re-stored under the ID of one of
+        those duplicates, with the same embedding.
+      - the PDF's sources are removed from the representatives of other PDFs.
+    """
+    prefix = f"{pdf_hash}_chunk_"
+    with dedup_lock:
+        index = load_dedup_index()
+        removed = [i for i, chunk_id in enumerate(index["ids"]) if chunk_id.startswith(prefix)]
+        if not removed:
+            return
+        removed_set = set(removed)
+        keep = [i for i in range(len(index["ids"])) if i not in removed_set]
+
+        # Remaining chunks per representative, grouped by representatives of this PDF or of others.
+        orphans, affected = {}, set()
+        for i in keep:
+            representative = index["representatives"][i]
+            if representative.startswith(prefix):
+                orphans.setdefault(representative, []).append(i)
+        for i in removed:
+            representative = index["representatives"][i]
+            if not representative.startswith(prefix):
+                affected.add(representative)
+
+        if orphans:
+            stored = collection.get(ids=list(orphans), include=["embeddings", "metadatas"])
+            for rep_id, embedding, metadata in zip(stored["ids"], stored["embeddings"], stored["metadatas"]):
+                new_rep = index["ids"][orphans[rep_id][0]]
+                rep_sources = [s for s in json.loads(metadata.get("sources", "[]")) if not s["chunk_id"].startswith(prefix)]
+                collection.add(ids=[new_rep], embeddings=[embedding], metadatas=[{**metadata, "sources": json.dumps(rep_sources)}])
+                for i in orphans[rep_id]:
+                    index["representatives"][i] = new_rep
+
+        if affected:
+            stored = collection.get(ids=list(affected), include=["metadatas"])
+            for rep_id, metadata in zip(stored["ids"], stored["metadatas"]):
+                rep_sources = [s for s in json.loads(metadata.get("sources", "[]")) if not s["chunk_id"].startswith(prefix)]
+                collection.update(ids=[rep_id], metadatas=[{**metadata, "sources": json.dumps(rep_sources)}])
+
+        save_dedup_index({
+            "ids": [index["ids"][i] for i in keep],
+            "signatures": index["signatures"][keep],
+            "representatives": [index["representatives"][i] for i in keep],
+        })
+
+def get_stored_chunk_ids(chunk_ids):
+    """Return the subset of chunk IDs already stored in the collection, in a single lookup."""
+    if not chunk_ids:
+        return set()
+    return set(collection.get(ids=chunk_ids, include=[]).get("ids", []))
+
+
 def mark_pdf_as_processed(pdf_path, num_chunks, pdf_hash):
     """Store PDF hash in metadata collection.
     """
@@ -134,11 +343,14 @@ def clear_all_embeddings(reset=False):
         print(f"❌ Error retrieving embeddings: {e}")
         return {"status": "error", "message": "Failed to list embeddings. Please try again later."}
     all_ids = results.get("ids", [])
+    invalidate_answer_cache()
     if all_ids:
         collection.delete(ids=all_ids)
         print(f"Cleared {len(all_ids)} embeddings from the collection.")
     else:
         print("No embeddings found to clear.")
+    if os.path.exists(PDF_DEDUP_INDEX_FILE):
+        os.remove(PDF_DEDUP_INDEX_FILE)
 
     # If reset=True, remove the entire storage folder
     if reset:
@@ -162,8 +374,15 @@ def clear_pdf_embeddings(pdf_path):
     pdf_hash = get_pdf_hash(pdf_path)
     print(f"[DEBUG] Attempting to clear embeddings for PDF: {pdf_path} (hash: {pdf_hash})")
     
-    # Retrieve metadata for this PDF.
-    metadata = get_pdf_metadata(pdf_path)
+    # Retrieve metadata for this PDF, or the checkpoint of an unfinished ingestion.
+    metadata = get_pdf_metadata(pdf_path) or load_pdf_checkpoint(pdf_hash)
+    clear_pdf_checkpoint(pdf_hash)
+
+    # Hand over representatives that other PDFs' near-duplicate chunks still rely on.
+    try:
+        release_pdf_chunks(pdf_hash)
+    except Exception as e:
+        print(f"[ERROR] Failed to release near-duplicate chunks of {pdf_path}: {e}")
     
     if metadata is None:
         print(f"[INFO] No metadata found for {pdf_path}. No embeddings to clear.")
@@ -176,6 +395,7 @@ def clear_pdf_embeddings(pdf_path):
     chunk_ids = [f"{pdf_hash}_chunk_{i}" for i in range(num_chunks)]
     
     # Delete the embeddings (chunks) from the main collection.
+    invalidate_answer_cache()
     try:
         collection.delete(ids=chunk_ids)
         print(f"[DEBUG] Deleted {len(chunk_ids)} embeddings for {pdf_path}.")
@@ -190,12 +410,8 @@ def clear_pdf_embeddings(pdf_path):
         print(f"[ERROR] Failed to delete metadata for {pdf_path}: {e}")
 
 def embed_text(text):
-    """Generate embeddings for a text chunk using openai api."""
-    response = openai.embeddings.create(
-        input=text,
-        model="text-embedding-ada-002" # text-embedding-3-small, text-embedding-3-large newest models
-    )
-    return response.data[0].embedding
+    """Generate embeddings for a text chunk using openai api, through the shared embedding scheduler."""
+    return embed_texts([text])[0]  # text-embedding-3-small, text-embedding-3-large newest models
 
 # embed text with opensource alternative model (all-MiniLM-L6-v2) offers faster processing times
 # use different chroma storage path as now the dimensionality is different
@@ -205,13 +421,34 @@ def embed_text(text):
 #     embedding = model.encode(text)
 #     return embedding.tolist()
 
-def search_docs(query, top_k=10, min_score=0.7):
-    """Retrieve relevant document chunks using embeddings."""
-    query_embedding = embed_text(query)
-    results = collection.query(
-        query_embeddings=[query_embedding],
-        n_results=top_k
-    )
+def format_chunk_sources(metadata):
+    """Return the files and pages a chunk (and its near-duplicates) was found on, e.g. "Sources: a.pdf (p. 2), b.pdf (p. 7)"."""
+    sources = json.loads(metadata.get("sources", "[]"))
+    pointers = dict.fromkeys(f"{source['file']} (p. {source['page']})" for source in sources)
+    return f"Sources: {', '.join(pointers)}" if pointers else ""
+
+def search_docs(query, top_k=10, min_score=0.7, mmr_lambda=None, query_embedding=None):
+    """Retrieve relevant document chunks using embeddings (the query embedding is cached unless it is given).
+    With mmr_lambda set, top_k * MMR_CANDIDATE_FACTOR neighbours are fetched with their stored embeddings
+    and up to top_k diverse chunks are kept with Maximal Marginal Relevance.
+    Each chunk ends with the files and pages it (or a near-duplicate of it) appears on, so answers can cite them."""
+    if query_embedding is None:
+        query_embedding = embed_query_cached(query)
+    if mmr_lambda is None:
+        results = collection.query(
+            query_embeddings=[query_embedding],
+            n_results=top_k
+        )
+    else:
+        results = collection.query(
+            query_embeddings=[query_embedding],
+            n_results=top_k * MMR_CANDIDATE_FACTOR,
+            include=["metadatas", "embeddings"]
+        )
+        candidates = results["metadatas"][0]
+        if candidates:
+            selected = mmr_select(query_embedding, results["embeddings"][0], top_k, mmr_lambda)
+            results["metadatas"] = [[candidates[i] for i in selected]]
     
     # Extract text from retrieved results
     retrieved_texts = []
@@ -219,12 +456,73 @@ def search_docs(query, top_k=10, min_score=0.7):
         for doc in group:
             score = doc.get("score", 1)  # Default score if not provided
             if score >= min_score and "text" in doc:
-                retrieved_texts.append(doc["text"])
+                sources = format_chunk_sources(doc)
+                retrieved_texts.append(f"{doc['text']}\n[{sources}]" if sources else doc["text"])
     
     return retrieved_texts
 
-def openai_stream_generator(response_iterator, session_id, chat_histories):
-    """Stream OpenAI response while storing it in chat history."""
+def invalidate_answer_cache():
+    """Drop all cached answers. Called whenever PDF chunks are added or deleted."""
+    with answer_cache_lock:
+        answer_cache.clear()
+        answer_cache_state["corpus_version"] += 1
+
+def is_history_independent(query, history):
+    """A query can be answered from the cache if it opens the conversation or refers to nothing said before."""
+    if not history:
+        return True
+    return not (set(re.findall(r"[a-z']+", query.lower())) & ANSWER_CACHE_CONTEXT_WORDS)
+
+def lookup_cached_answer(query_embedding, model):
+    """
+    Return the cached answer of the most similar earlier query for the same model and corpus version,
+    if its cosine similarity reaches ANSWER_CACHE_SIMILARITY. Expired entries are evicted on the way.
+    Hits and misses are counted, and the hit rate is kept as a gauge.
+    """
+    query = np.asarray(query_embedding, dtype='float32')
+    query = query / max(float(np.linalg.norm(query)), 1e-12)
+    now = time.time()
+    answer = None
+    with answer_cache_lock:
+        answer_cache[:] = [entry for entry in answer_cache if now - entry["created_at"] < ANSWER_CACHE_TTL_SECONDS]
+        candidates = [entry for entry in answer_cache if entry["model"] == model]
+        if candidates:
+            similarities = np.stack([entry["embedding"] for entry in candidates]) @ query
+            best = int(np.argmax(similarities))
+            if similarities[best] >= ANSWER_CACHE_SIMILARITY:
+                answer = candidates[best]["answer"]
+        answer_cache_state["hits" if answer is not None else "misses"] += 1
+        hit_rate = answer_cache_state["hits"] / (answer_cache_state["hits"] + answer_cache_state["misses"])
+
+    increment_counter("answer_cache.hits" if answer is not None else "answer_cache.misses")
+    set_gauge("answer_cache.hit_rate", round(hit_rate, 4))
+    return answer
+
+def store_cached_answer(query_embedding, model, answer, corpus_version):
+    """Cache an answer, unless the corpus changed while it was generated. The oldest entries are evicted first."""
+    embedding = np.asarray(query_embedding, dtype='float32')
+    embedding = embedding / max(float(np.linalg.norm(embedding)), 1e-12)
+    with answer_cache_lock:
+        if corpus_version != answer_cache_state["corpus_version"]:
+            return
+        answer_cache.append({"embedding": embedding, "model": model, "answer": answer, "created_at": time.time()})
+        del answer_cache[:-ANSWER_CACHE_MAX_ENTRIES]
+
+def get_corpus_version():
+    with answer_cache_lock:
+        return answer_cache_state["corpus_version"]
+
+def replay_cached_answer(answer, session_id, chat_histories):
+    """Stream a cached answer in small pieces, like a live response, while storing it in chat history."""
+    for start in range(0, len(answer), ANSWER_CACHE_REPLAY_CHARS):
+        yield answer[start:start + ANSWER_CACHE_REPLAY_CHARS]
+
+    if session_id in chat_histories:
+        add_history_message("pdf", chat_histories, session_id, "assistant", answer)
+
+def openai_stream_generator(response_iterator, session_id, chat_histories, on_complete=None, chat="pdf"):
+    """Stream OpenAI response while storing it in chat history (of the `chat` the histories belong to).
+    on_complete, if given, is called with the full response once the stream has finished."""
     full_response = ""
 
     for chunk in response_iterator:
@@ -235,9 +533,9 @@ def openai_stream_generator(response_iterator, session_id, chat_histories):
             full_response += delta.content
             yield delta.content
 
-    # ✅ Store final response in chat history
-    if session_id in chat_histories:
-        chat_histories[session_id].append({"role": "assistant", "content": full_response})
+    if on_complete is not None:
+        on_complete(full_response)
 
-        # Keep only the last 12 entries (6 user queries + 6 AI responses)
-        chat_histories[session_id] = chat_histories[session_id][-12:]
\ No newline at end of file
+    # ✅ Store final response in chat history; older turns are summarized in the background
+    if session_id in chat_histories:
+        add_history_message(chat, chat_histories, session_id, "assistant", full_response)
\ No newline at end of file
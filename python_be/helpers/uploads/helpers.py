@@ -0,0 +1,138 @@
+import os
+import json
+import asyncio
+import hashlib
+import tempfile
+from contextlib import nullcontext
+from typing import Optional, Callable
+from fastapi import HTTPException, UploadFile
+from schemas.variables import *
+from stores.upload_store import pending_uploads, upload_lock
+
+def get_hash_record_path(file_path: str) -> str:
+    return file_path + UPLOAD_HASH_SUFFIX
+
+def record_file_hash(file_path: str, sha256: str):
+    """
+    Records the SHA-256 hash of a file next to it, tagged with the file's size and mtime.
+    """
+    stat = os.stat(file_path)
+    with open(get_hash_record_path(file_path), "w") as f:
+        json.dump({"sha256": sha256, "size": stat.st_size, "mtime_ns": stat.st_mtime_ns}, f)
+
+def get_recorded_hash(file_path: str) -> Optional[str]:
+    """
+    Returns the hash recorded for a file at upload time, or None if there is none
+    or the file was modified since.
+    """
+    try:
+        with open(get_hash_record_path(file_path), "r") as f:
+            record = json.load(f)
+        stat = os.stat(file_path)
+    except (OSError, ValueError):
+        return None
+    if (record.get("size"), record.get("mtime_ns")) != (stat.st_size, stat.st_mtime_ns):
+        return None
+    return record.get("sha256")
+
+def remove_hash_record(file_path: str):
+    hash_record_path = get_hash_record_path(file_path)
+    if os.path.exists(hash_record_path):
+        os.remove(hash_record_path)
+
+async def reserve_upload(folder: str, filename: str, extension: str, max_files: int):
+    """
+    Reserves `filename` in `folder` for an upload. Files being uploaded count towards `max_files`
+    together with the stored ones, and the check and reservation happen under one lock,
+    so concurrent uploads cannot exceed the limit. Replacing a stored file takes no new slot.
+    """
+    async with upload_lock:
+        try:
+            stored = {f for f in os.listdir(folder) if f.endswith(extension)}
+        except Exception as e:
+            raise HTTPException(status_code=500, detail=str(e))
+
+        pending = pending_uploads.setdefault(folder, set())
+        if filename in pending:
+            raise HTTPException(status_code=409, detail=f"{filename} is already being uploaded.")
+        if len(stored | pending | {filename}) > max_files:
+            raise HTTPException(status_code=400, detail=f"Maximum of {max_files} {extension.lstrip('.').upper()} files allowed.")
+        pending.add(filename)
+
+async def release_upload(folder: str, filename: str):
+    async with upload_lock:
+        pending_uploads.get(folder, set()).discard(filename)
+
+def write_upload_chunk(buffer, hasher, chunk: bytes):
+    hasher.update(chunk)
+    buffer.write(chunk)
+
+async def save_upload(
+    file: UploadFile,
+    file_path: str,
+    max_bytes: int,
+    get_lock: Optional[Callable] = None,
+    before_replace: Optional[Callable] = None,
+) -> str:
+    """
+    Streams an upload to a temporary file in UPLOAD_CHUNK_BYTES chunks, hashing and writing them in a
+    worker thread, then moves it to `file_path` atomically and records its hash. Uploads larger than
+    `max_bytes` are rejected with a 413. Returns the SHA-256 hash of the file.
+
+    Starlette spools the multipart body before the handler runs, so this check only applies once the
+    upload has been received; the upload size middleware in main.py rejects oversized uploads up front
+    from their Content-Length.
+
+    The move happens under `get_lock(file_path)`, if given, so it cannot race indexing of the same file.
+    When a stored file is replaced with different content, `before_replace(file_path)` runs first
+    under the same lock, e.g. to clear the old file's embeddings.
+    """
+    if file.size is not None and file.size > max_bytes:
+        raise HTTPException(status_code=413, detail=f"File exceeds the maximum size of {max_bytes // (1024 * 1024)} MB.")
+
+    hasher = hashlib.sha256()
+    size = 0
+    # The temporary file lives in the target folder so the final move is a rename.
+    fd, tmp_path = tempfile.mkstemp(dir=os.path.dirname(file_path), suffix=".part")
+    try:
+        with os.fdopen(fd, "wb") as buffer:
+            while chunk := await file.read(UPLOAD_CHUNK_BYTES):
+                size += len(chunk)
+                if size > max_bytes:
+                    raise HTTPException(status_code=413, detail=f"File exceeds the maximum size of {max_bytes // (1024 * 1024)} MB.")
+                await asyncio.to_thread(write_upload_chunk, buffer, hasher, chunk)
+        sha256 = hasher.hexdigest()
+
+        async with get_lock(file_path) if get_lock is not None else nullcontext():
+            if before_replace is not None and os.path.exists(file_path) and get_recorded_hash(file_path) != sha256:
+                await asyncio.to_thread(before_replace, file_path)
+            os.replace(tmp_path, file_path)
+            record_file_hash(file_path, sha256)
+    except BaseException:
+        if os.path.exists(tmp_path):
+            os.remove(tmp_path)
+        raise
+
+    return sha256
+
+async def handle_upload(
+    file: UploadFile,
+    folder: str,
+    extension: str,
+    max_files: int,
+    max_bytes: int,
+    get_lock: Optional[Callable] = None,
+    before_replace: Optional[Callable] = None,
+) -> str:
+    """
+    Stores an uploaded file in `folder` within the file count and size limits (see save_upload for
+    `get_lock` and `before_replace`). Returns the path of the stored file.
+    """
+    filename = os.path.basename(file.filename)
+    await reserve_upload(folder, filename, extension, max_files)
+    try:
+        file_path = os.path.join(folder, filename)
+        await save_upload(file, file_path, max_bytes, get_lock, before_replace)
+    finally:
+        await release_upload(folder, filename)
+    return file_path
@@ -1,26 +1,53 @@
 import os
-from fastapi import FastAPI, UploadFile, File, HTTPException, BackgroundTasks, WebSocket, WebSocketDisconnect, Body, Query
+from fastapi import FastAPI, UploadFile, File, HTTPException, BackgroundTasks, WebSocket, WebSocketDisconnect, Body, Query, Request
 from fastapi.middleware.cors import CORSMiddleware
 import asyncio
 from pydantic import BaseModel
 import openai
-from processors.pdf.process_pdf import search_docs, process_all_pdfs
+from processors.pdf.process_pdf import search_docs
 from dotenv import load_dotenv
 from helpers.csv.helpers import *
 from schemas.variables import *
-from helpers.pdf.helpers import openai_stream_generator, clear_pdf_embeddings
+from helpers.pdf.helpers import (
+    openai_stream_generator, clear_pdf_embeddings, get_corpus_version, is_history_independent,
+    lookup_cached_answer, store_cached_answer, replay_cached_answer
+)
+from helpers.embeddings.helpers import embed_query_cached
 from fastapi.responses import StreamingResponse
-from processors.csv.process_csv import process_all_csvs, get_csv_index_records, process_query, ask_question_about_dataset
-from typing import List
+from processors.csv.process_csv import ask_question_about_dataset, embed_query, search_dataset
+from processors.chat.process_chat import retrieve_unified_context, merge_context, build_unified_messages
+from typing import List, Optional
 from stores.chart_store import chart_data_store
 from fastapi.responses import JSONResponse
+from helpers.metrics.helpers import get_metrics
+from helpers.uploads.helpers import handle_upload, remove_hash_record
+from processors.indexer.background_indexer import enqueue_file, get_file_lock, forget_file, get_indexer_status, process_all_files
+from helpers.admission.helpers import acquire_stream_slot, release_stream_slot, stream_response_with_slot
+from helpers.history.helpers import get_history_messages, add_history_message
 
 load_dotenv()
 openai.api_key = os.getenv("OPENAI_API_KEY")
 
 app = FastAPI()
 
-# improve this part
+# Size limits of the upload endpoints, checked against Content-Length before the body is received
+UPLOAD_SIZE_LIMITS = {"/api/pdf/upload": MAX_PDF_UPLOAD_BYTES, "/api/csv/upload": MAX_CSV_UPLOAD_BYTES}
+
+@app.middleware("http")
+async def limit_upload_size(request: Request, call_next):
+    """
+    Rejects uploads whose declared size exceeds the endpoint's limit with a 413 before the multipart body is
+    spooled. Uploads without Content-Length (chunked) are still stopped by the limit in save_upload.
+    """
+    max_bytes = UPLOAD_SIZE_LIMITS.get(request.url.path)
+    content_length = request.headers.get("content-length", "")
+    if max_bytes is not None and content_length.isdigit() and int(content_length) > max_bytes + UPLOAD_MULTIPART_OVERHEAD_BYTES:
+        return JSONResponse(
+            status_code=413, content={"detail": f"File exceeds the maximum size of {max_bytes // (1024 * 1024)} MB."}
+        )
+    return await call_next(request)
+
+# Added after the size check, so CORS headers are also set on its responses
 app.add_middleware(
     CORSMiddleware,
     allow_origins=["http://localhost:3000"],
@@ -37,6 +64,7 @@ os.makedirs(CSV_UPLOAD_FOLDER, exist_ok=True)
 
 # Dictionary to store chat history per session (Temporary storage)
 pdf_chat_history = {}
+unified_chat_history = {}
 
 async def reset_training_status():
     global TRAINING_STATUS
@@ -49,6 +77,10 @@ class ChatRequest(BaseModel):
     session_id: str
     model: str
 
+class CsvChatRequest(ChatRequest):
+    dataset_id: Optional[str] = None  # Routed automatically when not given
+    filters: Optional[List[dict]] = None  # {"column", "operator", "value"}; extracted from the query when not given
+
 @app.post("/api/pdf/chat")
 async def chat_pdf_endpoint(request: ChatRequest):
     query = request.message
@@ -57,9 +89,25 @@ async def chat_pdf_endpoint(request: ChatRequest):
 
     if session_id not in pdf_chat_history:
         pdf_chat_history[session_id] = []
+    selected_model = selectedModel if selectedModel else "gpt-4o-mini"
+
+    # Embed the query once (cached, off the event loop); it is used both for the answer cache and the document search.
+    query_embedding = await asyncio.to_thread(embed_query_cached, query)
+    corpus_version = get_corpus_version()
+
+    # Questions that don't build on the conversation are answered from the cache when asked before.
+    cacheable = is_history_independent(query, pdf_chat_history[session_id])
+    if cacheable:
+        cached_answer = lookup_cached_answer(query_embedding, selected_model)
+        if cached_answer is not None:
+            add_history_message("pdf", pdf_chat_history, session_id, "user", query)
+            return StreamingResponse(
+                content=replay_cached_answer(cached_answer, session_id, pdf_chat_history),
+                media_type="text/plain"
+            )
 
     # Retrieve relevant documents from ChromaDB
-    retrieved_docs = search_docs(query)
+    retrieved_docs = search_docs(query, mmr_lambda=MMR_LAMBDA, query_embedding=query_embedding)
     context = "\n".join(retrieved_docs)
 
      # Build the base system instructions
@@ -91,57 +139,62 @@ async def chat_pdf_endpoint(request: ChatRequest):
     # Start building the messages list with system instructions and history.
     messages = system_messages
     
-    # Keep only the last 10 messages
-    pdf_chat_history[session_id] = pdf_chat_history[session_id][-10:]
-
-    messages.extend(pdf_chat_history[session_id])  # ✅ Keep conversation history
+    # ✅ Keep conversation history: a running summary of older turns plus the last few messages
+    messages.extend(get_history_messages("pdf", pdf_chat_history, session_id))
     messages.append({"role": "user", "content": user_message})
 
-    response = openai.chat.completions.create(
-        model=selectedModel if selectedModel else "gpt-4o-mini",
-        messages=messages,
-        temperature=0.3,
-        stream=True
-        # store=True # if this is added completion history/messages can be retrieved
-    )
+    # Wait for a free upstream stream, or fail fast with 429/503 and Retry-After when overloaded
+    slot = await acquire_stream_slot(session_id)
+    try:
+        response = openai.chat.completions.create(
+            model=selected_model,
+            messages=messages,
+            temperature=0.3,
+            stream=True
+            # store=True # if this is added completion history/messages can be retrieved
+        )
+    except Exception:
+        release_stream_slot(slot)
+        raise
 
   # ✅ Save user query before streaming response
-    pdf_chat_history[session_id].append({"role": "user", "content": query})
+    add_history_message("pdf", pdf_chat_history, session_id, "user", query)
     print('pdf_chat_history', pdf_chat_history)
 
-    return StreamingResponse(
-        content=openai_stream_generator(response, session_id, pdf_chat_history),
-        media_type="text/plain"
+    return stream_response_with_slot(
+        openai_stream_generator(
+            response, session_id, pdf_chat_history,
+            on_complete=(lambda answer: store_cached_answer(query_embedding, selected_model, answer, corpus_version)) if cacheable else None
+        ),
+        slot
     )
 
 @app.post("/api/pdf/upload")
-async def upload_pdf(file: UploadFile = File(...)):
+async def upload_pdf(
+    file: UploadFile = File(...),
+    auto_ingest: Optional[bool] = Query(None, description="Index the file in the background right after upload"),
+):
     """
     Handles PDF uploads and stores them in the /pdfs folder.
+    With auto-ingest, just this file is queued for the background indexer.
     """
     if not file.filename.endswith(".pdf"):
         raise HTTPException(status_code=400, detail="Only PDF files are allowed.")
-    
-    # Check how many PDFs are already in the folder
-    try:
-        files = os.listdir(PDF_UPLOAD_FOLDER)
-        pdf_files = [f for f in files if f.endswith(".pdf")]
-    except Exception as e:
-        raise HTTPException(status_code=500, detail=str(e))
 
-    if len(pdf_files) >= 5:
-        raise HTTPException(status_code=400, detail="Maximum of 5 PDFs allowed.")
-
-
-    file_path = os.path.join(PDF_UPLOAD_FOLDER, file.filename)
-
-    # Save the uploaded file
-    with open(file_path, "wb") as buffer:
-        buffer.write(await file.read())
+    # Stream the uploaded file to disk within the file count and size limits. The file is replaced under its
+    # file lock, and a replaced PDF's old vectors are cleared first so its old content stops being searchable.
+    file_path = await handle_upload(
+        file, PDF_UPLOAD_FOLDER, ".pdf", MAX_PDF_FILES, MAX_PDF_UPLOAD_BYTES,
+        get_lock=get_file_lock, before_replace=clear_pdf_embeddings
+    )
 
     await reset_training_status()
 
-    return {"message": "File uploaded successfully!", "filename": file.filename}
+    response = {"message": "File uploaded successfully!", "filename": file.filename}
+    if AUTO_INGEST_ON_UPLOAD if auto_ingest is None else auto_ingest:
+        await enqueue_file("pdf", file_path)
+        response["indexing"] = "queued"
+    return response
 
 @app.get("/api/pdf/list", response_model=List[str])
 async def list_pdfs():
@@ -170,19 +223,23 @@ async def delete_pdf(filename: str = Query(..., description="Name of the PDF fil
     if not os.path.exists(file_path):
         raise HTTPException(status_code=404, detail="File not found.")
     
-    # Clear embeddings associated with the PDF.
-    try:
-        clear_pdf_embeddings(file_path)
-    except Exception as e:
-        # Log the error. Optionally, you can raise an HTTPException if failing to clear embeddings should block deletion.
-        print(f"Error clearing embeddings for {file_path}: {e}")
-    
-    # Delete the PDF file from storage.
-    try:
-        os.remove(file_path)
-    except Exception as e:
-        raise HTTPException(status_code=500, detail=str(e))
-    
+    # Wait for a background indexing run of this file, so its vectors are complete before they are cleared.
+    async with get_file_lock(file_path):
+        # Clear embeddings associated with the PDF.
+        try:
+            clear_pdf_embeddings(file_path)
+        except Exception as e:
+            # Log the error. Optionally, you can raise an HTTPException if failing to clear embeddings should block deletion.
+            print(f"Error clearing embeddings for {file_path}: {e}")
+
+        # Delete the PDF file from storage.
+        try:
+            os.remove(file_path)
+            remove_hash_record(file_path)
+        except Exception as e:
+            raise HTTPException(status_code=500, detail=str(e))
+    forget_file(file_path)
+
     await reset_training_status()
     
     return {"message": "File deleted successfully!", "filename": safe_filename}
@@ -210,10 +267,9 @@ async def train_process(file_type: str, chunk_size: int = 200):
     await send_status_updates()
 
     try:
-        if file_type.lower() == "pdf":
-            result = await asyncio.to_thread(process_all_pdfs, chunk_size)
-        elif file_type.lower() == "csv":
-            result = await asyncio.to_thread(process_all_csvs, chunk_size)  
+        if file_type.lower() in ("pdf", "csv"):
+            # Each file is processed under its file lock, so training never races the background indexer.
+            result = await process_all_files(file_type.lower(), chunk_size)
         else:
             raise ValueError("Invalid file type provided. Allowed values are 'pdf' or 'csv'.")
         
@@ -261,6 +317,13 @@ async def get_training_status():
     """
     return TRAINING_STATUS
 
+@app.get("/api/index/status")
+async def get_index_status():
+    """
+    Returns the status of the background indexer: queued files and the latest result per uploaded file.
+    """
+    return get_indexer_status()
+
 @app.websocket("/api/train/ws")
 async def websocket_endpoint(websocket: WebSocket):
     """
@@ -315,32 +378,30 @@ async def set_api_key(api_key: str = Body(..., embed=True)):
     return {"message": "API key saved successfully!"}
 
 @app.post("/api/csv/upload")
-async def upload_csv(file: UploadFile = File(...)):
+async def upload_csv(
+    file: UploadFile = File(...),
+    auto_ingest: Optional[bool] = Query(None, description="Index the file in the background right after upload"),
+):
     """
     Handles CSV uploads and stores them in the /datasets folder.
+    With auto-ingest, just this dataset is queued for the background indexer.
     """
     if not file.filename.endswith(".csv"):
         raise HTTPException(status_code=400, detail="Only CSV files are allowed.")
-    
-    # Check how many CSVs are already in the folder
-    try:
-        files = os.listdir(CSV_UPLOAD_FOLDER)
-        csv_files = [f for f in files if f.endswith(".csv")]
-    except Exception as e:
-        raise HTTPException(status_code=500, detail=str(e))
 
-    if len(csv_files) >= 1:
-        raise HTTPException(status_code=400, detail="Maximum of 1 CSV file is allowed.")
-
-    file_path = os.path.join(CSV_UPLOAD_FOLDER, file.filename)
-
-    # Save the uploaded file
-    with open(file_path, "wb") as buffer:
-        buffer.write(await file.read())
+    # Stream the uploaded file to disk within the file count and size limits, replacing it under its file lock
+    file_path = await handle_upload(
+        file, CSV_UPLOAD_FOLDER, ".csv", MAX_CSV_DATASETS, MAX_CSV_UPLOAD_BYTES, get_lock=get_file_lock
+    )
 
+    invalidate_dataset_cache()
     await reset_training_status()
 
-    return {"message": "File uploaded successfully!", "filename": file.filename}
+    response = {"message": "File uploaded successfully!", "filename": file.filename, "dataset_id": get_dataset_id(file_path)}
+    if AUTO_INGEST_ON_UPLOAD if auto_ingest is None else auto_ingest:
+        await enqueue_file("csv", file_path)
+        response["indexing"] = "queued"
+    return response
 
 @app.get("/api/csv/list", response_model=List[str])
 async def list_csvs():
@@ -367,52 +428,121 @@ async def delete_csv(filename: str = Query(..., description="Name of the CSV fil
     if not os.path.exists(file_path):
         raise HTTPException(status_code=404, detail="File not found.")
     
-    # Clear embeddings associated with the CSV.
-    try:
-        reset_faiss_index()
-    except Exception as e:
-        # Log the error. Optionally, raise an HTTPException if needed.
-        print(f"Error resseting faiss index: {e}")
-    
-    # Delete the CSV file from storage.
-    try:
-        os.remove(file_path)
-    except Exception as e:
-        raise HTTPException(status_code=500, detail=str(e))
-    
+    # Wait for a background indexing run of this dataset, so it cannot recreate the index afterwards.
+    async with get_file_lock(file_path):
+        # Clear embeddings associated with the CSV.
+        try:
+            reset_faiss_index(get_dataset_id(file_path))
+        except Exception as e:
+            # Log the error. Optionally, raise an HTTPException if needed.
+            print(f"Error resseting faiss index: {e}")
+
+        try:
+            remove_dataset_snapshot(file_path)
+        except Exception as e:
+            print(f"Error removing snapshot: {e}")
+
+        # Delete the CSV file from storage.
+        try:
+            os.remove(file_path)
+            remove_hash_record(file_path)
+        except Exception as e:
+            raise HTTPException(status_code=500, detail=str(e))
+    forget_file(file_path)
+
+    invalidate_dataset_cache()
     await reset_training_status()
     
     return {"message": "File deleted successfully!", "filename": safe_filename} 
 
+@app.get("/api/csv/datasets")
+async def list_csv_datasets():
+    """
+    Lists the CSV datasets with their IDs, whether they have been processed and, for compressed
+    indices, the report of memory saved versus recall lost.
+    """
+    return [
+        {
+            "dataset_id": dataset_id,
+            "filename": f"{dataset_id}.csv",
+            "processed": is_dataset_indexed(dataset_id),
+            "compression": load_compression_report(dataset_id),
+        }
+        for dataset_id in list_dataset_ids()
+    ]
+
 @app.post("/api/csv/chat")
-async def chat_csv_endpoint(request: ChatRequest):
+async def chat_csv_endpoint(request: CsvChatRequest):
     """
     Answers a chat query using the stored FAISS index and text records in streaming mode.
+    The query runs against the selected dataset, or the dataset whose centroid is closest to the query.
     """
     session_id = request.session_id
     selected_model = request.model or "gpt-4o-mini"
     query = request.message
 
-    # Load the FAISS index and text records
-    faiss_index, text_records = get_csv_index_records()
-
-    # Perform vector search to find top matching chunks
-    distances, indices = process_query(query, faiss_index, k=5)
-    if distances is None or indices is None:
+    # Embed the query once (cached, off the event loop); it is used both for routing and for the vector search.
+    query_embedding = await asyncio.to_thread(embed_query, query)
+    if query_embedding is None:
         raise HTTPException(status_code=500, detail="Error processing query.")
 
-    # Debug output: print similar results
-    print("Top similar results from vector search:")
-    for rank, (idx, dist) in enumerate(zip(indices[0], distances[0]), start=1):
-        print(f"{rank}. Index: {idx}, Distance: {dist}")
+    if request.dataset_id is not None and request.dataset_id not in list_dataset_ids():
+        raise HTTPException(status_code=404, detail=f"CSV dataset '{request.dataset_id}' not found.")
 
-    # Extract corresponding text chunks based on FAISS indices
-    selected_chunks = [text_records[i] for i in indices[0]]
+    # Search the selected or routed dataset, restricted to the rows matching the explicit or extracted filters
+    dataset_id, selected_chunks = search_dataset(query, query_embedding, request.dataset_id, request.filters)
+    if dataset_id is None:
+        raise HTTPException(status_code=400, detail="CSV not processed yet. Please process the CSV file first.")
 
-    # Use the streaming version of ask_question_about_dataset
-    stream_generator = ask_question_about_dataset(selected_chunks, query, session_id, model=selected_model)
+    # Use the streaming version of ask_question_about_dataset, holding an upstream stream slot until it ends
+    slot = await acquire_stream_slot(session_id)
+    stream_generator = ask_question_about_dataset(selected_chunks, query, session_id, model=selected_model, dataset_id=dataset_id)
     
-    return StreamingResponse(stream_generator, media_type="text/plain")
+    return stream_response_with_slot(stream_generator, slot)
+
+@app.post("/api/chat")
+async def chat_endpoint(request: CsvChatRequest):
+    """
+    Answers a chat query from both the PDF documents and the CSV datasets in one streamed answer.
+    The query is embedded once, both stores are searched in parallel, and the results share one context budget.
+    """
+    session_id = request.session_id
+    selected_model = request.model or "gpt-4o-mini"
+    query = request.message
+
+    if request.dataset_id is not None and request.dataset_id not in list_dataset_ids():
+        raise HTTPException(status_code=404, detail=f"CSV dataset '{request.dataset_id}' not found.")
+
+    try:
+        query_embedding = await asyncio.to_thread(embed_query_cached, query)
+    except Exception as e:
+        print(f"Error generating query embedding: {e}")
+        raise HTTPException(status_code=500, detail="Error processing query.")
+
+    pdf_chunks, csv_chunks = await retrieve_unified_context(query, query_embedding, request.dataset_id, request.filters)
+    pdf_chunks, csv_chunks = merge_context(pdf_chunks, csv_chunks)
+    messages = build_unified_messages(
+        query, pdf_chunks, csv_chunks, get_history_messages("unified", unified_chat_history, session_id)
+    )
+
+    # Wait for a free upstream stream, or fail fast with 429/503 and Retry-After when overloaded
+    slot = await acquire_stream_slot(session_id)
+    try:
+        response = openai.chat.completions.create(
+            model=selected_model,
+            messages=messages,
+            temperature=0.3,
+            stream=True
+        )
+    except Exception:
+        release_stream_slot(slot)
+        raise
+
+    add_history_message("unified", unified_chat_history, session_id, "user", query)
+
+    return stream_response_with_slot(
+        openai_stream_generator(response, session_id, unified_chat_history, chat="unified"), slot
+    )
 
 @app.get("/api/csv/chart-data/{session_id}")
 async def get_chart_data(session_id: str):
@@ -424,4 +554,11 @@ async def get_chart_data(session_id: str):
     if not chart_data:
         return JSONResponse(content={"detail": "Chart data not found for this session."}, status_code=200)
     
-    return JSONResponse(content=chart_data)
\ No newline at end of file
+    return JSONResponse(content=chart_data)
+
+@app.get("/api/metrics")
+async def get_runtime_metrics():
+    """
+    Returns the recorded runtime metrics, such as per-tool execution timings.
+    """
+    return get_metrics()
\ No newline at end of file
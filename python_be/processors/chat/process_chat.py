@@ -0,0 +1,89 @@
+import time
+import asyncio
+import numpy as np
+from typing import Optional
+from fastapi import HTTPException
+from schemas.variables import *
+from helpers.pdf.helpers import search_docs
+from helpers.metrics.helpers import record_timing
+from processors.csv.process_csv import search_dataset
+
+def estimate_tokens(text: str) -> int:
+    return len(text) // UNIFIED_CHARS_PER_TOKEN + 1
+
+async def run_search(name: str, search, *args, **kwargs):
+    """Runs a blocking search in a worker thread, recording its duration."""
+    start = time.perf_counter()
+    try:
+        return await asyncio.to_thread(search, *args, **kwargs)
+    finally:
+        record_timing(f"unified_chat.{name}", (time.perf_counter() - start) * 1000)
+
+async def retrieve_unified_context(query: str, query_embedding: list, dataset_id: Optional[str] = None, filters: Optional[list] = None):
+    """
+    Searches the PDF and CSV corpora concurrently with the same query embedding, so retrieval takes
+    as long as the slower of the two searches. Returns (pdf_chunks, csv_chunks), each ranked best first.
+    A corpus that is not processed yet or fails to search contributes no chunks; invalid CSV requests
+    (an unknown dataset, bad filters) raise their HTTPException.
+    """
+    start = time.perf_counter()
+    pdf_result, csv_result = await asyncio.gather(
+        run_search(
+            "pdf_search", search_docs, query, top_k=UNIFIED_PDF_TOP_K, mmr_lambda=MMR_LAMBDA, query_embedding=query_embedding
+        ),
+        run_search(
+            "csv_search", search_dataset, query, np.asarray(query_embedding, dtype='float32').reshape(1, -1),
+            dataset_id, filters, k=UNIFIED_CSV_TOP_K
+        ),
+        return_exceptions=True,
+    )
+    record_timing("unified_chat.retrieval", (time.perf_counter() - start) * 1000)
+
+    if isinstance(csv_result, HTTPException) and csv_result.status_code < 500:
+        raise csv_result
+    if isinstance(pdf_result, BaseException):
+        print(f"[ERROR] PDF search failed: {pdf_result}")
+        pdf_result = []
+    if isinstance(csv_result, BaseException):
+        print(f"[ERROR] CSV search failed: {csv_result}")
+        csv_result = (None, [])
+
+    selected_dataset, csv_chunks = csv_result
+    print(f"Unified retrieval: {len(pdf_result)} PDF chunks, {len(csv_chunks)} CSV chunks (dataset {selected_dataset}).")
+    return pdf_result, csv_chunks
+
+def merge_context(pdf_chunks: list, csv_chunks: list, token_budget: int = UNIFIED_CONTEXT_TOKENS):
+    """
+    Fits the chunks of both corpora into one token budget. Scores of the two stores are not comparable,
+    so the chunks are taken by rank, alternating between the corpora; chunks that no longer fit are skipped.
+    Returns the selected (pdf_chunks, csv_chunks).
+    """
+    selected = {"pdf": [], "csv": []}
+    remaining = token_budget
+    for rank in range(max(len(pdf_chunks), len(csv_chunks))):
+        for source, chunks in (("pdf", pdf_chunks), ("csv", csv_chunks)):
+            if rank < len(chunks):
+                cost = estimate_tokens(chunks[rank])
+                if cost <= remaining:
+                    selected[source].append(chunks[rank])
+                    remaining -= cost
+    return selected["pdf"], selected["csv"]
+
+def build_unified_messages(query: str, pdf_chunks: list, csv_chunks: list, history: list) -> list:
+    """Builds the prompt of a unified chat answer from the merged context of both corpora and the conversation history."""
+    if pdf_chunks or csv_chunks:
+        system_message = (
+            "You are an AI assistant that answers questions from the provided PDF documents and CSV data rows. "
+            "Combine both sources when the question needs it, and do not answer outside the given context. "
+            "If no relevant information is found, say: 'I am sorry. I don't have knowledge over what you ask.'"
+        )
+    else:
+        system_message = (
+            "You are an AI assistant. Currently, there is no context provided from any documents or datasets. "
+            "Instruct the user to train you on the subject, for example: "
+            "'I don't have any context to answer this query. Please provide training materials on this topic and try again.'"
+        )
+    documents = "\n".join(pdf_chunks) or "No relevant documents found."
+    rows = "\n\n".join(csv_chunks) or "No relevant data rows found."
+    user_message = f"User query: {query}\n\nRelevant documents:\n{documents}\n\nRelevant data rows:\n{rows}"
+    return [{"role": "system", "content": system_message}] + history + [{"role": "user", "content": user_message}]
@@ -1,84 +1,89 @@
 import openai
 import json
+import time
+import asyncio
 import numpy as np
+from concurrent.futures import ThreadPoolExecutor
 from helpers.csv.helpers import *
+from helpers.metrics.helpers import record_timing
 from schemas.variables import *
 from schemas.tools import tools
 from fastapi import HTTPException
 from helpers.csv.helpers import stream_openai_response
+from helpers.embeddings.helpers import embed_query_cached, mmr_select
+from helpers.history.helpers import get_history_messages, add_history_message
 
-async def augment_summary_with_description(summary, query: str, model: str):
-    """
-    Calls the LLM in streaming mode to provide a concise explanation of the summary.
-    Yields chunks as they are received.
-    """
-    # Convert to string if needed.
-    summary_str = summary.to_string() if hasattr(summary, "to_string") else str(summary)
-    
-    prompt = (
-        "Below is a dataset summary. When analyzing a dataset, always focus on **categorical distributions, trends, and frequency insights** first. " +
-        "Only provide numerical statistics (such as min, max, or mean) if the user explicitly requests them.\n\n" +
-        "- For a **categorical column**, retrieve insights such as category distributions, unique values, and the most/least frequent values.\n" +
-        "- For a **numeric column**, first check if the data can be grouped into meaningful categories and then provide categorical insights (such as frequency patterns).\n" +
-        "Do not suggest generating charts for numeric columns.\n" +
-        "- **Only if the user explicitly asks for \"minimum\", \"maximum\", \"mean\", or \"average\" should you call the `get_min_max_mean` tool.** Otherwise, focus on the categorical analysis.\n\n" +
-        "If the user query mentions a specific column, call the `create_category_aggregates` tool with that column as the 'column_of_interest'." +
-        "If no specific column is mentioned, call the `create_category_aggregates` tool to compute aggregates for all columns.\n\n" +
-        "Summary of the dataset:\n" +
-        f"{summary_str}\n\n" +
-        "Based on the above data, explain the key insights. " +
-        "Do NOT include the raw table data in your response. " +
-        "Only include the raw table data if the user explicitly requests it (for example, using phrases like \"raw data\" or \"raw table\").\n\n" +
-        f"User Query: {query}\n" +
-        "Your explanation:"
-    )
+# Worker pool shared by all CSV tool calls
+tool_executor = ThreadPoolExecutor(max_workers=TOOL_MAX_WORKERS)
 
-    
-    response = openai.chat.completions.create(
-        model=model,
-        messages=[
-            {"role": "system", "content": (
-                "You are a helpful data analysis assistant. When providing insights based on summary tables, "
-                "offer a concise explanation without including the raw table data unless explicitly requested by the user."
-            )},
-            {"role": "user", "content": prompt}
-        ],
-        stream=True,
-        temperature=0.3
-    )
-    
-    async for chunk in stream_openai_response(response):
-        yield chunk
+TOOL_RESULTS_INSTRUCTIONS = (
+    "You now have the results of the data tools you called. Answer the user's query based solely on them.\n"
+    "- When analyzing a dataset, focus on **categorical distributions, trends, and frequency insights** first. "
+    "Only provide numerical statistics (such as min, max, or mean) if the user explicitly requests them.\n"
+    "- For a **categorical column**, give insights such as category distributions, unique values, and the most/least frequent values.\n"
+    "- For a **cross-tabulation**, explain the relationship between the two columns in terms of frequency and patterns.\n"
+    "- For a **query result**, answer directly and precisely, quoting the relevant numbers.\n"
+    "Do not suggest generating charts for numeric columns. "
+    "Do NOT include the raw table data in your response unless the user explicitly requests it "
+    "(for example, using phrases like \"raw data\" or \"raw table\")."
+)
 
-async def explain_comparison(comparison_result: str, column1: str, column2: str, query: str, model: str):
+def execute_tool_call(tool_call: dict, query: str, session_id: str, csv_path: str) -> dict:
     """
-    Streams a concise explanation comparing two columns based on cross-tabulated data.
-    Yields chunks as they are received.
+    Runs a single tool call requested by the model against the CSV file at `csv_path`, including any
+    chart data it should store, and returns its result as a tool message. The execution time is recorded per tool.
     """
-    prompt = (
-        f"Below is a cross-tabulation between the '{column1}' and '{column2}' columns of a dataset.\n"
-        "Use this data to provide a concise explanation comparing the two columns in terms of frequency, patterns, or relationships.\n"
-        "Do NOT output the raw cross-tabulated data; only provide a summary explanation that accurately answers the query.\n"
-        f"User Query: {query}\n"
-        f"Cross-Tabulation Data:\n{comparison_result}\n"
-        "Your explanation:"
-    )
-    
-    response = openai.chat.completions.create(
-        model=model,
-        messages=[
-            {"role": "system", "content": (
-                "You are a helpful data analysis assistant. When comparing two dataset columns, provide a concise, insightful explanation of the relationship between the columns. "
-                "Do not include the raw cross-tabulation data in your final response."
-            )},
-            {"role": "user", "content": prompt}
-        ],
-        stream=True,
-        temperature=0.3
-    )
-    
-    async for chunk in stream_openai_response(response):
-        yield chunk
+    function_name = tool_call["function"]["name"]
+    start = time.perf_counter()
+    try:
+        arguments = json.loads(tool_call["function"]["arguments"] or "{}")
+        if arguments.get("csv_path"):
+            arguments["csv_path"] = csv_path
+
+        if arguments.get("encoding"):
+            # Served from the snapshot or dataset cache; only detected on the first parse of the file.
+            arguments["encoding"] = get_dataset_encoding(csv_path)
+
+        if function_name == "get_min_max_mean":
+            content = get_min_max_mean(**arguments).to_string()
+
+            if should_show_barchart(query):
+                bar_chart_data = generate_bar_chart_data_for_numeric_summary(arguments["csv_path"], session_id)
+                if bar_chart_data:
+                    print("Chart data generated:", bar_chart_data)
+                else:
+                    print("No chart data generated.")
+        elif function_name == "create_category_aggregates":
+            numeric_df, categorical_df = create_category_aggregates(**arguments)
+
+            # Create a summary text combining both numeric and categorical aggregates.
+            content = (
+                "Numeric Aggregates:\n" + numeric_df.to_string() +
+                "\n\nCategorical Aggregates:\n" + categorical_df.to_string()
+            )
+
+            # If the user requested charts, compute and store the chart data before answering.
+            if should_show_piechart(query):
+                chart_data = generate_pie_chart_data(
+                    arguments.get("csv_path"), arguments["encoding"], arguments.get("column_of_interest"), session_id
+                )
+                if chart_data:
+                    print("Chart data generated:", chart_data)
+                else:
+                    print("No chart data generated.")
+        elif function_name == "compare_columns":
+            content = compare_columns(**arguments)
+        elif function_name == "query_dataset":
+            content = query_dataset(**arguments)
+        else:
+            content = f"Unknown function called: {function_name}"
+    except Exception as e:
+        content = f"Error processing tool call: {str(e)}"
+
+    elapsed_ms = (time.perf_counter() - start) * 1000
+    record_timing(f"csv_tool.{function_name}", elapsed_ms)
+    print(f"⏱️ Tool {function_name} finished in {elapsed_ms:.1f} ms", flush=True)
+    return {"role": "tool", "tool_call_id": tool_call["id"], "content": content}
 
 
 # Global conversation memory for CSV chat
@@ -89,11 +94,15 @@ async def ask_question_about_dataset(
     query: str, 
     session_id: str, 
     model: str = "gpt-4o-mini", 
-    temperature: float = 0.3
+    temperature: float = 0.3,
+    dataset_id: Optional[str] = None
 ):
     """
     Builds the prompt by combining system instructions, conversation history, and the current query.
-    Then it calls OpenAI's ChatCompletion API (with tool support) and yields the answer.
+    Then it streams OpenAI's ChatCompletion API (with tool support) and yields the answer as it arrives.
+    Tool calls are assembled from the stream and each one starts in the worker pool as soon as it
+    is complete; their results are sent back as tool messages in a single streamed follow-up completion.
+    Tools run against the CSV file of `dataset_id` (the first dataset if not given).
     Updates the conversation memory with both the user query and assistant's answer.
     """
     # Build context from selected chunks.
@@ -106,6 +115,9 @@ async def ask_question_about_dataset(
             "You are a helpful assistant. When you receive queries that ask about trends—such as which category is used most or least often, "
             "or questions regarding frequency or averages—first use the available functions (like get_min_max_mean and create_category_aggregates) "
             "to retrieve data from the CSV file, then base your answer solely on that data. "
+            "For exact totals, averages, counts or rankings over the data (optionally filtered or grouped), "
+            "use query_dataset instead of reasoning over the sample rows provided. "
+            "You may call several functions at once when the query needs more than one. "
             "Do not include raw table data in your final answer unless the user explicitly requests it."
         )
     }
@@ -116,161 +128,355 @@ async def ask_question_about_dataset(
         "content": f"Answer the following query based on the provided text:\n\n{context}\n\nQuery: {query}\nAnswer:"
     }
     
-    # Retrieve the existing history for this session (limit to the last 10 messages).
-    history = csv_chat_history.get(session_id, [])[-10:]
+    # Retrieve the history for this session: a running summary of older turns plus the last few messages.
+    history = get_history_messages("csv", csv_chat_history, session_id)
     
     # Build the full messages payload.
     messages = [system_message] + history + [user_message]
     
     # Append the current user query to the conversation history.
-    csv_chat_history.setdefault(session_id, []).append({"role": "user", "content": query})
+    add_history_message("csv", csv_chat_history, session_id, "user", query)
     
-    # Make the initial (synchronous) call to OpenAI.
+    # Stream the initial call to OpenAI: content goes straight to the user while tool calls are assembled.
     response = openai.chat.completions.create(
         model=model,
         messages=messages,
         temperature=temperature, # not supported in o series reasoning models
-        tools=tools  # Pass tool configuration if needed.
+        tools=tools,  # Pass tool configuration if needed.
+        stream=True
     )
     
     full_response = ""
+    csv_path = get_csv_path(dataset_id)
+    loop = asyncio.get_running_loop()
+    tool_calls = []     # Tool calls assembled from the streamed deltas
+    tool_results = []   # Futures of tool calls already running in the worker pool
+
+    def start_tool_call(tool_call):
+        tool_results.append(loop.run_in_executor(tool_executor, execute_tool_call, tool_call, query, session_id, csv_path))
+
+    try:
+        for chunk in response:
+            if not chunk.choices:
+                continue
+            delta = chunk.choices[0].delta
+            if delta.content:
+                full_response += delta.content
+                yield delta.content
+
+            for tool_call_delta in delta.tool_calls or []:
+                if tool_call_delta.index >= len(tool_calls):
+                    # A new call starts, so the previous one is complete and can run right away.
+                    if tool_calls:
+                        start_tool_call(tool_calls[-1])
+                    tool_calls.append({"id": "", "type": "function", "function": {"name": "", "arguments": ""}})
+                tool_call = tool_calls[tool_call_delta.index]
+                if tool_call_delta.id:
+                    tool_call["id"] = tool_call_delta.id
+                if tool_call_delta.function:
+                    tool_call["function"]["name"] += tool_call_delta.function.name or ""
+                    tool_call["function"]["arguments"] += tool_call_delta.function.arguments or ""
+
+        # If tool calls exist, wait for all of them and stream the follow-up response.
+        if tool_calls:
+            start_tool_call(tool_calls[-1])
+            print('tool_calls ->', tool_calls)
+            tool_messages = await asyncio.gather(*tool_results)
+
+            assistant_message = {"role": "assistant", "content": full_response or None, "tool_calls": tool_calls}
+            follow_up = openai.chat.completions.create(
+                model=model,
+                messages=messages + [assistant_message] + list(tool_messages) + [{"role": "system", "content": TOOL_RESULTS_INSTRUCTIONS}],
+                temperature=temperature,
+                stream=True
+            )
+            async for subchunk in stream_openai_response(follow_up):
+                full_response += subchunk
+                yield subchunk
+    except Exception as e:
+        yield f"Error processing query: {str(e)}"
     
-    # If a tool call exists, process it and stream the follow-up response.
-    if response.choices[0].message.tool_calls:
-        try:
-            tool_call = response.choices[0].message.tool_calls[0]
-            print('tool_call ->', tool_call)
-            function_name = tool_call.function.name
-            arguments_json = tool_call.function.arguments
-            arguments = json.loads(arguments_json)
-            if arguments.get("csv_path"):
-                arguments["csv_path"] = get_csv_path()
-
-            if arguments.get("encoding"):
-                arguments["encoding"] = detect_encoding(get_csv_path())
-            
-            # Based on the tool call, stream the follow-up answer.
-            if function_name == "get_min_max_mean":
-                res = get_min_max_mean(**arguments)
-
-                if should_show_barchart(query):
-                    bar_chart_data = generate_bar_chart_data_for_numeric_summary(arguments["csv_path"], session_id)
-                    if bar_chart_data:
-                        print("Chart data generated:", bar_chart_data)
-                    else:
-                        print("No chart data generated.")
-                async for subchunk in augment_summary_with_description(res, query, model):
-                    full_response += subchunk
-                    yield subchunk
-            elif function_name == "create_category_aggregates":
-                res = create_category_aggregates(**arguments)
-                numeric_df = res[0]
-                categorical_df = res[1]
-
-                # Create a summary text combining both numeric and categorical aggregates.
-                summary_text = (
-                    "Numeric Aggregates:\n" + numeric_df.to_string() +
-                    "\n\nCategorical Aggregates:\n" + categorical_df.to_string()
-                )
-                
-                # If the user requested charts, compute and store the chart data BEFORE streaming text.
-                if should_show_piechart(query):
-                    csv_path = arguments.get("csv_path")
-                    column_of_interest = arguments.get("column_of_interest")
-                    encoding = arguments["encoding"]
-                    
-                    chart_data = generate_pie_chart_data(csv_path, encoding, column_of_interest, session_id)
-                    if chart_data:
-                        print("Chart data generated:", chart_data)
-                    else:
-                        print("No chart data generated.")
-                
-                async for subchunk in augment_summary_with_description(summary_text, query, model):
-                    full_response += subchunk
-                    yield subchunk
-            elif function_name == "compare_columns":
-                res = compare_columns(**arguments)
-                async for subchunk in explain_comparison(res, arguments["column1"], arguments["column2"], query, model):
-                    full_response += subchunk
-                    yield subchunk
-            else:
-                yield "Unknown function called."
-        except Exception as e:
-            yield f"Error processing tool call: {str(e)}"
-    else:
-        # No tool call; yield the full answer directly.
-        answer = response.choices[0].message.content
-        full_response = answer
-        yield answer
-    
-    # Update chat history with the assistant's answer.
-    csv_chat_history[session_id].append({"role": "assistant", "content": full_response})
-    # Optionally, limit the history to a maximum number of messages (e.g., last 12 entries).
-    csv_chat_history[session_id] = csv_chat_history[session_id][-12:]
+    # Update chat history with the assistant's answer; older turns are summarized in the background.
+    add_history_message("csv", csv_chat_history, session_id, "assistant", full_response)
 
 
 
 def process_csv(csv_path, chunk_size):
     """
     Processes the uploaded CSV file for training by ensuring that the FAISS index and associated text records are ready.
-    If the CSV file has already been processed (i.e., the FAISS index and text records exist), it loads them and returns a flat
-    response indicating that the CSV was skipped. Otherwise, it cleans the CSV data, chunks it, generates embeddings, builds a new
-    FAISS index, and saves the results.
+    Every CSV is a separate dataset whose index, text records, profile and centroid are stored under
+    CSV_INDEX_DIRECTORY/<dataset_id>/.
+    The index is tagged with the CSV's content hash and per-row hashes. If the content hash (and the configured
+    vector compression) is unchanged it returns a flat response indicating that the CSV was skipped. If the CSV only gained rows, just the new rows
+    are embedded and appended to the index. Otherwise, it cleans the CSV data, chunks it, generates embeddings,
+    builds a new FAISS index, and saves the results. Embeddings are checkpointed while they are generated,
+    so re-running an interrupted ingestion only embeds the rows that were not embedded yet.
+
+    Rows whose embeddings fail are left out of the index, which is then saved without the content hash,
+    so training again embeds just those rows; the status is "error" in that case.
 
     Returns a dictionary with:
       - "status": "skipped", "processed", or "error"
       - "message": A descriptive message about the processing outcome.
     """
     filename = os.path.basename(csv_path)
+    dataset_id = get_dataset_id(csv_path)
+    index_path = get_index_path(dataset_id)
+    text_records_path = get_text_records_path(dataset_id)
+
+    content_hash = get_file_hash(csv_path)
+    manifest = load_index_manifest(dataset_id) if is_dataset_indexed(dataset_id) else None
+    if manifest is not None and manifest.get("compression") != get_compression_spec():
+        print("\n🔹 Vector compression setting changed, the FAISS index will be rebuilt.")
+        manifest = None
 
-    if os.path.exists(INDEX_FILE) and os.path.exists(TEXT_RECORDS_FILE):
-        print("\n🔹 Loading existing FAISS Index and text records...")
-        # Load index and records (for internal use) but do not return them in this function.
-        faiss_index = faiss.read_index(INDEX_FILE)
-        with open(TEXT_RECORDS_FILE, "r") as f:
-            text_records = json.load(f)
-        print(f"✅ FAISS index loaded with {faiss_index.ntotal} embeddings.")
+    if manifest is not None and manifest.get("content_hash") == content_hash:
+        print(f"\n🔹 FAISS index is up to date with {manifest.get('num_rows')} rows.")
+        if read_snapshot_metadata(csv_path) is None:
+            write_dataset_snapshot(csv_path)
+        get_dataset_profile(csv_path)
         message = f"✅ Skipping {filename}: Already processed."
         return {"status": "skipped", "message": message}
-    else:
-        print("\n🔹 Detecting CSV encoding...")
-        encoding = detect_encoding(csv_path)
-        print(f"✅ Detected encoding: {encoding}")
 
-        print("\n🔹 Cleaning Data...")
-        clean_df = prepare_clean_data(csv_path, encoding=encoding)
-        print(f"✅ Cleaned DataFrame with {len(clean_df)} rows.")
-    
-        print("\n🔹 Chunking Data...")
-        json_chunks = chunk_dataframe(clean_df, chunk_size, int(chunk_size / 50))
-        print(f"✅ Created {len(json_chunks)} chunks.")
-    
-        print("\n🔹 Generating Embeddings and text records...")
-        embeddings, text_records = create_embeddings_from_chunks(json_chunks)
-        print(f"✅ Total Embeddings Created: {len(embeddings)}", flush=True)
-    
-        print("\n🔹 Building FAISS Index...")
-        try:
-            faiss_index = build_faiss_index(embeddings)
-            print(f"✅ FAISS index now contains {faiss_index.ntotal} embeddings.", flush=True)
-            # Save the index and text records for future runs
-            faiss.write_index(faiss_index, INDEX_FILE)
-            print(f"✅ FAISS index saved to {INDEX_FILE}", flush=True)
-            with open(TEXT_RECORDS_FILE, "w") as f:
-                json.dump(text_records, f)
-            print(f"✅ Text records saved to {TEXT_RECORDS_FILE}", flush=True)
-        except Exception as ve:
-            error_message = f"Error building FAISS index: {ve}"
-            print(error_message)
-            return {"status": "error", "message": error_message}
-    
+    print("\n🔹 Detecting CSV encoding...")
+    encoding = detect_encoding(csv_path)
+    print(f"✅ Detected encoding: {encoding}")
+
+    print("\n🔹 Writing columnar snapshot...")
+    write_dataset_snapshot(csv_path, encoding)
+
+    print("\n🔹 Profiling dataset...")
+    write_dataset_profile(csv_path)
+
+    if manifest is not None:
+        result = append_csv_rows(csv_path, encoding, chunk_size, content_hash)
+        if result is not None:
+            return result
+        print("\n🔹 Rows were changed or removed, rebuilding the FAISS index...")
+
+    if os.path.getsize(csv_path) > CSV_STREAMING_THRESHOLD_BYTES:
+        return process_csv_streaming(csv_path, encoding, chunk_size, content_hash)
+
+    print("\n🔹 Cleaning Data...")
+    clean_df = prepare_clean_data(csv_path, encoding=encoding)
+    print(f"✅ Cleaned DataFrame with {len(clean_df)} rows.")
+
+    print("\n🔹 Chunking Data...")
+    text_chunks = chunk_dataframe(clean_df, chunk_size)
+    print(f"✅ Created {len(text_chunks)} chunks.")
+
+    print("\n🔹 Generating Embeddings and text records...")
+    embeddings, text_records, row_positions, dropped_rows = create_embeddings_from_chunks(
+        text_chunks, chunk_row_positions(clean_df, chunk_size), dataset_id
+    )
+    print(f"✅ Total Embeddings Created: {len(embeddings)}", flush=True)
+
+    print("\n🔹 Building FAISS Index...")
+    try:
+        faiss_index = build_faiss_index(embeddings)
+        print(f"✅ FAISS index now contains {faiss_index.ntotal} embeddings.", flush=True)
+        embeddings_np = np.array(embeddings, dtype='float32')
+        # Save the index, text records and centroid for future runs
+        os.makedirs(get_dataset_index_dir(dataset_id), exist_ok=True)
+        faiss.write_index(faiss_index, index_path)
+        print(f"✅ FAISS index saved to {index_path}", flush=True)
+        save_rescore_vectors(dataset_id, faiss_index, embeddings_np)
+        with open(text_records_path, "w") as f:
+            json.dump(text_records, f)
+        print(f"✅ Text records saved to {text_records_path}", flush=True)
+        np.save(get_centroid_path(dataset_id), np.mean(embeddings_np, axis=0))
+        save_index_manifest(dataset_id, content_hash if not dropped_rows else None, hash_texts(text_records), row_positions)
+        clear_embedding_checkpoint(dataset_id)
+        write_compression_report(dataset_id, faiss_index)
+    except Exception as ve:
+        error_message = f"Error building FAISS index: {ve}"
+        print(error_message)
+        return {"status": "error", "message": error_message}
+
+    if dropped_rows:
+        return get_incomplete_result(filename, dropped_rows)
+    message = f"CSV {filename} successfully processed!"
+    return {"status": "processed", "message": message}
+
+def get_incomplete_result(filename, dropped_rows):
+    error_message = f"[ERROR] {dropped_rows} rows of {filename} could not be embedded. Train again to embed them."
+    print(error_message)
+    return {"status": "error", "message": error_message}
+
+def append_csv_rows(csv_path, encoding, chunk_size, content_hash):
+    """
+    Incrementally updates the index of a dataset whose CSV has changed.
+    Rows are identified by the hash of their text: rows that are not in the index yet are embedded and
+    added with index.add, while rows already in the index are kept as they are.
+    Returns None if rows of the index are no longer in the CSV, in which case the index must be rebuilt.
+    """
+    filename = os.path.basename(csv_path)
+    dataset_id = get_dataset_id(csv_path)
+    index_path = get_index_path(dataset_id)
+    text_records_path = get_text_records_path(dataset_id)
+
+    print("\n🔹 Comparing CSV rows with the FAISS index...")
+    stored_hashes = np.load(get_row_hashes_path(dataset_id))
+    current_hashes, current_positions = [np.empty(0, dtype=np.uint64)], [np.empty(0, dtype=np.int64)]
+    for texts, positions in iter_row_texts(csv_path, encoding):
+        current_hashes.append(hash_texts(texts))
+        current_positions.append(positions)
+    current_hashes, current_positions = np.concatenate(current_hashes), np.concatenate(current_positions)
+    if not np.isin(stored_hashes, current_hashes).all():
+        return None
+
+    # Rows already in the index may have moved in the CSV, so their positions are looked up again.
+    position_lookup = pd.Series(current_positions, index=current_hashes)
+    position_lookup = position_lookup[~position_lookup.index.duplicated()]
+    stored_positions = position_lookup.reindex(stored_hashes).to_numpy(dtype=np.int64)
+
+    is_new = ~np.isin(current_hashes, stored_hashes) & ~pd.Series(current_hashes).duplicated().to_numpy()
+    if not is_new.any():
+        save_index_manifest(dataset_id, content_hash, stored_hashes, stored_positions)
+        message = f"✅ Skipping {filename}: No new rows."
+        return {"status": "skipped", "message": message}
+
+    # Second pass: collect only the texts of the new rows.
+    new_texts = []
+    offset = 0
+    for texts, _ in iter_row_texts(csv_path, encoding):
+        new_texts.extend(text for text, new in zip(texts, is_new[offset:offset + len(texts)]) if new)
+        offset += len(texts)
+    new_positions = current_positions[is_new]
+    print(f"✅ Found {len(new_texts)} new rows.")
+
+    print("\n🔹 Generating Embeddings for new rows...")
+    text_chunks = [new_texts[i:i + chunk_size] for i in range(0, len(new_texts), chunk_size)]
+    position_chunks = [new_positions[i:i + chunk_size] for i in range(0, len(new_positions), chunk_size)]
+    embeddings, text_records, row_positions, dropped_rows = create_embeddings_from_chunks(text_chunks, position_chunks, dataset_id)
+
+    try:
+        if not embeddings:
+            raise ValueError("No embeddings were generated for the new rows.")
+
+        embeddings_np = np.array(embeddings).astype('float32')
+        faiss_index = faiss.read_index(index_path)
+        previous_total = faiss_index.ntotal
+        faiss_index.add(embeddings_np)
+
+        with open(text_records_path, "r") as f:
+            all_records = json.load(f)
+        all_records.extend(text_records)
+
+        centroid = np.load(get_centroid_path(dataset_id)).astype('float64')
+        centroid = (centroid * previous_total + embeddings_np.sum(axis=0)) / faiss_index.ntotal
+
+        faiss.write_index(faiss_index, index_path)
+        save_rescore_vectors(dataset_id, faiss_index, embeddings_np, append=True)
+        tmp_records_file = text_records_path + ".tmp"
+        with open(tmp_records_file, "w") as f:
+            json.dump(all_records, f)
+        os.replace(tmp_records_file, text_records_path)
+        np.save(get_centroid_path(dataset_id), centroid.astype('float32'))
+        # Only rows that were embedded are recorded, and without the content hash failed rows are retried on the next run.
+        save_index_manifest(
+            dataset_id, content_hash if not dropped_rows else None,
+            np.concatenate([stored_hashes, hash_texts(text_records)]),
+            np.concatenate([stored_positions, row_positions])
+        )
+        clear_embedding_checkpoint(dataset_id)
+        print(f"✅ FAISS index now contains {faiss_index.ntotal} embeddings.", flush=True)
+        write_compression_report(dataset_id, faiss_index)
+    except Exception as ve:
+        error_message = f"Error appending to FAISS index: {ve}"
+        print(error_message)
+        return {"status": "error", "message": error_message}
+
+    if dropped_rows:
+        return get_incomplete_result(filename, dropped_rows)
+    message = f"CSV {filename} successfully updated with {len(text_records)} new rows!"
+    return {"status": "processed", "message": message}
+
+def process_csv_streaming(csv_path, encoding, chunk_size, content_hash):
+    """
+    Out-of-core variant of process_csv used for CSV files above CSV_STREAMING_THRESHOLD_BYTES.
+    Reads the CSV in bounded batches, de-duplicates rows across batches, and streams every batch
+    through serialization, embedding and FAISS insertion. Text records are appended to disk as
+    they are produced, so neither the raw DataFrame nor the text records are held in memory.
+    A compressed index is trained on the first batch.
+
+    Returns the same status dictionary as process_csv.
+    """
+    filename = os.path.basename(csv_path)
+    dataset_id = get_dataset_id(csv_path)
+    index_path = get_index_path(dataset_id)
+    text_records_path = get_text_records_path(dataset_id)
+    print(f"\n🔹 Streaming {filename} in batches of {CSV_STREAMING_BATCH_ROWS} rows...")
+
+    faiss_index = None
+    embeddings_sum = None
+    row_hashes = []
+    row_positions = []
+    total_rows = 0
+    dropped_rows = 0
+    # Loaded once for the whole file rather than per batch.
+    checkpoint = load_embedding_checkpoint(dataset_id)
+    os.makedirs(get_dataset_index_dir(dataset_id), exist_ok=True)
+    tmp_records_file = text_records_path + ".tmp"
+    try:
+        with open(tmp_records_file, "w") as records_file:
+            records_file.write("[")
+            for batch_number, batch in enumerate(iter_clean_data(csv_path, encoding=encoding), start=1):
+                print(f"🔹 Batch {batch_number}: {len(batch)} clean rows", flush=True)
+                embeddings, text_records, positions, batch_dropped = create_embeddings_from_chunks(
+                    chunk_dataframe(batch, chunk_size), chunk_row_positions(batch, chunk_size), dataset_id, checkpoint
+                )
+                dropped_rows += batch_dropped
+                if not embeddings:
+                    continue
+
+                embeddings_np = np.array(embeddings).astype('float32')
+                first_batch = faiss_index is None
+                if first_batch:
+                    faiss_index = create_faiss_index(embeddings_np)
+                    embeddings_sum = np.zeros(embeddings_np.shape[1], dtype='float64')
+                faiss_index.add(embeddings_np)
+                save_rescore_vectors(dataset_id, faiss_index, embeddings_np, append=not first_batch)
+                embeddings_sum += embeddings_np.sum(axis=0)
+
+                row_hashes.append(hash_texts(text_records))
+                row_positions.append(positions)
+                for record in text_records:
+                    records_file.write(("," if total_rows else "") + json.dumps(record))
+                    total_rows += 1
+            records_file.write("]")
+
+        if faiss_index is None:
+            raise ValueError("No embeddings were generated. Please check your data and text extraction.")
+
+        faiss.write_index(faiss_index, index_path)
+        print(f"✅ FAISS index saved to {index_path} with {faiss_index.ntotal} embeddings.", flush=True)
+        os.replace(tmp_records_file, text_records_path)
+        print(f"✅ Text records saved to {text_records_path}", flush=True)
+        np.save(get_centroid_path(dataset_id), (embeddings_sum / faiss_index.ntotal).astype('float32'))
+        save_index_manifest(
+            dataset_id, content_hash if not dropped_rows else None, np.concatenate(row_hashes), np.concatenate(row_positions)
+        )
+        clear_embedding_checkpoint(dataset_id)
+        write_compression_report(dataset_id, faiss_index)
+    except Exception as ve:
+        if os.path.exists(tmp_records_file):
+            os.remove(tmp_records_file)
+        # The vectors were written for the new index, which was not saved.
+        if os.path.exists(get_vectors_path(dataset_id)):
+            os.remove(get_vectors_path(dataset_id))
+        error_message = f"Error building FAISS index: {ve}"
+        print(error_message)
+        return {"status": "error", "message": error_message}
+
+    if dropped_rows:
+        return get_incomplete_result(filename, dropped_rows)
     message = f"CSV {filename} successfully processed!"
     return {"status": "processed", "message": message}
 
 def process_all_csvs(chunk_size):
     """Process all CSV files in a specified directory.
-        Currently we process only a single csv.
-        We keep this function in case this changes in the future.
+        Each CSV is indexed as its own dataset.
     """
     print(f"Checking for CSVs in directory: {CSV_DIRECTORY}")
     if not os.path.exists(CSV_DIRECTORY):
@@ -293,41 +499,156 @@ def process_all_csvs(chunk_size):
   
     return {"status": "completed", "results": results}
 
-def get_csv_index_records():
+def get_csv_index_records(dataset_id: str):
     """
-    Retrieves the FAISS index and text records for the CSV file.
+    Retrieves the FAISS index and text records for the given CSV dataset.
     Raises an HTTPException if either file does not exist, indicating that 
     CSV processing has not been completed yet.
     
     Returns:
         Tuple[faiss.Index, List[str]]: The loaded FAISS index and text records.
     """
-    if not (os.path.exists(INDEX_FILE) and os.path.exists(TEXT_RECORDS_FILE)):
+    if not is_dataset_indexed(dataset_id):
         raise HTTPException(
             status_code=400, 
-            detail="CSV not processed yet. Please process the CSV file first."
+            detail=f"CSV dataset '{dataset_id}' not processed yet. Please process the CSV file first."
         )
     
-    faiss_index = faiss.read_index(INDEX_FILE)
-    with open(TEXT_RECORDS_FILE, "r") as f:
+    faiss_index = faiss.read_index(get_index_path(dataset_id))
+    with open(get_text_records_path(dataset_id), "r") as f:
         text_records = json.load(f)
 
     return faiss_index, text_records
-        
-def process_query(query_text: str, faiss_index, k: int = 5):
+
+def embed_query(query_text: str):
     """
-    Processes the input query by generating its embedding and performing a similarity search 
-    against the provided FAISS index. Returns the top k nearest neighbor indices and distances.
+    Generates the embedding of a query as a (1, dim) float32 array, or None on failure.
+    Embeddings of recent queries are served from the query-embedding cache.
     """
     try:
-        response = openai.embeddings.create(input=query_text, model="text-embedding-ada-002")
-        query_embedding = response.data[0].embedding
+        query_embedding = embed_query_cached(query_text)
     except Exception as e:
         print(f"Error generating query embedding: {e}")
-        return None, None
+        return None
+
+    return np.array(query_embedding).astype('float32').reshape(1, -1)
+
+def route_query_to_dataset(query_embedding) -> Optional[str]:
+    """
+    Picks the indexed CSV dataset whose centroid vector is most similar (cosine) to the query embedding.
+    Returns None if no dataset has been processed yet.
+    """
+    dataset_ids = [d for d in list_dataset_ids() if is_dataset_indexed(d) and os.path.exists(get_centroid_path(d))]
+    if not dataset_ids:
+        return None
+    if len(dataset_ids) == 1:
+        return dataset_ids[0]
+
+    centroids = np.stack([np.load(get_centroid_path(d)) for d in dataset_ids])
+    centroids /= np.linalg.norm(centroids, axis=1, keepdims=True)
+    query = query_embedding.reshape(-1) / np.linalg.norm(query_embedding)
+    similarities = centroids @ query
+    best = int(np.argmax(similarities))
+    print(f"Routed query to dataset '{dataset_ids[best]}' (similarity {similarities[best]:.4f})")
+    return dataset_ids[best]
+
+def process_query(
+    query_text: str,
+    faiss_index,
+    k: int = 5,
+    query_embedding=None,
+    id_mask: Optional[np.ndarray] = None,
+    rescore_vectors: Optional[np.ndarray] = None,
+    mmr_lambda: Optional[float] = None,
+):
+    """
+    Processes the input query by generating its embedding (unless one is given) and performing a
+    similarity search against the provided FAISS index. Returns the top k nearest neighbor indices and distances.
+
+    If `id_mask` (a boolean mask over the index ids) is given, only the ids where it is True are searched;
+    PQ indices reject id selectors, so their neighbours are filtered after the search instead.
+    If `rescore_vectors` (the full vectors of a compressed index) is given, k * CSV_RESCORE_FACTOR candidates
+    are fetched and re-ranked by their exact distance.
+    With `mmr_lambda` set, k * MMR_CANDIDATE_FACTOR neighbours are fetched and up to k diverse rows are kept
+    with Maximal Marginal Relevance over their stored vectors.
+    """
+    if query_embedding is None:
+        query_embedding = embed_query(query_text)
+        if query_embedding is None:
+            return None, None
 
-    query_embedding_np = np.array(query_embedding).astype('float32').reshape(1, -1)
-    distances, indices = faiss_index.search(query_embedding_np, k)
+    candidate_k = k * MMR_CANDIDATE_FACTOR if mmr_lambda is not None else k
+    fetch_k = candidate_k * CSV_RESCORE_FACTOR if rescore_vectors is not None else candidate_k
+    if id_mask is None:
+        distances, indices = faiss_index.search(query_embedding, fetch_k)
+    elif not accepts_search_selector(faiss_index):
+        distances, indices = search_post_filtered(faiss_index, query_embedding, fetch_k, id_mask)
+    else:
+        # The selector reads the bitmap through a raw pointer, so it must stay referenced during the search.
+        bitmap = np.packbits(id_mask.astype(bool), bitorder="little")
+        selector = faiss.IDSelectorBitmap(len(id_mask), faiss.swig_ptr(bitmap))
+        distances, indices = faiss_index.search(query_embedding, fetch_k, params=faiss.SearchParameters(sel=selector))
+
+    if rescore_vectors is not None:
+        distances, indices = rescore_candidates(query_embedding, indices, rescore_vectors, candidate_k)
+
+    if mmr_lambda is not None:
+        found = indices[0] >= 0
+        candidate_ids, candidate_distances = indices[0][found], distances[0][found]
+        if len(candidate_ids):
+            vectors = get_index_vectors(faiss_index, candidate_ids, rescore_vectors)
+            selected = mmr_select(query_embedding, vectors, k, mmr_lambda)
+            distances, indices = candidate_distances[selected].reshape(1, -1), candidate_ids[selected].reshape(1, -1)
     return distances, indices
 
+def search_dataset(
+    query: str,
+    query_embedding: np.ndarray,
+    dataset_id: Optional[str] = None,
+    filters: Optional[list] = None,
+    k: int = 5,
+):
+    """
+    Retrieves the text chunks of the CSV rows most similar to the query from the given dataset, or from the
+    dataset routed to by the query embedding. The search is restricted to the rows matching the explicit
+    `filters`, or the filters extracted from the query. Returns (dataset_id, chunks), with dataset_id
+    None when no dataset has been processed yet. Raises an HTTPException on invalid filters or a failed search.
+    """
+    if dataset_id is None:
+        dataset_id = route_query_to_dataset(query_embedding)
+    if dataset_id is None:
+        return None, []
+
+    # Load the FAISS index and text records of the selected dataset only
+    faiss_index, text_records = get_csv_index_records(dataset_id)
+
+    # Restrict the vector search to the rows matching the explicit or extracted column filters
+    csv_path = get_csv_path(dataset_id)
+    try:
+        query_filters = filters if filters is not None else extract_query_filters(csv_path, query)
+        id_mask = select_index_rows(csv_path, query_filters)
+    except (ValueError, TypeError) as e:
+        raise HTTPException(status_code=400, detail=str(e))
+    if id_mask is not None:
+        print(f"Filters {query_filters} match {int(id_mask.sum())} of {len(id_mask)} indexed rows.")
+        # Extracted filters can misread the query, so fall back to searching all rows.
+        if not id_mask.any() and filters is None:
+            id_mask = None
+
+    # Perform vector search to find top matching chunks
+    distances, indices = process_query(
+        query, faiss_index, k=k, query_embedding=query_embedding, id_mask=id_mask,
+        rescore_vectors=load_rescore_vectors(dataset_id, faiss_index.d), mmr_lambda=MMR_LAMBDA
+    )
+    if distances is None or indices is None:
+        raise HTTPException(status_code=500, detail="Error processing query.")
+
+    # Debug output: print similar results
+    print("Top similar results from vector search:")
+    for rank, (idx, dist) in enumerate(zip(indices[0], distances[0]), start=1):
+        print(f"{rank}. Index: {idx}, Distance: {dist}")
+
+    # Extract corresponding text chunks based on FAISS indices (-1 marks missing neighbours)
+    return dataset_id, [text_records[i] for i in indices[0] if i >= 0]
+
 
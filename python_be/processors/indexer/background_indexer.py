@@ -0,0 +1,116 @@
+import os
+import time
+import asyncio
+from processors.pdf.process_pdf import process_pdf
+from processors.csv.process_csv import process_csv
+from helpers.metrics.helpers import record_timing
+from schemas.variables import *
+from stores.indexer_store import index_queue, queued_files, file_locks, index_results
+
+# Worker tasks consuming the index queue, started with the first queued file
+indexer_tasks = []
+
+def get_file_lock(file_path: str) -> asyncio.Lock:
+    """
+    Returns the lock serializing indexing and deletion of a single file.
+    """
+    return file_locks.setdefault(os.path.abspath(file_path), asyncio.Lock())
+
+def start_indexer():
+    """
+    Starts INDEXER_WORKERS background workers, once.
+    """
+    if not indexer_tasks:
+        indexer_tasks.extend(asyncio.create_task(indexer_worker()) for _ in range(INDEXER_WORKERS))
+
+async def enqueue_file(file_type: str, file_path: str, chunk_size: int = AUTO_INGEST_CHUNK_SIZE) -> bool:
+    """
+    Queues a single uploaded PDF or CSV file for background indexing.
+    Returns False if the file is already waiting in the queue.
+    """
+    start_indexer()
+    key = os.path.abspath(file_path)
+    if key in queued_files:
+        return False
+    queued_files.add(key)
+    index_results[key] = {"file": os.path.basename(file_path), "file_type": file_type, "status": "queued"}
+    await index_queue.put((file_type, file_path, chunk_size))
+    return True
+
+async def index_file(file_type: str, file_path: str, chunk_size: int):
+    """
+    Indexes one file with process_pdf / process_csv in a worker thread, so the event loop keeps
+    accepting uploads (and other workers keep embedding) meanwhile.
+    """
+    key = os.path.abspath(file_path)
+    # Leaving the queue first lets a re-upload during indexing queue the new version.
+    queued_files.discard(key)
+    async with get_file_lock(file_path):
+        if not os.path.exists(file_path):
+            # Deleted while it was queued.
+            index_results.pop(key, None)
+            return
+
+        index_results[key] = {"file": os.path.basename(file_path), "file_type": file_type, "status": "running"}
+        processor = process_pdf if file_type == "pdf" else process_csv
+        start = time.perf_counter()
+        try:
+            result = await asyncio.to_thread(processor, file_path, chunk_size)
+        except Exception as e:
+            result = {"status": "error", "message": f"Indexing failed: {e}"}
+        record_timing(f"indexer.{file_type}", (time.perf_counter() - start) * 1000)
+        print(f"[INDEXER] {os.path.basename(file_path)}: {result.get('message')}", flush=True)
+
+        if key not in queued_files:
+            index_results[key] = {"file": os.path.basename(file_path), "file_type": file_type, **result}
+
+async def indexer_worker():
+    while True:
+        file_type, file_path, chunk_size = await index_queue.get()
+        try:
+            await index_file(file_type, file_path, chunk_size)
+        finally:
+            index_queue.task_done()
+
+async def process_all_files(file_type: str, chunk_size: int) -> dict:
+    """
+    Lock-aware counterpart of process_all_pdfs / process_all_csvs used for training: every PDF or CSV
+    file is processed in a worker thread while holding its file lock, so training cannot race the
+    background indexer, an upload or a delete of the same file. Returns the same result dictionary.
+    """
+    directory, extension = (PDF_DIRECTORY, ".pdf") if file_type == "pdf" else (CSV_DIRECTORY, ".csv")
+    print(f"Checking for {file_type.upper()}s in directory: {directory}")
+    if not os.path.exists(directory):
+        error_message = f"Error: Directory '{directory}' does not exist."
+        print(error_message)
+        return {"status": "error", "message": error_message}
+
+    files = [f for f in os.listdir(directory) if f.endswith(extension)]
+    if not files:
+        message = f"No {file_type.upper()} files found. Upload one!"
+        print(message)
+        return {"status": "empty", "message": message}
+
+    processor = process_pdf if file_type == "pdf" else process_csv
+    results = []
+    for filename in files:
+        file_path = os.path.join(directory, filename)
+        async with get_file_lock(file_path):
+            if not os.path.exists(file_path):
+                # Deleted while earlier files were processed.
+                continue
+            results.append(await asyncio.to_thread(processor, file_path, chunk_size))
+
+    return {"status": "completed", "results": results}
+
+def forget_file(file_path: str):
+    """
+    Drops the indexing status of a deleted file.
+    """
+    index_results.pop(os.path.abspath(file_path), None)
+
+def get_indexer_status() -> dict:
+    """
+    Returns the number of queued files and the latest indexing status of every file.
+    """
+    return {"queued": index_queue.qsize(), "files": list(index_results.values())}
@@ -1,7 +1,10 @@
 import fitz  # PyMuPDF
 import os
+import bisect
+import json
 from helpers.pdf.helpers import *
 from schemas.variables import *
+from helpers.metrics.helpers import increment_counter
 import nltk
 nltk.download('punkt_tab')
 from nltk.tokenize import sent_tokenize
@@ -10,13 +13,37 @@ os.environ["TOKENIZERS_PARALLELISM"] = "false"
 
 def add_document(id, text):
     """Store document embeddings in ChromaDB."""
-    embedding = embed_text(text)
+    add_documents([id], [text])
+
+def add_documents(ids, texts, metadatas=None):
+    """Store the embeddings of several documents in ChromaDB, embedded in batched requests."""
+    embeddings = embed_texts(texts)
+    invalidate_answer_cache()
     collection.add(
-        ids=[id],
-        embeddings=[embedding],
-        metadatas=[{"text": text}]
+        ids=ids,
+        embeddings=embeddings,
+        metadatas=[{"text": text, **(extra or {})} for text, extra in zip(texts, metadatas or [None] * len(texts))]
     )
 
+def locate_chunk_pages(chunks, pages_text):
+    """Return the 1-based page on which each chunk starts, by finding its opening words in the page texts."""
+    page_starts = []
+    offset = 0
+    for page_text in pages_text:
+        page_starts.append(offset)
+        offset += len(page_text) + 1  # pages are joined with "\n"
+    full_text = "\n".join(pages_text)
+
+    pages = []
+    cursor = 0
+    for chunk in chunks:
+        position = full_text.find(chunk[:50], cursor)
+        if position >= 0:
+            # Overlapping chunks start before the end of the previous one, so search on from the start.
+            cursor = position
+        pages.append(bisect.bisect_right(page_starts, cursor))
+    return pages
+
 def chunk_text(text, chunk_size=200, overlap=3):
     """Split text into overlapping chunks without breaking sentences,
        and handle sentences that exceed the chunk size by splitting them further.
@@ -110,31 +137,73 @@ def process_pdf(pdf_path, chunk_size):
     num_chunks = len(chunks)
     print(f"[DEBUG] Chunking complete: {num_chunks} chunks created.", flush=True)
 
-    for i, chunk in enumerate(chunks):
-        chunk_id = f"{pdf_hash}_chunk_{i}"
-        print(f"[DEBUG] Processing chunk {i + 1}/{num_chunks}: {chunk_id}")
-
-        # Check if the chunk is already stored before inserting
+    # Chunks are stored one by one, so the chunks of an interrupted run are the checkpoint to resume from.
+    # Chunk IDs are positional, so chunks stored with another chunk size must be removed first.
+    checkpoint = load_pdf_checkpoint(pdf_hash)
+    if checkpoint is not None and checkpoint.get("chunk_size") != chunk_size:
+        print(f"[DEBUG] Discarding chunks of an interrupted run with chunk size {checkpoint.get('chunk_size')}.")
         try:
-            existing_chunks = collection.get(ids=[chunk_id])
+            release_pdf_chunks(pdf_hash)
+            collection.delete(ids=[f"{pdf_hash}_chunk_{i}" for i in range(checkpoint.get("num_chunks", 0))])
         except Exception as e:
-            print(f"[ERROR] Error retrieving chunk {chunk_id} from collection: {e}")
-            continue
-
-        if "ids" in existing_chunks and existing_chunks["ids"]:
-            print(f"⏭️ Skipping existing chunk {chunk_id}")
-            continue
+            error_message = f"[ERROR] Failed to discard the chunks of an interrupted run of {filename}: {e}"
+            print(error_message)
+            return {"status": "error", "message": error_message}
+    save_pdf_checkpoint(pdf_hash, chunk_size, num_chunks)
+
+    chunk_ids = [f"{pdf_hash}_chunk_{i}" for i in range(num_chunks)]
+
+    # Near-duplicate chunks (shared boilerplate, overlap) reuse one representative's embedding,
+    # which keeps pointers to every source file and page.
+    sources = [
+        {"chunk_id": chunk_id, "file": filename, "page": page}
+        for chunk_id, page in zip(chunk_ids, locate_chunk_pages(chunks, pages_text))
+    ]
+    try:
+        representatives, new_sources = register_pdf_chunks(chunk_ids, chunks, sources)
+    except Exception as e:
+        error_message = f"[ERROR] Near-duplicate detection failed for {filename}: {e}"
+        print(error_message)
+        return {"status": "error", "message": error_message}
 
-        print(f"[DEBUG] Embedding and adding chunk {i + 1}/{num_chunks}: {chunk_id} ...")
+    try:
+        existing_ids = get_stored_chunk_ids(chunk_ids)
+    except Exception as e:
+        print(f"[ERROR] Error retrieving stored chunks from collection: {e}")
+        existing_ids = set()
+    if existing_ids:
+        print(f"🔄 Resuming {filename}: {len(existing_ids)}/{num_chunks} chunks already embedded.", flush=True)
+
+    # Missing chunks are embedded and stored in batches; a batch is only lost once its retries are exhausted.
+    pending = [
+        i for i in range(num_chunks)
+        if representatives[i] == chunk_ids[i] and chunk_ids[i] not in existing_ids
+    ]
+    failed_chunks = 0
+    for start in range(0, len(pending), EMBEDDING_BATCH_SIZE):
+        batch = pending[start:start + EMBEDDING_BATCH_SIZE]
+        print(f"[DEBUG] Embedding and adding chunks {batch[0] + 1}-{batch[-1] + 1}/{num_chunks} ...")
         try:
-            add_document(chunk_id, chunk)
-            print(f"[DEBUG] Chunk {chunk_id} successfully embedded and added.", flush=True)
+            add_documents(
+                [chunk_ids[i] for i in batch],
+                [chunks[i] for i in batch],
+                [{"sources": json.dumps(new_sources.get(chunk_ids[i], [sources[i]]))} for i in batch],
+            )
+            print(f"[DEBUG] {len(batch)} chunks successfully embedded and added.", flush=True)
         except Exception as e:
-            print(f"[ERROR] Error embedding chunk {chunk_id}: {e}", flush=True)
+            failed_chunks += len(batch)
+            increment_counter("embeddings.dropped_texts", len(batch))
+            print(f"[ERROR] Error embedding chunks {batch[0] + 1}-{batch[-1] + 1}: {e}", flush=True)
 
+    if failed_chunks:
+        # Keep the checkpoint, so training again only embeds the missing chunks.
+        error_message = f"[ERROR] {failed_chunks}/{num_chunks} chunks of {filename} failed. Train again to resume."
+        print(error_message)
+        return {"status": "error", "message": error_message}
 
     try:
         mark_pdf_as_processed(pdf_path, num_chunks, pdf_hash)
+        clear_pdf_checkpoint(pdf_hash)
         print("[DEBUG] Marked PDF as processed.", flush=True)
         return {"status": "processed", "message": f"PDF {filename} successfully processed!"}
     except Exception as e:
@@ -73,5 +73,72 @@ tools = [
                 "required": ["csv_path", "column1", "column2", "encoding"]
             },
         }
+    },
+    {
+        "type": "function",
+        "function": {
+            "name": "query_dataset",
+            "description": "Answers exact numeric questions such as totals, averages, counts or rankings (e.g. 'total revenue per region in 2023') by running a filter, group-by and aggregation query over the whole CSV file.",
+            "parameters": {
+                "type": "object",
+                "properties": {
+                    "csv_path": {
+                        "type": "string",
+                        "description": "Path to the CSV file"
+                    },
+                    "encoding": {
+                        "type": "string",
+                        "description": "The encoding of the CSV file (e.g., 'utf-8', 'latin1'). Defaults to 'utf-8' if not provided."
+                    },
+                    "filters": {
+                        "type": "array",
+                        "description": "Row filters that must all match.",
+                        "items": {
+                            "type": "object",
+                            "properties": {
+                                "column": {"type": "string", "description": "Column to filter on"},
+                                "operator": {"type": "string", "enum": ["==", "!=", ">", ">=", "<", "<=", "in", "contains"]},
+                                "value": {
+                                    "type": ["string", "number", "array"],
+                                    "items": {"type": ["string", "number"]},
+                                    "description": "Value to compare with. Use a list of values for the 'in' operator."
+                                }
+                            },
+                            "required": ["column", "operator", "value"]
+                        }
+                    },
+                    "group_by": {
+                        "type": "array",
+                        "description": "Columns to group the results by.",
+                        "items": {"type": "string"}
+                    },
+                    "aggregations": {
+                        "type": "array",
+                        "description": "Aggregations to compute. Omit the column of a 'count' to count rows.",
+                        "items": {
+                            "type": "object",
+                            "properties": {
+                                "function": {"type": "string", "enum": ["count", "sum", "mean", "median", "min", "max", "nunique", "std"]},
+                                "column": {"type": "string", "description": "Column to aggregate"}
+                            },
+                            "required": ["function"]
+                        }
+                    },
+                    "sort_by": {
+                        "type": "string",
+                        "description": "Result column to sort by, e.g. 'sum_revenue'. Aggregated columns are named '<function>_<column>'."
+                    },
+                    "ascending": {
+                        "type": "boolean",
+                        "description": "Sort ascending instead of descending."
+                    },
+                    "limit": {
+                        "type": "integer",
+                        "description": "Maximum number of result rows to return."
+                    }
+                },
+                "required": ["csv_path", "encoding"]
+            },
+        }
     }
 ]
\ No newline at end of file
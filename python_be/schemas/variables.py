@@ -1,8 +1,148 @@
-# Files to persist the FAISS index and text mapping
+# Files to persist the FAISS index and text mapping, stored per dataset in CSV_INDEX_DIRECTORY/<dataset_id>/
 INDEX_FILE = "faiss_index.index"
 TEXT_RECORDS_FILE = "text_records.json"
+CENTROID_FILE = "centroid.npy"
+ROW_HASHES_FILE = "row_hashes.npy"
+ROW_POSITIONS_FILE = "row_positions.npy"
+INDEX_MANIFEST_FILE = "index_manifest.json"
+VECTORS_FILE = "vectors.f16"
+COMPRESSION_REPORT_FILE = "compression_report.json"
+# Embeddings of an unfinished CSV ingestion, flushed to disk every EMBEDDING_CHECKPOINT_ROWS rows
+EMBEDDING_CHECKPOINT_DIRECTORY = "checkpoint"
+EMBEDDING_CHECKPOINT_ROWS = 5000
+CSV_INDEX_DIRECTORY = "csv_indices"
 # Directories
 PDF_DIRECTORY = "pdfs"
 PDF_UPLOAD_FOLDER = "./pdfs"
+# Progress of unfinished PDF ingestions, one file per PDF hash
+PDF_CHECKPOINT_DIRECTORY = "pdf_checkpoints"
+# Near-duplicate PDF chunks: MinHash over word shingles, LSH banding, and the Jaccard threshold above
+# which a chunk reuses the embedding of an existing one
+PDF_DEDUP_INDEX_FILE = "pdf_dedup_index.npz"
+PDF_SHINGLE_SIZE = 5
+PDF_MINHASH_PERMUTATIONS = 128
+PDF_MINHASH_SEED = 42
+PDF_LSH_BANDS = 16
+PDF_DEDUP_THRESHOLD = 0.8
 CSV_DIRECTORY = "datasets"
-CSV_UPLOAD_FOLDER = "./datasets"
\ No newline at end of file
+CSV_UPLOAD_FOLDER = "./datasets"
+MAX_CSV_DATASETS = 5
+MAX_PDF_FILES = 5
+# Uploads are streamed to disk in chunks of this size and rejected above the size limits
+UPLOAD_CHUNK_BYTES = 1024 * 1024
+MAX_PDF_UPLOAD_BYTES = 100 * 1024 * 1024
+MAX_CSV_UPLOAD_BYTES = 2 * 1024 * 1024 * 1024
+# Room for the multipart boundaries and headers when the size limits are checked against Content-Length
+UPLOAD_MULTIPART_OVERHEAD_BYTES = 64 * 1024
+# Suffix of the file recording an upload's SHA-256 hash, stored next to it
+UPLOAD_HASH_SUFFIX = ".sha256"
+# Index every uploaded file in the background (can be overridden per upload with ?auto_ingest=)
+AUTO_INGEST_ON_UPLOAD = False
+AUTO_INGEST_CHUNK_SIZE = 200
+# Number of files the background indexer processes concurrently
+INDEXER_WORKERS = 2
+# CSV files larger than this are ingested in streaming mode
+CSV_STREAMING_THRESHOLD_BYTES = 100 * 1024 * 1024
+# Number of rows read from disk per batch in streaming mode
+CSV_STREAMING_BATCH_ROWS = 50000
+# Memory cap for cleaned DataFrames kept in the dataset cache
+DATASET_CACHE_MAX_BYTES = 512 * 1024 * 1024
+# Columnar snapshots of cleaned CSV files
+CSV_SNAPSHOT_DIRECTORY = "snapshots"
+SNAPSHOT_METADATA_KEY = "chatbot_source"
+# Precomputed dataset profile, persisted next to each dataset's FAISS index
+PROFILE_FILE = "dataset_profile.json"
+# Number of most/least frequent categories kept per column in the profile
+PROFILE_TOP_K = 10
+# Bounds for compare_columns cross-tabulations
+COMPARE_MAX_CATEGORIES = 10
+COMPARE_MAX_CHARS = 6000
+OTHER_CATEGORY_LABEL = "Other"
+# Structured query tool
+QUERY_AGGREGATIONS = {"count", "sum", "mean", "median", "min", "max", "nunique", "std"}
+QUERY_DEFAULT_LIMIT = 20
+QUERY_MAX_LIMIT = 100
+
+# Optional compressed vector storage for CSV indices: None (flat float32), "sq8", "fp16" or "pq"
+CSV_VECTOR_COMPRESSION = None
+# Dimension the embeddings are projected to with PCA before quantization (None keeps all 1536)
+CSV_VECTOR_PCA_DIM = 256
+# Number of PQ sub-quantizers (must divide the projected dimension)
+CSV_PQ_SUBQUANTIZERS = 32
+# Datasets with fewer rows are stored uncompressed; training uses at most CSV_COMPRESSION_TRAIN_ROWS rows
+CSV_COMPRESSION_MIN_ROWS = 1000
+CSV_COMPRESSION_TRAIN_ROWS = 100000
+# Compressed searches fetch k * CSV_RESCORE_FACTOR candidates, re-scored with the full vectors
+CSV_RESCORE_FACTOR = 4
+# Queries sampled from the dataset to measure the recall of the compressed index
+COMPRESSION_REPORT_QUERIES = 100
+COMPRESSION_REPORT_K = 5
+
+# Filter extraction for the CSV vector search
+FILTER_MAX_CATEGORIES = 200
+QUERY_RANGE_PATTERNS = [
+    (r"at least|no less than|>=", ">="),
+    (r"at most|no more than|<=", "<="),
+    (r"greater than|more than|over|above|>", ">"),
+    (r"less than|fewer than|under|below|<", "<"),
+]
+
+# Embedding requests: inputs per request, and the adaptive (AIMD) concurrency limits
+EMBEDDING_MODEL = "text-embedding-ada-002"
+EMBEDDING_BATCH_SIZE = 100
+EMBEDDING_INITIAL_CONCURRENCY = 4
+EMBEDDING_MIN_CONCURRENCY = 1
+EMBEDDING_MAX_CONCURRENCY = 16
+EMBEDDING_DECREASE_FACTOR = 0.5
+# Fraction of the rate limit that must remain for the concurrency limit to grow
+EMBEDDING_HEADROOM = 0.1
+# Retries of failed embedding requests, with exponential backoff and full jitter
+EMBEDDING_MAX_RETRIES = 6
+EMBEDDING_BASE_BACKOFF_SECONDS = 1.0
+EMBEDDING_MAX_BACKOFF_SECONDS = 60.0
+
+# Number of query embeddings kept in the in-process LRU cache
+QUERY_EMBEDDING_CACHE_SIZE = 1024
+
+# Maximal Marginal Relevance selection of retrieved context: relevance/diversity trade-off (1.0 = pure
+# relevance; None disables MMR, set e.g. 0.7 to enable it) and candidates fetched per selected chunk
+MMR_LAMBDA = None
+MMR_CANDIDATE_FACTOR = 3
+
+# Semantic answer cache for PDF chat: minimum cosine similarity between queries, lifetime and size
+ANSWER_CACHE_SIMILARITY = 0.95
+ANSWER_CACHE_TTL_SECONDS = 60 * 60
+ANSWER_CACHE_MAX_ENTRIES = 500
+# Queries containing these words may refer to the conversation, so they are not answered from the cache
+ANSWER_CACHE_CONTEXT_WORDS = {
+    "it", "its", "this", "that", "these", "those", "they", "them", "their", "he", "she", "him", "her",
+    "above", "previous", "earlier", "before", "again", "more", "also", "else", "same", "another",
+}
+# Characters per chunk when a cached answer is replayed as a stream
+ANSWER_CACHE_REPLAY_CHARS = 20
+
+# Admission control of upstream chat completion streams: streams open at once, requests waiting for
+# a stream, streams one session may hold or wait for, and the longest wait before a request is refused
+LLM_MAX_CONCURRENT_STREAMS = 8
+LLM_MAX_QUEUED_STREAMS = 32
+LLM_MAX_STREAMS_PER_SESSION = 2
+LLM_QUEUE_TIMEOUT_SECONDS = 30.0
+
+# Rolling chat history: recent messages sent verbatim, older ones folded into a running summary by a
+# cheap model once HISTORY_SUMMARY_BATCH of them have piled up, and the raw messages kept at most when
+# summarization keeps failing
+HISTORY_RECENT_MESSAGES = 4
+HISTORY_SUMMARY_BATCH = 4
+HISTORY_MAX_MESSAGES = 24
+HISTORY_SUMMARY_MODEL = "gpt-4o-mini"
+HISTORY_SUMMARY_MAX_TOKENS = 300
+
+# Unified PDF + CSV chat: chunks retrieved from each corpus and the token budget of the merged context
+# (estimated at UNIFIED_CHARS_PER_TOKEN characters per token)
+UNIFIED_PDF_TOP_K = 10
+UNIFIED_CSV_TOP_K = 5
+UNIFIED_CONTEXT_TOKENS = 3000
+UNIFIED_CHARS_PER_TOKEN = 4
+
+# Maximum number of CSV tool calls executed in parallel
+TOOL_MAX_WORKERS = 4
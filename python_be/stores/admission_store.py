@@ -0,0 +1,9 @@
+from collections import OrderedDict
+
+# Upstream chat completion streams open and waiting, and the running average stream duration
+admission_state = {"active": 0, "queued": 0, "avg_stream_seconds": 5.0}
+
+# Waiting requests per session, served round-robin across sessions, and the streams
+# each session holds or waits for. Only touched from the event loop, so no lock is needed.
+admission_waiters = OrderedDict()
+admission_sessions = {}
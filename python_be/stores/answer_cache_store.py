@@ -0,0 +1,7 @@
+import threading
+
+# Cached PDF chat answers (query embedding, model, answer, creation time), oldest first,
+# the version of the PDF corpus they were answered from, and the lookup hits and misses
+answer_cache = []
+answer_cache_state = {"corpus_version": 0, "hits": 0, "misses": 0}
+answer_cache_lock = threading.Lock()
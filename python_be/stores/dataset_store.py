@@ -0,0 +1,6 @@
+import threading
+from collections import OrderedDict
+
+# Cleaned CSV DataFrames keyed by file identity (path, size, mtime), least recently used first
+dataset_store = OrderedDict()
+dataset_store_lock = threading.Lock()
@@ -0,0 +1,14 @@
+import threading
+from collections import OrderedDict
+from schemas.variables import EMBEDDING_INITIAL_CONCURRENCY
+
+# Shared state of the embedding scheduler: the AIMD concurrency limit, requests in flight,
+# and the time until which new requests wait after a rate limit
+embedding_scheduler_state = {"limit": float(EMBEDDING_INITIAL_CONCURRENCY), "in_flight": 0, "paused_until": 0.0}
+embedding_scheduler_condition = threading.Condition()
+
+# Query embeddings keyed by (model, text), least recently used first, and the embedding
+# requests in flight per key, which identical concurrent queries wait on instead of repeating
+query_embedding_cache = OrderedDict()
+query_embedding_in_flight = {}
+query_embedding_lock = threading.Lock()
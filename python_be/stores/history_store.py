@@ -0,0 +1,7 @@
+import threading
+
+# Running summaries of the older turns of each conversation, keyed by (chat, session_id),
+# and the conversations being summarized in the background
+history_summaries = {}
+history_summarizing = set()
+history_lock = threading.Lock()
@@ -0,0 +1,10 @@
+import asyncio
+
+# Files waiting for the background indexer, as (file_type, path, chunk_size) jobs
+index_queue = asyncio.Queue()
+# Paths currently in the queue, so a file uploaded twice is only queued once
+queued_files = set()
+# Per-file locks, held while a file is indexed or its vectors are deleted
+file_locks = {}
+# Latest background indexing status per file path
+index_results = {}
@@ -0,0 +1,5 @@
+import threading
+
+# Global dictionary of runtime metrics (timings, counters), keyed by metric name
+metrics_store = {}
+metrics_store_lock = threading.Lock()
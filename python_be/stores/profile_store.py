@@ -0,0 +1,2 @@
+# Dataset profiles keyed by file identity (path, size, mtime)
+profile_store = {}
@@ -0,0 +1,5 @@
+import asyncio
+
+# File names currently being uploaded, per upload folder, so they count towards the file limits
+pending_uploads = {}
+upload_lock = asyncio.Lock()
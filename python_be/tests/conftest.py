@@ -0,0 +1,12 @@
+import os
+import sys
+import pytest
+
+sys.path.insert(0, os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+
+@pytest.fixture
+def workdir(tmp_path, monkeypatch):
+    """Runs a test in an empty directory, where the datasets and indices folders are created."""
+    monkeypatch.chdir(tmp_path)
+    os.makedirs("datasets")
+    return tmp_path
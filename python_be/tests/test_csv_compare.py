@@ -0,0 +1,23 @@
+import re
+import pandas as pd
+import helpers.csv.helpers as csv_helpers
+
+def test_bucket_column_keeps_numeric_bins_ordered():
+    s = pd.Series([1, 2, 3, 5, 8, 12, 15, 20, 30, 50, 80, 100] * 3, dtype=float)
+    bucketed = csv_helpers.bucket_column(s, max_categories=4)
+    lefts = [float(label[1:].split(",")[0]) for label in bucketed.cat.categories]
+    assert lefts == sorted(lefts)
+
+def test_compare_columns_lists_numeric_buckets_in_numeric_order(workdir):
+    csv_path = "datasets/orders.csv"
+    pd.DataFrame({
+        "amount": [float(v) for v in range(1, 121)],
+        "kind": ["a", "b", "c"] * 40,
+    }).to_csv(csv_path, index=False)
+
+    result = csv_helpers.compare_columns(csv_path, "amount", "kind")
+    table = result.split("\n\n")[0]
+    lefts = [float(left) for left in re.findall(r"^\((-?[\d.]+), [\d.]+\]", table, flags=re.MULTILINE)]
+    assert len(lefts) == csv_helpers.COMPARE_MAX_CATEGORIES
+    # Alphabetical order would put e.g. "(108.1, 120.0]" before "(12.9, 24.8]".
+    assert lefts == sorted(lefts)
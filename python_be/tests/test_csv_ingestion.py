@@ -0,0 +1,82 @@
+import json
+import zlib
+import faiss
+import numpy as np
+import pytest
+import helpers.csv.helpers as csv_helpers
+import processors.csv.process_csv as process_csv_module
+from processors.csv.process_csv import process_csv
+
+DIM = 8
+
+class Interrupted(BaseException):
+    """Stops an ingestion the way a killed process would, past the per-chunk error handling."""
+
+def fake_embedding(text: str) -> list:
+    return np.random.default_rng(zlib.crc32(text.encode())).random(DIM).tolist()
+
+def write_csv(path, rows: int):
+    with open(path, "w") as f:
+        f.write("name,value\n")
+        for i in range(rows):
+            f.write(f"item{i},{i * 10}\n")
+
+@pytest.mark.parametrize("streaming", [False, True])
+def test_interrupted_ingestion_resumes_from_checkpoint(workdir, monkeypatch, streaming):
+    csv_path = "datasets/items.csv"
+    write_csv(csv_path, 30)
+    monkeypatch.setattr(csv_helpers, "EMBEDDING_CHECKPOINT_ROWS", 5)
+    if streaming:
+        monkeypatch.setattr(process_csv_module, "CSV_STREAMING_THRESHOLD_BYTES", 0)
+
+    embedded = []
+    def interrupted_embed_texts(texts):
+        if len(embedded) >= 10:
+            raise Interrupted()
+        embedded.extend(texts)
+        return [fake_embedding(text) for text in texts]
+
+    monkeypatch.setattr(csv_helpers, "embed_texts", interrupted_embed_texts)
+    with pytest.raises(Interrupted):
+        process_csv(csv_path, chunk_size=5)
+    assert len(embedded) == 10
+    assert csv_helpers.load_embedding_checkpoint("items")["num_parts"] == 2
+
+    resumed = []
+    def embed_texts(texts):
+        resumed.extend(texts)
+        return [fake_embedding(text) for text in texts]
+
+    monkeypatch.setattr(csv_helpers, "embed_texts", embed_texts)
+    result = process_csv(csv_path, chunk_size=5)
+    assert result["status"] == "processed"
+    # Only the rows missing from the checkpoint are embedded again.
+    assert len(resumed) == 20
+    assert not set(resumed) & set(embedded)
+
+    index = faiss.read_index(csv_helpers.get_index_path("items"))
+    with open(csv_helpers.get_text_records_path("items")) as f:
+        text_records = json.load(f)
+    assert index.ntotal == len(text_records) == 30
+    # Checkpointed rows keep the embeddings they were stored with.
+    for i, text in enumerate(text_records):
+        np.testing.assert_allclose(index.reconstruct(i), fake_embedding(text), rtol=1e-6)
+    assert not csv_helpers.os.path.exists(csv_helpers.get_checkpoint_dir("items"))
+
+def test_failed_chunk_is_counted_once_in_result_and_metric(workdir, monkeypatch):
+    from helpers.metrics.helpers import get_metrics
+    monkeypatch.setattr(csv_helpers, "EMBEDDING_CHECKPOINT_ROWS", 100)
+    # Half of the failing chunk is checkpointed, so only the other half would be sent to the model.
+    checkpointed = [f"row {i}" for i in range(3)]
+    csv_helpers.save_embedding_checkpoint("items", 0, csv_helpers.hash_texts(checkpointed), [fake_embedding(t) for t in checkpointed])
+
+    def failing_embed_texts(texts):
+        raise RuntimeError("rate limited")
+
+    monkeypatch.setattr(csv_helpers, "embed_texts", failing_embed_texts)
+    before = get_metrics().get("embeddings.dropped_texts", {"count": 0})["count"]
+    chunk = checkpointed + [f"row {i}" for i in range(3, 6)]
+    embeddings, _, _, dropped_rows = csv_helpers.create_embeddings_from_chunks([chunk], dataset_id="items")
+    assert embeddings == []
+    assert dropped_rows == 6
+    assert get_metrics()["embeddings.dropped_texts"]["count"] - before == dropped_rows
@@ -0,0 +1,38 @@
+import numpy as np
+import pytest
+import helpers.csv.helpers as csv_helpers
+from processors.csv.process_csv import process_query
+
+DIM = 32
+ROWS = 2000
+
+@pytest.fixture
+def vectors():
+    return np.random.default_rng(0).random((ROWS, DIM), dtype=np.float32)
+
+@pytest.mark.parametrize("pca_dim", [None, 16])
+@pytest.mark.parametrize("compression", [None, "sq8", "fp16", "pq"])
+def test_filtered_search_returns_only_matching_rows(monkeypatch, vectors, compression, pca_dim):
+    monkeypatch.setattr(csv_helpers, "CSV_VECTOR_COMPRESSION", compression)
+    monkeypatch.setattr(csv_helpers, "CSV_VECTOR_PCA_DIM", pca_dim)
+    monkeypatch.setattr(csv_helpers, "CSV_PQ_SUBQUANTIZERS", 8)
+    monkeypatch.setattr(csv_helpers, "CSV_COMPRESSION_MIN_ROWS", 100)
+    index = csv_helpers.create_faiss_index(vectors)
+    index.add(vectors)
+    rescore_vectors = vectors if csv_helpers.is_compressed_index(index) else None
+
+    # A selective filter: one row in twenty, none of them the query row itself.
+    id_mask = np.zeros(ROWS, dtype=bool)
+    id_mask[1::20] = True
+    query = vectors[:1]
+    distances, indices = process_query(
+        "query", index, k=5, query_embedding=query, id_mask=id_mask, rescore_vectors=rescore_vectors, mmr_lambda=None
+    )
+
+    assert indices.shape == (1, 5)
+    assert id_mask[indices[0]].all()
+    assert (np.diff(distances[0]) >= 0).all()
+    if compression is None:
+        exact = ((vectors[id_mask] - query) ** 2).sum(axis=1)
+        expected = np.flatnonzero(id_mask)[np.argsort(exact)[:5]]
+        assert indices[0].tolist() == expected.tolist()
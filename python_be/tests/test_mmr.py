@@ -0,0 +1,14 @@
+import numpy as np
+from helpers.embeddings.helpers import mmr_select
+
+def test_mmr_select_keeps_k_candidates_even_when_they_are_near_duplicates():
+    query = np.array([1.0, 0.0, 0.0])
+    candidates = np.array([[1.0, 0.0, 0.0], [1.0, 0.001, 0.0], [1.0, 0.0, 0.001], [0.0, 1.0, 0.0]])
+    selected = mmr_select(query, candidates, 3, 0.3)
+    assert len(selected) == 3
+    assert selected[0] == 0
+    # The orthogonal candidate is picked before the remaining near-duplicates of the first pick.
+    assert selected[1] == 3
+
+def test_mmr_select_returns_all_candidates_when_fewer_than_k():
+    assert sorted(mmr_select([1.0, 0.0], [[1.0, 0.0], [0.0, 1.0]], 5, 0.5)) == [0, 1]
@@ -75,7 +75,7 @@ function UploadCsvComponent() {
                 Upload your CSV
             </h3>
             <h5 className="text-center text-sm font-italic">
-                Must be a .csv file. Max allowed files: 1
+                Must be a .csv file. Max allowed files: 5
             </h5>
             <div className="flex flex-col items-center justify-center space-y-4">
                 {uploaded && (